@@ -546,7 +546,7 @@ $(function() {
         event.preventDefault();
         if ($(this).hasClass('verselist')) {
             // Lookup a list of verses so they will show up on the side.
-            lookup($(this).attr('href').split('=')[1]);
+            lookup($(this).attr('href').split('=')[1].split('&')[0]);
         } else {
             // One reference was clicked so it is probably already in the verse
             // list.
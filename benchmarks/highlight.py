@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Search term highlighting benchmark.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Highlight the search terms in the raw text of the first verses found by
+a search, once with the regex highlighter the lookup used to use and once
+with highlight_osis, and time them.  highlight_osis_cold is timed with an
+empty cache of the verse text without tags, and highlight_osis_table reads
+the plain entries from a table, like the lookup does once render.py has
+built them.
+
+"""
+
+from os.path import dirname, join
+from time import perf_counter
+from tempfile import TemporaryDirectory
+import argparse
+import json
+import sys
+import re
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+import sword_search
+from sword_search import build_highlight_regx, highlight_search_terms
+from render import build_highlight, highlight_osis
+import render
+from biblesearch_app import search_regx
+
+
+def regex_highlight(text_list: list, terms_list: list) -> list:
+    """ Highlight the terms in every text the way lookup_verses used to.
+
+    """
+
+    highlight_text = '<span class="query-highlight">\\1</span>'
+    output = []
+    for verse_text in text_list:
+        reel = build_highlight_regx(terms_list, False,
+                                    color_tag='</?span[^>]*>',
+                                    extra_tag='</span>')
+        verse_text = re.sub(r'(stron)g(:|Morph:|sMarkup)', '\\1k\\2',
+                            verse_text, flags=re.IGNORECASE)
+        verse_text = highlight_search_terms(verse_text, reel, highlight_text,
+                                            color_tag='</?span[^>]*>')
+        output.append(re.sub(r'(stron)k(:|Morph:|sMarkup)', '\\1g\\2',
+                             verse_text, flags=re.IGNORECASE))
+
+    return output
+
+
+def position_highlight(text_list: list, terms_list: list) -> list:
+    """ Highlight the terms in every text with highlight_osis.
+
+    """
+
+    highlight_regx = build_highlight(terms_list)
+    return [highlight_osis(text, highlight_regx) for text in text_list]
+
+
+def cold_highlight(text_list: list, terms_list: list) -> list:
+    """ Highlight the terms in every text with highlight_osis, without any
+    of the text cached.
+
+    """
+
+    render._plain_text.cache_clear()
+    return position_highlight(text_list, terms_list)
+
+
+def table_highlight(text_list: list, entry_table: object,
+                    terms_list: list) -> list:
+    """ Highlight the terms in every text with highlight_osis, with the
+    plain entry of each one read from entry_table.
+
+    """
+
+    highlight_regx = build_highlight(terms_list)
+    return [highlight_osis(text, highlight_regx, entry_table[i])
+            for i, text in enumerate(text_list)]
+
+
+def best_time(func, repeat: int, *args) -> float:
+    """ Return the best time in seconds of calling func with args.
+
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        times.append(perf_counter() - start)
+
+    return min(times)
+
+
+def main(args: object) -> dict:
+    """ Run the benchmark and return a dictionary of the results.
+
+    """
+
+    terms_list = [''.join(i) for i in search_regx.findall(args.terms)]
+    bible_search = sword_search.Search(multiword=True)
+    verse_list = sorted(bible_search.mixed_search(terms_list),
+                        key=sword_search.sort_key)[:args.count]
+    text_list = [text for _, text in
+                 sword_search.VerseTextIter(iter(verse_list), strongs=True,
+                                            morph=True, render='raw')]
+
+    with TemporaryDirectory() as table_path:
+        filename = join(table_path, 'plain.bin')
+        sword_search.RefTable.write(filename,
+                                    map(render.plain_entry, text_list))
+        entry_table = sword_search.RefTable(filename)
+
+        return {
+            'terms': args.terms,
+            'verses': len(text_list),
+            'regex_highlight': best_time(regex_highlight, args.repeat,
+                                         text_list, terms_list),
+            'highlight_osis': best_time(position_highlight, args.repeat,
+                                        text_list, terms_list),
+            'highlight_osis_cold': best_time(cold_highlight, args.repeat,
+                                             text_list, terms_list),
+            'highlight_osis_table': best_time(table_highlight, args.repeat,
+                                              text_list, entry_table,
+                                              terms_list),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of times to repeat each benchmark.')
+    parser.add_argument('-c', '--count', type=int, default=1000,
+                        help='Number of verses to highlight.')
+    parser.add_argument('-t', '--terms', default='lov* "the lord"',
+                        help='The search terms to highlight.')
+    results = main(parser.parse_args())
+    print(json.dumps(results, indent=4))
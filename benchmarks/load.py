@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Load testing for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Replay a mix of requests against the app with a number of concurrent
+clients, and report the throughput and the p50, p95, and p99 latency of
+each route as json.
+
+The requests are either read from a log, one url or access log line per
+line, or made up from a mix of searches, lookups with context, chapters,
+paragraphs, Strong's and morphology lookups, and devotionals.  With the
+wsgi backend they call the app in this process, which leaves out the
+server.  The other backends start the app in a server in a new process
+and send the requests over a local socket:
+
+    wsgiref     -   bottle's single threaded wsgiref server.
+    threaded    -   the wsgiref server with a thread per request.
+    tornado     -   server.AsyncTornadoServer in one process.
+    prefork     -   server.AsyncTornadoServer with --processes processes.
+
+The results of each backend can be saved as a baseline, and a later run
+exits with an error if a route's p99 got more than the threshold slower,
+or the throughput dropped by more than the threshold.
+
+"""
+
+from os.path import dirname, join, isfile
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import make_server
+from wsgiref.util import setup_testing_defaults
+from urllib.parse import urlencode
+from collections import Counter, defaultdict
+from threading import Thread
+from time import perf_counter, strftime, sleep
+from math import ceil
+from io import BytesIO
+import http.client
+import subprocess
+import itertools
+import platform
+import argparse
+import random
+import socket
+import json
+import sys
+import re
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from bottle import ServerAdapter, run
+
+
+backend_list = ['wsgi', 'wsgiref', 'threaded', 'tornado', 'prefork']
+
+# How often each kind of request is in the made up mix.
+request_mix = {
+    'search': 40,
+    'lookup': 20,
+    'chapter': 10,
+    'paragraph': 10,
+    'strongs': 15,
+    'devotional': 5,
+}
+
+# Searches people repeat, which mostly hit the result cache.
+common_searches = ['love', 'faith hope charity', '"in the beginning"',
+                   '"the lord is my shepherd"', 'grace AND peace', 'lov*',
+                   '"son of man" God', 'lamb OR lion', '~love neighbour',
+                   'created NOT (and OR but)']
+
+# Words that are put together into searches that are mostly new.
+search_words = ['god', 'lord', 'love', 'faith', 'grace', 'peace', 'mercy',
+                'light', 'heaven', 'earth', 'king', 'david', 'jesus',
+                'spirit', 'truth', 'life', 'blood', 'covenant', 'law',
+                'sin', 'prophet', 'temple', 'jerusalem', 'israel']
+
+# References to look up, most with some context.
+lookup_refs = ['John 3:16', 'Genesis 1', 'Psalms 23', 'Romans 8:28-39',
+               'Matthew 5-7', '1 Corinthians 13', 'Isaiah 53', 'Psalms 119',
+               'Revelation 21:1-4', 'Hebrews 11']
+
+# Verses to get the chapter or paragraph of.
+verse_refs = ['Genesis 1:1', 'Exodus 20:3', 'Psalms 23:4', 'Isaiah 40:31',
+              'John 3:16', 'Acts 2:38', 'Romans 8:28', 'Ephesians 2:8',
+              'Hebrews 11:1', 'Revelation 22:21']
+
+# Strong's numbers and morphology tags to look up.
+strongs_list = ['G25', 'G26', 'G2316', 'G4102', 'G5485', 'H0430', 'H03068',
+                'H07965', 'H0157', 'H02617']
+morph_list = ['robinson:N-NSM', 'robinson:V-AAI-3S', 'robinson:T-NSM',
+              'strongMorph:TH8799']
+
+# Matches the path of the request in an access log line.
+log_regx = re.compile(r'"(?:GET|HEAD) (\S+)[^"]*"')
+
+
+def make_mix(count: int, seed: int=0) -> list:
+    """ Return count made up urls, chosen from the request mix.
+
+    """
+
+    rng = random.Random(seed)
+    kind_list, weight_list = zip(*sorted(request_mix.items()))
+
+    url_list = []
+    for kind in rng.choices(kind_list, weight_list, k=count):
+        if kind == 'search':
+            if rng.random() < 0.5:
+                terms = rng.choice(common_searches)
+            else:
+                terms = ' '.join(rng.sample(search_words,
+                                            rng.randint(1, 3)))
+            query = {'search': terms}
+            if rng.random() < 0.2:
+                query.update(min_range='Matthew', max_range='Revelation')
+            url = '/biblesearch/search.json?%s' % urlencode(query)
+        elif kind == 'lookup':
+            query = {'verse_refs': rng.choice(lookup_refs),
+                     'context': rng.choice((0, 0, 2, 5))}
+            if rng.random() < 0.3:
+                query['terms'] = rng.choice(search_words)
+            url = '/biblesearch/lookup.json?%s' % urlencode(query)
+        elif kind in ('chapter', 'paragraph'):
+            url = '/biblesearch/%s.json?%s' % (
+                kind, urlencode({'start': rng.choice(verse_refs)}))
+        elif kind == 'strongs':
+            if rng.random() < 0.7:
+                query = {'strongs': rng.choice(strongs_list)}
+            else:
+                query = {'morph': rng.choice(morph_list)}
+            url = '/biblesearch/strongs.json?%s' % urlencode(query)
+        else:
+            month, day = rng.randint(1, 12), rng.randint(1, 28)
+            url = '/biblesearch/devotional.json?date=%02d.%02d' % (month, day)
+        url_list.append(url)
+
+    return url_list
+
+
+def read_log(filename: str) -> list:
+    """ Return the urls in the log filename.  Each line can be a url, or an
+    access log line with the request in quotes.
+
+    """
+
+    url_list = []
+    with open(filename, 'r') as log_file:
+        for line in log_file:
+            line = line.strip()
+            match = log_regx.search(line)
+            if match:
+                url_list.append(match.group(1))
+            elif line.startswith('/'):
+                url_list.append(line.split()[0])
+
+    return url_list
+
+
+def route_name(url: str) -> str:
+    """ Return the route of url, without the query or extension.
+
+    """
+
+    path = url.split('?', 1)[0]
+    return re.sub(r'\.json$', '', path)
+
+
+def percentile(sorted_list: list, percent: float) -> float:
+    """ Return the percent percentile of the sorted_list, by nearest rank.
+
+    """
+
+    rank = max(ceil(percent / 100 * len(sorted_list)) - 1, 0)
+    return sorted_list[rank]
+
+
+class WSGIClient(object):
+    """ Sends requests straight to a wsgi app.
+
+    """
+
+    def __init__(self, app: object):
+        """ Set the app.
+
+        """
+
+        self._app = app
+
+    def get(self, url: str) -> int:
+        """ Request url, read the whole body, and return the status code.
+
+        """
+
+        path, _, query = url.partition('?')
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'HTTP_ACCEPT_ENCODING': 'gzip',
+            'wsgi.input': BytesIO(),
+        }
+        setup_testing_defaults(environ)
+
+        status_list = []
+
+        def start_response(status, headers, exc_info=None):
+            """ Save the status.
+
+            """
+
+            status_list.append(status)
+            return lambda data: None
+
+        body = self._app(environ, start_response)
+        try:
+            for chunk in body:
+                # Fail like a strict server would.
+                if type(chunk) is not bytes:
+                    raise TypeError("The body has a %s chunk." %
+                                    type(chunk).__name__)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        return int(status_list[0].split(' ', 1)[0])
+
+    def close(self):
+        """ Nothing to close.
+
+        """
+
+        pass
+
+
+class HTTPClient(object):
+    """ Sends requests to a server over one keep-alive connection.
+
+    """
+
+    def __init__(self, host: str, port: int, timeout: float=60):
+        """ Set the server.
+
+        """
+
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._conn = None
+
+    def get(self, url: str) -> int:
+        """ Request url, read the whole body, and return the status code.
+        A connection the server closed is opened again once.
+
+        """
+
+        for retry in (True, False):
+            if not self._conn:
+                self._conn = http.client.HTTPConnection(self._host,
+                                                        self._port,
+                                                        timeout=self._timeout)
+            try:
+                self._conn.request('GET', url,
+                                   headers={'Accept-Encoding': 'gzip'})
+                response = self._conn.getresponse()
+                response.read()
+                if response.will_close:
+                    self.close()
+                return response.status
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if not retry:
+                    raise
+
+    def close(self):
+        """ Close the connection.
+
+        """
+
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+def run_load(client_func: object, url_list: list, concurrency: int,
+             count: int, duration: float) -> dict:
+    """ Send count requests, or if count is 0, as many as can be sent in
+    duration seconds, from concurrency clients made by client_func, going
+    through url_list in order.  Return the latencies and status codes of
+    each route.
+
+    """
+
+    counter = itertools.count()
+    end_time = perf_counter() + duration if duration and not count else 0
+    thread_results = []
+
+    def client_loop():
+        """ Send requests until there are none left.
+
+        """
+
+        client = client_func()
+        latencies = defaultdict(list)
+        statuses = defaultdict(Counter)
+        thread_results.append((latencies, statuses))
+        try:
+            while True:
+                index = next(counter)
+                if count and index >= count:
+                    break
+                if end_time and perf_counter() >= end_time:
+                    break
+
+                url = url_list[index % len(url_list)]
+                route = route_name(url)
+                start = perf_counter()
+                try:
+                    status = client.get(url)
+                except Exception as err:
+                    print("Error requesting %s: %s" % (url, err),
+                          file=sys.stderr)
+                    status = 'error'
+                latencies[route].append(perf_counter() - start)
+                statuses[route][status] += 1
+        finally:
+            client.close()
+
+    start = perf_counter()
+    thread_list = [Thread(target=client_loop) for _ in range(concurrency)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    for thread_latencies, thread_statuses in thread_results:
+        for route, latency_list in thread_latencies.items():
+            latencies[route].extend(latency_list)
+            statuses[route].update(thread_statuses[route])
+
+    return {'elapsed': elapsed, 'latencies': latencies, 'statuses': statuses}
+
+
+def summarize(latency_list: list, status_counter: Counter,
+              elapsed: float) -> dict:
+    """ Return the throughput, latency percentiles in milliseconds, and the
+    status counts of one route.
+
+    """
+
+    sorted_list = sorted(latency_list)
+    errors = sum(count for status, count in status_counter.items()
+                 if status == 'error' or status >= 500)
+
+    return {
+        'count': len(sorted_list),
+        'errors': errors,
+        'throughput': round(len(sorted_list) / elapsed, 2),
+        'mean': round(sum(sorted_list) / len(sorted_list) * 1000, 3),
+        'p50': round(percentile(sorted_list, 50) * 1000, 3),
+        'p95': round(percentile(sorted_list, 95) * 1000, 3),
+        'p99': round(percentile(sorted_list, 99) * 1000, 3),
+        'max': round(sorted_list[-1] * 1000, 3),
+        'statuses': {str(status): count
+                     for status, count in sorted(status_counter.items(),
+                                                 key=str)},
+    }
+
+
+def report(load: dict) -> dict:
+    """ Return the summary of every route, and of all of them together.
+
+    """
+
+    elapsed = load['elapsed']
+    routes = {route: summarize(latency_list, load['statuses'][route],
+                               elapsed)
+              for route, latency_list in sorted(load['latencies'].items())}
+
+    all_latencies = [latency for latency_list in load['latencies'].values()
+                     for latency in latency_list]
+    all_statuses = sum(load['statuses'].values(), Counter())
+
+    return {'routes': routes,
+            'total': summarize(all_latencies, all_statuses, elapsed)}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """ Return a list of the routes whose p99 is more than threshold slower
+    than in baseline, and the total throughput if it dropped by more than
+    threshold.
+
+    """
+
+    regression_list = []
+    for route, result in sorted(results['routes'].items()):
+        base = baseline['routes'].get(route)
+        if not base or not base['p99']:
+            continue
+
+        ratio = result['p99'] / base['p99']
+        if ratio > 1 + threshold:
+            regression_list.append('%s p99: %.1fms -> %.1fms (%.0f%% slower)'
+                                   % (route, base['p99'], result['p99'],
+                                      (ratio - 1) * 100))
+
+    base = baseline['total']['throughput']
+    throughput = results['total']['throughput']
+    if base and throughput < base * (1 - threshold):
+        regression_list.append('throughput: %.1f/s -> %.1f/s' % (base,
+                                                                 throughput))
+
+    return regression_list
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """ A wsgiref server that handles each request in a new thread.
+
+    """
+
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    """ Doesn't log every request.
+
+    """
+
+    def log_request(self, *args, **kwargs):
+        """ Don't log.
+
+        """
+
+        pass
+
+
+class ThreadedWSGIRefServer(ServerAdapter):
+    """ Run the app with the threaded wsgiref server.
+
+    """
+
+    def run(self, handler: object):
+        """ Serve the app until interrupted.
+
+        """
+
+        server = make_server(self.host, self.port, handler,
+                             server_class=ThreadingWSGIServer,
+                             handler_class=QuietHandler)
+        server.serve_forever()
+
+
+def serve(backend: str, port: int, workers: int, processes: int):
+    """ Serve the app with backend on port on the loopback address.
+
+    """
+
+    import biblesearch_app
+    from server import AsyncTornadoServer
+
+    warm_up_thread = biblesearch_app.start_warm_up()
+
+    options = {'host': '127.0.0.1', 'port': port, 'quiet': True}
+    if backend == 'wsgiref':
+        options['server'] = 'wsgiref'
+    elif backend == 'threaded':
+        options['server'] = ThreadedWSGIRefServer
+    else:
+        # Open the index before forking, so the processes share it.
+        warm_up_thread.join()
+        options.update(server=AsyncTornadoServer, workers=workers,
+                       processes=processes if backend == 'prefork' else 1,
+                       after_fork=biblesearch_app.reopen_index)
+
+    run(biblesearch_app.application, **options)
+
+
+def free_port() -> int:
+    """ Return a port no one is listening on.
+
+    """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args: object, port: int) -> subprocess.Popen:
+    """ Start the server in a new process, and wait until it is ready,
+    with the index open and the caches warm.
+
+    """
+
+    server = subprocess.Popen([sys.executable, __file__, '--serve',
+                               args.backend, '--port', str(port),
+                               '--workers', str(args.workers),
+                               '--processes', str(args.processes)])
+
+    client = HTTPClient('127.0.0.1', port, timeout=5)
+    deadline = perf_counter() + args.startup_timeout
+    while perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The %s server exited with status %s." %
+                               (args.backend, server.returncode))
+        try:
+            if client.get('/readyz') == 200:
+                return server
+        except OSError:
+            pass
+        finally:
+            client.close()
+        sleep(0.1)
+
+    stop_server(server)
+    raise RuntimeError("The %s server didn't start in %ss." %
+                       (args.backend, args.startup_timeout))
+
+
+def stop_server(server: subprocess.Popen):
+    """ Stop the server and wait for it to exit.
+
+    """
+
+    server.terminate()
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def main(args: object) -> dict:
+    """ Run the load test and return a dictionary of the results.
+
+    """
+
+    if args.log:
+        url_list = read_log(args.log)
+    else:
+        url_list = make_mix(args.mix_size, args.seed)
+
+    if not url_list:
+        raise ValueError("There are no requests to send.")
+
+    server = None
+    if args.backend == 'wsgi':
+        import biblesearch_app
+        client_func = lambda: WSGIClient(biblesearch_app.application)
+    elif args.url:
+        host, _, port = args.url.split('//')[-1].rstrip('/').partition(':')
+        client_func = lambda: HTTPClient(host, int(port or 80))
+    else:
+        port = free_port()
+        server = start_server(args, port)
+        client_func = lambda: HTTPClient('127.0.0.1', port)
+
+    try:
+        if args.warmup:
+            print("Warming up with %s requests..." % args.warmup,
+                  file=sys.stderr)
+            run_load(client_func, url_list, args.concurrency, args.warmup, 0)
+
+        print("Sending %s requests from %s clients..." % (
+            args.requests or '%ss of' % args.duration, args.concurrency),
+            file=sys.stderr)
+        load = run_load(client_func, url_list, args.concurrency,
+                        args.requests, args.duration)
+    finally:
+        if server:
+            stop_server(server)
+
+    output = {
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'backend': args.url or args.backend,
+        'concurrency': args.concurrency,
+        'elapsed': round(load['elapsed'], 3),
+        'source': args.log or 'mix of %s, seed %s' % (args.mix_size,
+                                                     args.seed),
+    }
+    output.update(report(load))
+
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-B', '--backend', choices=backend_list,
+                        default='wsgi', help='How to serve the app.')
+    parser.add_argument('-u', '--url', default='',
+                        help='Send the requests to an already running '
+                             'server at this http://host:port instead.')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='Number of clients sending requests at once.')
+    parser.add_argument('-n', '--requests', type=int, default=0,
+                        help='Number of requests to send.')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='Seconds to send requests for, when the '
+                             'number of requests is not given.')
+    parser.add_argument('-w', '--warmup', type=int, default=100,
+                        help='Number of requests to send before timing.')
+    parser.add_argument('-l', '--log', default='',
+                        help='Replay the urls in this log instead of the '
+                             'made up mix.')
+    parser.add_argument('-m', '--mix-size', type=int, default=1000,
+                        help='Number of different requests in the made up '
+                             'mix.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the made up mix.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of threads in the tornado servers.')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Number of prefork processes, 0 for one per '
+                             'cpu.')
+    parser.add_argument('--startup-timeout', type=float, default=120,
+                        help='Seconds to wait for the server to start.')
+    parser.add_argument('-b', '--baseline',
+                        default=join(dirname(__file__), 'load_baseline.json'),
+                        help='The results of each backend to compare with.')
+    parser.add_argument('-s', '--save', action='store_true',
+                        help='Save the results as the baseline of the '
+                             'backend.')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='How much slower a p99 can get, or how much '
+                             'the throughput can drop, before it is a '
+                             'regression.')
+    parser.add_argument('--serve', choices=backend_list[1:],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.workers, args.processes)
+        sys.exit(0)
+
+    output = main(args)
+
+    baseline = {}
+    if isfile(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regression_list = []
+    if output['backend'] in baseline and not args.save:
+        regression_list = compare(output, baseline[output['backend']],
+                                  args.threshold)
+
+    print(json.dumps(output, indent=4, sort_keys=True))
+
+    if args.save:
+        baseline[output['backend']] = output
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+        print("Saved the %s baseline to %s." % (output['backend'],
+                                                args.baseline),
+              file=sys.stderr)
+
+    for regression in regression_list:
+        print("Regression in %s" % regression, file=sys.stderr)
+
+    sys.exit(1 if regression_list else 0)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# The regular expression OSIS renderer render_osis replaced.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The regular expression OSIS renderer the app used before render_osis.
+It substitutes tag_regx with tag_func, running the substitution again on
+the text of every nested tag.  The benchmarks check that render_osis still
+produces the same html, and compare their times.
+
+"""
+
+import re
+
+
+# Seperates tags and there attributes and text into groups.
+tag_regx = re.compile(r'''
+            <(?P<tag>
+            [Ss]eg|[Nn]ote|[Ww]|[Mm]ilestone|[Ff]oreign|
+            [Tt]itle|trans[cC]hange|divine[nN]ame|
+            scrip[Rr]ef|[Qq])
+            (?P<attr>[^>]*)(?:(?P<end>/>)|>
+            (?P<text>[\w\W]*?)
+            </(?P=tag)>)
+            ''', re.X)
+
+# Seperates tag attributes into the attribute name and its value.
+attr_regx = re.compile(r'''\s*(?P<name>[^=]+)="(?P<value>[^"]+)\s*"''')
+
+# Split a reference into book, chapter, and verse groups.
+ref_regx = re.compile(r'''
+    (?P<book>\d?[^\d-]+)
+    \s*
+    (?P<chap>[\d,-]*)
+    :
+    (?P<verse>[\d,-]*)
+    ''', re.X)
+
+
+def tag_func(match):
+    """ Modify the verse text to italicize, uppercase and extract headings.
+
+    """
+
+    # Get a dictionary of the matched text each key is one of the labels
+    # in the regex.
+    match_dict = match.groupdict()
+
+    # Set the text to '' empty string if it is None.
+    if not match_dict['text']:
+        match_dict['text'] = ''
+
+    # Get the most used values out of the dictionary.
+    tag = match_dict.get('tag', '').lower()
+    attr = match_dict.get('attr', '')
+    text = match_dict.get('text', '')
+
+    # Use another regex to get a dictionary of all the name=value pairs
+    # in the attributes of this tag.
+    attr_dict = dict(attr_regx.findall(attr.lower()))
+
+    # Depending on the tag return an appropriate replacement.
+    if 'transchange' in tag:
+        if attr_dict.get('type', '') == 'added':
+            return '<span class="added-text">%s</span>' % text
+    if 'divinename' in tag:
+        return '<span class="divine-name">%s</span>' % text
+    if 'title' in tag:
+        text = tag_regx.sub(tag_func, text)
+        return '<span class="title-text">%s</span> ' % text
+    if 'foreign' in tag:
+        if 'n' in attr_dict:
+            match_dict.update(attr_dict)
+            foreign_str = '<span class="foreign-text">{n}</span> {text}'
+            return foreign_str.format(**match_dict)
+    if 'milestone' in tag:
+        if 'marker' in attr_dict:
+            match_dict.update(attr_dict)
+            marker = '<span class="paragraph-marker">{marker}</span> {text}'
+            return marker.format(**match_dict)
+    if 'w' == tag:
+        word_span = '<span class="word" '
+        lemma_str = 'data-lemma="{lemma}" '
+        morph_str = 'data-morph="{morph}"'
+        close_span = '>{text}</span>'
+
+        attr_dict = dict(attr_regx.findall(attr))
+        if 'lemma' in attr_dict:
+            word_span += lemma_str
+        if 'morph' in attr_dict:
+            word_span += morph_str
+        word_span += close_span
+        match_dict.update(attr_dict)
+        match_dict['text'] = tag_regx.sub(tag_func, match_dict['text'])
+        return word_span.format(**match_dict)
+    if 'seg' == tag:
+        seg_span = '<span class="seg">%s</span>'
+        return seg_span % tag_regx.sub(tag_func, match_dict['text'])
+    if 'note' == tag:
+        note_span = '<span class="note">{text}</span>'
+        return note_span.format(**match_dict)
+    if 'scripref' == tag:
+        passage_href = 'href="/biblesearch/lookup?verse_refs=%s">%s</a>'
+        passage_a = '<a class="verseref verselist" ' + passage_href
+        passage_str = attr_dict.get('passage', '')
+        ref_list = []
+        last_book = ''
+        for book, chapter, verse in ref_regx.findall(passage_str.strip()):
+            book = book.strip()
+            if not book:
+                book = last_book
+            last_book = book
+            # Attempt to fix the book name to destinguish between Judges
+            # and Jude.
+            if book.lower() == 'jud':
+                book = 'Judg'
+                text = text.replace('Jud ', 'Judg ')
+            ref_list.append('%s+%s:%s' % (book, chapter, verse))
+        refs = ';'.join(ref_list)
+
+        return passage_a % (refs, text)
+    if 'q' == tag:
+        q_span = '<span class="red-quote">%s</span>'
+        match_dict['text'] = tag_regx.sub(tag_func, match_dict['text'])
+        return q_span % match_dict['text']
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# OSIS rendering benchmark.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Render the raw text of the whole canon with tag_regx/tag_func and with
+render_osis, check that both produce the same html, and time them.
+
+"""
+
+from os.path import dirname, join
+from time import perf_counter
+import argparse
+import json
+import sys
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+import sword_search
+from osis_regex import tag_regx, tag_func
+from render import render_osis
+
+
+def load_canon() -> list:
+    """ Return a list of the raw text of every verse in the Bible.
+
+    """
+
+    verse_iter = sword_search.VerseIter('Genesis 1:1')
+    return [text for _, text in sword_search.VerseTextIter(verse_iter,
+                                                           strongs=True,
+                                                           morph=True,
+                                                           render='raw')]
+
+
+def best_time(func, text_list: list, repeat: int) -> float:
+    """ Return the best time in seconds of rendering every text in text_list
+    with func.
+
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for text in text_list:
+            func(text)
+        times.append(perf_counter() - start)
+
+    return min(times)
+
+
+def main(args: object) -> dict:
+    """ Run the benchmark and return a dictionary of the results.
+
+    """
+
+    text_list = load_canon()
+    regex_render = lambda text: tag_regx.sub(tag_func, text)
+
+    mismatch_list = [i for i, text in enumerate(text_list)
+                     if regex_render(text) != render_osis(text)]
+
+    results = {
+        'verses': len(text_list),
+        'mismatches': len(mismatch_list),
+        'tag_func': best_time(regex_render, text_list, args.repeat),
+        'render_osis': best_time(render_osis, text_list, args.repeat),
+    }
+    results['speedup'] = results['tag_func'] / results['render_osis']
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of times to repeat each benchmark.')
+    results = main(parser.parse_args())
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Startup benchmark for the sword_search reference tables.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare loading the gzipped json reference list with mapping the binary
+reference table, and time a cold import of sword_search in a fresh process.
+Also time importing the web app, and its first lookup and first search, in
+a fresh process.  The app is started the way the servers start it, with
+the index opened in the background, so only the search has to wait for it.
+
+"""
+
+from os.path import join as os_join
+from os.path import dirname
+from timeit import repeat
+import subprocess
+import argparse
+import gzip
+import json
+import sys
+
+
+def load_json(data_path: str) -> list:
+    """ Load the reference list the old way.
+
+    """
+
+    with gzip.open(os_join(data_path, 'ref_list.json.gz'), 'rb') as reflist:
+        return json.loads(reflist.read().decode())
+
+
+def load_table(data_path: str) -> object:
+    """ Map the binary reference table and read one reference.
+
+    """
+
+    import sword_search
+
+    table = sword_search.RefTable(os_join(data_path, 'ref_list.bin'))
+    table[26136]
+    return table
+
+
+# Where the web app is, to import it.
+project_root = os_join(dirname(__file__), '..')
+
+# Sends a request straight to the app.
+request_code = ("import biblesearch_app; "
+                "biblesearch_app.start_warm_up(); "
+                "from wsgiref.util import setup_testing_defaults; "
+                "e = {'PATH_INFO': '%s', 'QUERY_STRING': '%s'}; "
+                "setup_testing_defaults(e); "
+                "b''.join(biblesearch_app.application(e, lambda *a: None))")
+
+
+def cold_start(code: str, runs: int, cwd: str=None) -> float:
+    """ Return the best time in seconds of running code in a new interpreter
+    in cwd.
+
+    """
+
+    timer = ('from time import perf_counter as t; s = t(); %s; '
+             'print(t() - s)' % code)
+    # The time is the last line, after anything code printed.
+    return min(float(subprocess.check_output([sys.executable, '-c', timer],
+                                             cwd=cwd).split()[-1])
+               for _ in range(runs))
+
+
+def main(args: object) -> dict:
+    """ Run the benchmarks and return a dictionary of the best times in
+    seconds.
+
+    """
+
+    import sword_search
+
+    data_path = sword_search.verses.data_path
+
+    results = {
+        'json_load': min(repeat(lambda: load_json(data_path), number=1,
+                                repeat=args.repeat)),
+        'table_load': min(repeat(lambda: load_table(data_path), number=1,
+                                 repeat=args.repeat)),
+        'cold_first_verse': cold_start("import sword_search; "
+                                       "str(sword_search.Verse('John 3:16'))",
+                                       args.repeat),
+        'cold_app_import': cold_start("import biblesearch_app", args.repeat,
+                                      project_root),
+        'cold_first_lookup': cold_start(request_code % (
+            '/biblesearch/lookup.json', 'verse_refs=John+3:16'), args.repeat,
+            project_root),
+        'cold_first_search': cold_start(request_code % (
+            '/biblesearch/search.json', 'search=love'), args.repeat,
+            project_root),
+    }
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of times to repeat each benchmark.')
+    results = main(parser.parse_args())
+    print(json.dumps(results, indent=4))
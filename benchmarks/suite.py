@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Benchmark suite for searching, rendering, and the reference functions.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Time every search method on a fixed set of queries, the verse lookup
+and rendering, the reference functions, and opening the index.  The results
+are printed as json, and compared with a baseline saved by an earlier run,
+to find any benchmark that got slower or started returning a different
+number of verses.
+
+Every benchmark is run once before it is timed, so the index items it uses
+are loaded and the times are of a warm index, like a server that has been
+running a while.  index_open_cold is the time to open the index and do
+the first lookup in a new process.
+
+"""
+
+from os.path import dirname, join, isfile
+from statistics import median
+from time import perf_counter, strftime
+import platform
+import argparse
+import json
+import sys
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from startup import cold_start
+import osis_regex
+
+
+# The queries for each search method.  Don't change them without saving a
+# new baseline, or the comparison means nothing.
+search_queries = {
+    'multiword': ['love', 'faith hope charity', 'god created heaven earth',
+                  'the'],
+    'anyword': ['grace mercy', 'lamb lion', 'sabbath passover feast'],
+    'eitheror': ['grace mercy', 'lamb lion'],
+    'phrase': ['in the beginning', 'the lord is my shepherd',
+               'son of man'],
+    'mixed_phrase': ['in the beginning', 'son of man', 'of the'],
+    'ordered_multiword': ['love neighbour', 'god so loved world'],
+    'partial_word': ['lov*', 'sancti*', '*eth'],
+    'regex': [r'\bgrace\b.*\bpeace\b', r'\b[Jj]erusalem\b'],
+    # These are split the way the app splits them, without the quotes.
+    'mixed': [['in the beginning', 'God', '!earth'],
+              ['love', '+faith', '|hope'], ['~love neighbour', 'lov*']],
+    'combined': ['created NOT (and OR but)', 'grace AND peace',
+                 'lamb OR lion'],
+}
+
+# The ranges that limit some of the searches.
+search_range = 'Matthew-Revelation'
+
+# The references for the lookup and reference benchmarks.
+verse_ranges = ['Genesis 1:1-Genesis 50:26', 'John 3:16', 'Psalms 119',
+                'Romans 1:1-16:27,1 Corinthians 13', 'Matthew-John']
+paragraph_refs = ['Genesis 1:1', 'Psalms 23:4', 'John 3:16', 'Romans 8:28',
+                  'Revelation 22:21']
+
+
+def time_func(func: object, repeat: int) -> dict:
+    """ Run func once to warm up, then repeat times, and return the best
+    and median times in seconds, and the size of what func returned.
+
+    """
+
+    count = len(func())
+
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    return {'best': min(times), 'median': median(times), 'count': count}
+
+
+def search_benchmarks(bible_search: object) -> dict:
+    """ Return a dictionary of functions that run the queries of each search
+    method, returning the verses they found.
+
+    """
+
+    def make_func(method: str, query_list: list, range_str: str) -> object:
+        """ Return a function that runs every query in query_list with
+        method.
+
+        """
+
+        search_func = getattr(bible_search, '%s_search' % method)
+
+        def func():
+            """ Return the verses found by every query.
+
+            """
+
+            found_list = []
+            for query in query_list:
+                found_list.extend(search_func(query, range_str=range_str))
+            return found_list
+
+        return func
+
+    func_dict = {}
+    for method, query_list in search_queries.items():
+        func_dict['search.%s' % method] = make_func(method, query_list, '')
+        func_dict['search.%s.range' % method] = make_func(method, query_list,
+                                                          search_range)
+
+    return func_dict
+
+
+def reference_benchmarks() -> dict:
+    """ Return a dictionary of functions that time the reference parsing,
+    context, sorting, paragraph, lookup, and rendering functions.
+
+    """
+
+    import sword_search
+    import biblesearch_app
+
+    parsed_list = [sword_search.parse_verse_range(i) for i in verse_ranges]
+    all_refs = sword_search.parse_verse_range('Genesis-Revelation')
+    raw_list = [sword_search.Lookup('KJV').get_raw_text(ref)
+                for ref in sorted(sword_search.parse_verse_range(
+                    'Genesis 1-3,Psalms 119,John 1-3'),
+                    key=sword_search.sort_key)]
+
+    def parse_verse_range():
+        """ Parse every range.
+
+        """
+
+        return [ref for i in verse_ranges
+                for ref in sword_search.parse_verse_range(i)]
+
+    def add_context():
+        """ Add two verses and the chapter around every range.
+
+        """
+
+        return [ref for ref_set in parsed_list
+                for chapter in (False, True)
+                for ref in sword_search.add_context(ref_set, 2, chapter)]
+
+    def sort_key():
+        """ Sort every verse in the Bible.
+
+        """
+
+        return sorted(all_refs, key=sword_search.sort_key)
+
+    def get_paragraph():
+        """ Find the paragraph of every reference.
+
+        """
+
+        return [biblesearch_app.get_paragraph(ref) for ref in paragraph_refs]
+
+    def lookup_verses():
+        """ Look up and highlight every range with context.
+
+        """
+
+        # Empty the cache so the highlighted verses are rendered each time.
+        biblesearch_app.fragment_cache.clear()
+        return [verse for i in verse_ranges
+                for verse in biblesearch_app.lookup_verses(i, 'god love', 1)]
+
+    def tag_func():
+        """ Render the text with tag_regx and tag_func.
+
+        """
+
+        return [osis_regex.tag_regx.sub(osis_regex.tag_func, text)
+                for text in raw_list]
+
+    def render_osis():
+        """ Render the text with render_osis.
+
+        """
+
+        return [biblesearch_app.render_osis(text) for text in raw_list]
+
+    return {
+        'parse_verse_range': parse_verse_range,
+        'add_context': add_context,
+        'sort_key': sort_key,
+        'get_paragraph': get_paragraph,
+        'lookup_verses': lookup_verses,
+        'render.tag_func': tag_func,
+        'render.render_osis': render_osis,
+    }
+
+
+def index_benchmarks(repeat: int) -> dict:
+    """ Time opening the index and looking up a word, in a new process and
+    in this one.
+
+    """
+
+    import sword_search
+
+    def open_index():
+        """ Open the index and look up a word.
+
+        """
+
+        index_dict = sword_search.IndexDict('KJV')
+        return index_dict.value_intersect(['love'], False)
+
+    code = ("import sword_search; "
+            "sword_search.IndexDict('KJV').value_intersect(['love'], False)")
+
+    return {
+        'index_open_cold': {'best': cold_start(code, repeat), 'count': 0},
+        'index_open_warm': time_func(open_index, repeat),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """ Return a list of the benchmarks in results that are more than
+    threshold slower than in baseline, or returned a different count.
+
+    """
+
+    regression_list = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        ratio = result['best'] / base['best'] if base['best'] else 1.0
+        result['baseline'] = base['best']
+        result['ratio'] = ratio
+
+        if ratio > 1 + threshold:
+            regression_list.append('%s: %.3fs -> %.3fs (%.0f%% slower)' % (
+                name, base['best'], result['best'], (ratio - 1) * 100))
+        if result.get('count') != base.get('count'):
+            regression_list.append('%s: returned %s instead of %s' % (
+                name, result.get('count'), base.get('count')))
+
+    return regression_list
+
+
+def main(args: object) -> dict:
+    """ Run the benchmarks that match args.filter and return a dictionary
+    of the results.
+
+    """
+
+    import sword_search
+
+    func_dict = search_benchmarks(sword_search.Search(multiword=True))
+    func_dict.update(reference_benchmarks())
+
+    results = {}
+    for name, func in sorted(func_dict.items()):
+        if args.filter and args.filter not in name:
+            continue
+        print("Running %s..." % name, file=sys.stderr)
+        results[name] = time_func(func, args.repeat)
+
+    if not args.filter or 'index' in args.filter:
+        print("Running index_open...", file=sys.stderr)
+        results.update(index_benchmarks(args.repeat))
+
+    return {
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of times to repeat each benchmark.')
+    parser.add_argument('-f', '--filter', default='',
+                        help='Only run the benchmarks with this in their '
+                             'name.')
+    parser.add_argument('-b', '--baseline',
+                        default=join(dirname(__file__), 'baseline.json'),
+                        help='The results to compare with.')
+    parser.add_argument('-s', '--save', action='store_true',
+                        help='Save the results as the new baseline.')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='How much slower a benchmark can get before '
+                             'it is a regression.')
+    args = parser.parse_args()
+
+    output = main(args)
+
+    regression_list = []
+    if isfile(args.baseline) and not args.save:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regression_list = compare(output['results'], baseline, args.threshold)
+
+    print(json.dumps(output, indent=4, sort_keys=True))
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(output, baseline_file, indent=4, sort_keys=True)
+        print("Saved the baseline to %s." % args.baseline, file=sys.stderr)
+
+    for regression in regression_list:
+        print("Regression in %s" % regression, file=sys.stderr)
+
+    sys.exit(1 if regression_list else 0)
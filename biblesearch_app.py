@@ -18,42 +18,44 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from time import strftime, perf_counter
+
+# When the app started importing, to time the startup.
+import_start = perf_counter()
+
 from os.path import join, dirname
-from bottle import run, debug, jinja2_template as template
-from bottle import request, response, redirect, static_file, Bottle
+from threading import Thread, Event
+from urllib.parse import urlencode
+from wsgiref.util import setup_testing_defaults
+from io import BytesIO
+from bottle import run, debug
+from bottle import request, response, redirect, Bottle
 from string import printable as string_printable
 from html import escape as html_escape
-from time import strftime
 import json
+import sys
+import os
 import re
 
 import sword_search
-from sword_search import build_highlight_regx, highlight_search_terms
+from render import render_osis, build_highlight, highlight_osis
+from render import FragmentCache, TokenTable
+from stream import template_stream, json_str_stream, json_list_stream
+from stream import ndjson_stream, wants_ndjson
+from templates import template, dropdown_html, PageShell
+from httpcache import Conditional
+from static import AssetStore
+from compress import Compress
+from results import ResultCache, result_id
+from metrics import Metrics, RequestMetrics, stage, debug_timing
+from profiler import Profiler
+import templates
+import render
 import errors
 
 
 # Global variables
 
-# Seperates tags and there attributes and text into groups.
-tag_regx = re.compile(r'''
-            <(?P<tag>
-            [Ss]eg|[Nn]ote|[Ww]|[Mm]ilestone|[Ff]oreign|
-            [Tt]itle|trans[cC]hange|divine[nN]ame|
-            scrip[Rr]ef|[Qq])
-            (?P<attr>[^>]*)(?:(?P<end>/>)|>
-            (?P<text>[\w\W]*?)
-            </(?P=tag)>)
-            ''', re.X)
-
-# Seperates tag attributes into the attribute name and its value.
-attr_regx = re.compile(r'''\s*(?P<name>[^=]+)="(?P<value>[^"]+)\s*"''')
-
-title_regx = re.compile(r'''
-            <(?P<tag>[Tt]itle)(?P<attr>[^>]*)>
-            (?P<text>[\w\W]*?)
-            </(?P=tag)>
-            ''', re.X)
-
 # Extracts the language from a StrongsReal uri.
 strongs_regx = re.compile(r'''
         sword://StrongsReal(H|G)(ebrew|reek)/(\d+?)
@@ -62,21 +64,16 @@ strongs_regx = re.compile(r'''
 # Extracts the languages from a strongs number.
 strongs_lang_regx = re.compile(r'((H|G)\d+)', re.I)
 
-# Regex for formatting morphology definitions.
-morph_regx = re.compile(r'''
+# Regex for formatting morphology definitions.  It is slow to compile, so
+# it is compiled, and cached by re, when a morphology tag is looked up.
+morph_pattern = r'''
         (?:<(?P<italic>hi)      # The opening highlight
         [^>]+?>                 # Tag attributes
         ([^<]+)                 # Tag text
         </(?P=italic)>          # Tag end
         ([^><]+)                # Break after text
         <(?P<break>lb)/>)       # Break tag
-        ''', re.I | re.X)
-
-added_regx = re.compile(r'''
-        <transChange\s+type="added">
-        ([^<]+)
-        </transChange>
-        ''', re.I | re.X)
+        '''
 
 # Splits a search query into quoted groups and non-quoted words.
 search_regx = re.compile(r'''(?:"(?P<quoted>[^"]+)"|(?P<unquoted>[^\s"]+))''')
@@ -84,172 +81,219 @@ search_regx = re.compile(r'''(?:"(?P<quoted>[^"]+)"|(?P<unquoted>[^\s"]+))''')
 # Find paragraph markers.
 paragraph_regx = re.compile(r'''marker="[^"]+"''')
 
-# Split a reference into book, chapter, and verse groups.
-# ref_regx = re.compile(r'''(?P<book>\d*\D+)(?P<chap>\d*):?(?P<verse>\d*)''')
-ref_regx = re.compile(r'''
-    (?P<book>\d?[^\d-]+)
-    \s*
-    (?P<chap>[\d,-]*)
-    :
-    (?P<verse>[\d,-]*)
-    ''', re.X)
-
 # The main bottle app.
 bible_app = Bottle()
 bible_app.error_handler = errors.handler
 
 project_root = dirname(__file__)
 
+# The request, stage, and cache metrics served at /metrics.
+app_metrics = Metrics()
+sword_search.set_stage_hook(app_metrics.observe_stage)
+
+# Add the stage times to the json when the query has debug=timing.
+bible_app.install(debug_timing(app_metrics))
+
+# Profile live requests when the BIBLESEARCH_PROFILE_* variables are set.
+bible_app.install(Profiler())
+
+# The index is opened by warm_up, or by the first search if it comes first.
 bible_search = sword_search.Search(multiword=True)
 
+# The pre-rendered html of every verse, and the plain entries highlight_osis
+# searches.  Run render.py to build them.
+verse_html = sword_search.open_html_table()
+verse_plain = sword_search.open_html_table(kind='plain')
+
+# The rendered html of highlighted verses, shared by all the routes.
+fragment_cache = FragmentCache()
+
+# The results of recent searches by result id.
+result_cache = ResultCache()
+
+# The search page with everything but the fields already rendered.
+search_page = PageShell('biblesearch', ['verse_list', 'verses', 'strongs_morph',
+                                        'dropdowns', 'search_terms'])
+
+# ETags for the responses that only change when the index or the templates
+# are rebuilt.
+conditional = Conditional(sword_search.INDEX_PATH, join(project_root, 'views'))
+
+# Every asset and its compressed copies, so they are served from memory.
+asset_store = AssetStore()
+
+app_metrics.add_cache('fragments', fragment_cache.stats)
+app_metrics.add_cache('results', result_cache.stats)
+app_metrics.add_cache('highlight_regex', render._highlight_regex.cache_info)
+app_metrics.add_cache('plain_text', render._plain_text.cache_info)
+app_metrics.add_cache('dropdowns', templates._cached_dropdown.cache_info)
+for name in sword_search.regex_cache_info():
+    app_metrics.add_cache(name, lambda name=name:
+                          sword_search.regex_cache_info()[name])
+
+
+# The searches and chapters people ask for most, which warm_up sends
+# through the app so their first requests hit the caches.  The
+# BIBLESEARCH_WARM_UP_FILE variable can name a json file with other
+# "queries" and "chapters" lists, and BIBLESEARCH_WARM_UP_TOP is how many
+# of each to send.
+warm_up_queries = ['love', 'faith', 'grace', 'peace', '"in the beginning"',
+                   '"the lord is my shepherd"', 'God so loved the world',
+                   'faith hope charity', 'jesus wept', 'holy spirit']
+warm_up_chapters = ['John 3', 'Psalms 23', 'Genesis 1', 'Romans 8',
+                    '1 Corinthians 13', 'Matthew 5', 'Psalms 91',
+                    'Isaiah 53', 'John 1', 'Romans 12']
+
+# Set when the index is open and the caches are warm.
+app_ready = Event()
+
+# The error that stopped the warm up, if any.
+warm_up_error = ''
+
+# The thread start_warm_up runs warm_up in.
+warm_up_thread = None
+
+
+def warm_up_paths() -> list:
+    """ Return the paths of the requests to warm up the caches with.
+
+    """
+
+    queries, chapters = warm_up_queries, warm_up_chapters
+
+    filename = os.getenv('BIBLESEARCH_WARM_UP_FILE', '')
+    if filename:
+        try:
+            with open(filename, 'r') as warm_up_file:
+                warm_up_dict = json.load(warm_up_file)
+            queries = warm_up_dict.get('queries', queries)
+            chapters = warm_up_dict.get('chapters', chapters)
+        except (OSError, ValueError) as err:
+            print("Error reading %s: %s" % (filename, err), file=sys.stderr)
+
+    top = int(os.getenv('BIBLESEARCH_WARM_UP_TOP', '10') or 0)
+
+    path_list = ['/biblesearch/books.json']
+    path_list.extend('/biblesearch/search.json?%s' % urlencode({'search': i})
+                     for i in queries[:top])
+    path_list.extend('/biblesearch/lookup.json?%s' % urlencode(
+                     {'verse_refs': i}) for i in chapters[:top])
+
+    return path_list
+
+
+def warm_request(path: str):
+    """ Send a request for path through the compressed app, leaving out
+    the request metrics.
+
+    """
+
+    path_info, _, query = path.partition('?')
+    environ = {
+        'PATH_INFO': path_info,
+        'QUERY_STRING': query,
+        'HTTP_ACCEPT_ENCODING': 'gzip',
+        'wsgi.input': BytesIO(),
+    }
+    setup_testing_defaults(environ)
+
+    status_list = []
 
-def tag_func(match):
-    """ Modify the verse text to italicize, uppercase and extract headings.
-
-    """
-
-    # Get a dictionary of the matched text each key is one of the labels
-    # in the regex.
-    match_dict = match.groupdict()
-
-    # Set the text to '' empty string if it is None.
-    if not match_dict['text']:
-        match_dict['text'] = ''
-
-    # Get the most used values out of the dictionary.
-    tag = match_dict.get('tag', '').lower()
-    attr = match_dict.get('attr', '')
-    text = match_dict.get('text', '')
-
-    # Use another regex to get a dictionary of all the name=value pairs
-    # in the attributes of this tag.
-    attr_dict = dict(attr_regx.findall(attr.lower()))
-
-    # Depending on the tag return an appropriate replacement.
-    if 'transchange' in tag:
-        if attr_dict.get('type', '') == 'added':
-            return '<span class="added-text">%s</span>' % text
-    if 'divinename' in tag:
-        return '<span class="divine-name">%s</span>' % text
-    if 'title' in tag:
-        text = tag_regx.sub(tag_func, text)
-        return '<span class="title-text">%s</span> ' % text
-    if 'foreign' in tag:
-        if 'n' in attr_dict:
-            match_dict.update(attr_dict)
-            foreign_str = '<span class="foreign-text">{n}</span> {text}'
-            return foreign_str.format(**match_dict)
-    if 'milestone' in tag:
-        if 'marker' in attr_dict:
-            match_dict.update(attr_dict)
-            marker = '<span class="paragraph-marker">{marker}</span> {text}'
-            return marker.format(**match_dict)
-    if 'w' == tag:
-        word_span = '<span class="word" '
-        lemma_str = 'data-lemma="{lemma}" '
-        morph_str = 'data-morph="{morph}"'
-        close_span = '>{text}</span>'
-
-        attr_dict = dict(attr_regx.findall(attr))
-        if 'lemma' in attr_dict:
-            word_span += lemma_str
-        if 'morph' in attr_dict:
-            word_span += morph_str
-        word_span += close_span
-        match_dict.update(attr_dict)
-        match_dict['text'] = tag_regx.sub(tag_func, match_dict['text'])
-        return word_span.format(**match_dict)
-    if 'seg' == tag:
-        seg_span = '<span class="seg">%s</span>'
-        return seg_span % tag_regx.sub(tag_func, match_dict['text'])
-    if 'note' == tag:
-        note_span = '<span class="note">{text}</span>'
-        return note_span.format(**match_dict)
-    if 'scripref' == tag:
-        passage_href = 'href="/biblesearch/lookup?verse_refs=%s">%s</a>'
-        passage_a = '<a class="verseref verselist" ' + passage_href
-        passage_str = attr_dict.get('passage', '')
-        ref_list = []
-        last_book = ''
-        for book, chapter, verse in ref_regx.findall(passage_str.strip()):
-            book = book.strip()
-            if not book:
-                book = last_book
-            last_book = book
-            # Attempt to fix the book name to destinguish between Judges
-            # and Jude.
-            if book.lower() == 'jud':
-                book = 'Judg'
-                text = text.replace('Jud ', 'Judg ')
-            ref_list.append('%s+%s:%s' % (book, chapter, verse))
-        refs = ';'.join(ref_list)
-
-        return passage_a % (refs, text)
-    if 'q' == tag:
-        q_span = '<span class="red-quote">%s</span>'
-        match_dict['text'] = tag_regx.sub(tag_func, match_dict['text'])
-        return q_span % match_dict['text']
-
-
-def old_highlight_search_terms(verse_text, regx_list, highlight_text,
-                           color_tag='\033\[[\d+;]*m', *args):
-    """ Highlight search terms in the verse text.
-
-    """
-
-    def highlight_group(match):
-        """ Highlight each word/Strong's Number/Morphological Tag in the
-        match.
+    def start_response(status, headers, exc_info=None):
+        """ Save the status.
 
         """
 
-        match_text = match.group()
-        for word in set(match.groups()):
-            # print(f"{word=}, {match_text=}")
-            # if word != match_text:
-            #     print(f"{word=}, {match_text=}")
-            if word:
-                # if word.lower() == 'strong' and word == match_text:
-                #     continue
-                try:
-                    match_text = re.sub('''
-                            (
-                            (?:{0}|\\b)+
-                            {1}(?!sMarkup|Morph|:(TH|H|G)[0-9]+)
-                            (?:{0}|\\b)+
-                            )
-                            '''.format(color_tag, re.escape(word)),
-                            highlight_text, match_text, flags=re.X)
-                except Exception as err:
-                    print("Error with highlighting word %s: %s" % (word, err))
-            #match_text = match_text.replace(word, '\033[7m%s\033[m' % word)
-        # print(f"returning: {match_text}")
-        return match_text
-
-        # Strip any previous colors.
-        # match_text = strip_color_regx.sub('', match.group())
-        # return word_regx.sub(highlight_text, match_text)
-
-    verse_text = verse_text.strip()
-    # Apply each highlighting regular expression to the text.
-    for regx in regx_list:
-        # print(f"regx={regx}: verse_text={verse_text}")
-        verse_text = regx.sub(highlight_group, verse_text)
-        # print(f"got {verse_text}")
-
-    return verse_text
-
-
-def build_verselist(verse_refs: str) -> str:
-    """ Build the verse list html from a string of verse references.
+        status_list.append(status)
+        return lambda data: None
+
+    body = compressed_app(environ, start_response)
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+    if not status_list[0].startswith('200'):
+        print("Warming up %s returned %s." % (path, status_list[0]),
+              file=sys.stderr)
+
+
+def warm_up():
+    """ Open the search index and load its lower case map, then send the
+    books, top searches, and top chapters through the app, and set
+    app_ready.  This runs in warm_up_thread when the server starts.
+
+    """
+
+    global warm_up_error
+
+    try:
+        index_start = perf_counter()
+        bible_search.open()
+        app_metrics.set_gauge('biblesearch_index_open_seconds',
+                              perf_counter() - index_start,
+                              'Time to open the search index.')
+
+        cache_start = perf_counter()
+        for path in warm_up_paths():
+            warm_request(path)
+        app_metrics.set_gauge('biblesearch_warm_up_seconds',
+                              perf_counter() - cache_start,
+                              'Time to warm up the caches.')
+    except (Exception, SystemExit) as err:
+        # The index calls sys.exit when it is broken or missing.
+        warm_up_error = str(err) or err.__class__.__name__
+        print("Error warming up: %s" % warm_up_error, file=sys.stderr)
+    else:
+        app_ready.set()
+
+
+def start_warm_up() -> Thread:
+    """ Start warm_up in warm_up_thread, if it isn't started yet, and return
+    the thread.  The servers call this when they start, so importing the
+    app doesn't open the index.  A server that forks should join the thread
+    first, so the processes share the index and caches.
+
+    """
+
+    global warm_up_thread
+
+    if warm_up_thread is None:
+        warm_up_thread = Thread(target=warm_up, name='warm_up', daemon=True)
+        warm_up_thread.start()
+
+    return warm_up_thread
+
+
+def reopen_index():
+    """ Give a forked server process its own handle on the search index.
+    The index items already loaded and the mmap'd verse html stay shared
+    with the other processes.
+
+    """
+
+    index_start = perf_counter()
+    bible_search.reopen()
+    app_metrics.set_gauge('biblesearch_index_open_seconds',
+                          perf_counter() - index_start,
+                          'Time to open the search index.')
+    conditional.refresh()
+
+
+def build_verselist(verse_refs: str, rid: str='') -> str:
+    """ Build the verse list html from a string of verse references.  The
+    links keep the result id rid.
 
     """
 
     sorted_verse_list = make_valid(verse_refs)
 
     # Generate the result html.
-    return template('verselist', output=sorted_verse_list,
-                    count=len(sorted_verse_list))
+    with stage(app_metrics, 'render.template'):
+        return template('verselist', output=sorted_verse_list,
+                        count=len(sorted_verse_list), rid=rid)
 
 
 def make_valid(verse_refs: str) -> list:
@@ -259,7 +303,8 @@ def make_valid(verse_refs: str) -> list:
     """
 
     # Get a set of valid verse references asked for.
-    verse_refs = sword_search.parse_verse_range(verse_refs)
+    with stage(app_metrics, 'lookup.parse_range'):
+        verse_refs = sword_search.parse_verse_range(verse_refs)
 
     # Get a sorted list of the verse set, because it is faster to
     # lookup verses from a sorted list than from a randomized one.
@@ -278,16 +323,6 @@ def find_paragraph(verse_refs: list, inclusive: bool=True,
                                                       strongs=True,
                                                       morph=True,
                                                       render='raw'):
-        ref_match = ref_regx.search(ref)
-        last_match = ref_regx.search(last_ref)
-
-        # Assume paragraphs don't cross into other books.
-        if last_ref and ref_match:
-            book = ref_match.groupdict().get('book', '').strip()
-            last_book = last_match.groupdict().get('book', '').strip()
-            if last_book != book:
-                return last_ref
-
         # Check for a paragraph in the verse text.
         if paragraph_regx.search(verse_text):
             return ref if inclusive else last_ref
@@ -300,63 +335,90 @@ def find_paragraph(verse_refs: list, inclusive: bool=True,
     return ref if inclusive else last_ref
 
 
-def get_paragraph(verse_ref: str) -> str:
-    """ Finds and returns the paragraph that verse_ref belongs to.
+def get_paragraph(verse_ref: str) -> tuple:
+    """ Finds and returns the span of verse ids of the paragraph that
+    verse_ref belongs to.
 
     """
 
-    # Get verses on either side to try and find the entire paragraph.
-    verse_list = sword_search.add_context([verse_ref], 200)
-    sorted_verse_list = sorted(verse_list, key=sword_search.sort_key)
+    verse_id = sword_search.verse_id(verse_ref)
 
-    # Get the index of this verse.
-    verse_index = sorted_verse_list.index(verse_ref)
+    # Assume paragraphs don't cross into other books, so only look at
+    # the verses on either side that are in the same book.
+    book_start, book_end = sword_search.book_span(verse_id)
 
     # Get the first half including the current reference.
-    first_half = reversed(sorted_verse_list[:verse_index + 1])
+    first_half = sword_search.span_refs((max(book_start, verse_id - 200),
+                                         verse_id))
 
     # Get the second half not including the current reference.
-    last_half = sorted_verse_list[verse_index + 1:]
+    last_half = sword_search.span_refs((verse_id + 1,
+                                        min(book_end, verse_id + 200)))
 
     # Find the start of the paragraph by searching backwards from the
     # target reference.
-    start_ref = find_paragraph(first_half, inclusive=True, default=verse_ref)
+    start_ref = find_paragraph(reversed(first_half), inclusive=True,
+                               default=verse_ref)
 
     # Search forwards to find the end of the paragraph (start of the
     # next paragraph).
     end_ref = find_paragraph(last_half, inclusive=False, default=verse_ref)
 
-    # Make it a range.
-    return '%s-%s' % (start_ref, end_ref)
+    return (sword_search.verse_id(start_ref), sword_search.verse_id(end_ref))
 
 
-def get_chapter(verse_ref: str) -> str:
-    """ Finds and returns the chapter that verse_ref belongs to.
+def get_chapter(verse_ref: str) -> tuple:
+    """ Finds and returns the span of verse ids of the chapter that verse_ref
+    belongs to.
 
     """
 
-    verse = sword_search.Verse(verse_ref)
+    return sword_search.chapter_span(sword_search.verse_id(verse_ref))
 
-    book = verse.get_book_name()
-    start_ref = f'{book} {verse._chapter}:1'
-    end_ref = f'{book} {verse._chapter}:{verse.get_max_verse()._verse}'
 
-    # Make it a range.
-    return f'{start_ref}-{end_ref}'
+def span_to_str(span: tuple) -> str:
+    """ Make a range string out of a span of verse ids.
 
+    """
 
-def lookup_verses(verse_refs, search_terms: str='', context=0):
-    """ Looks up the verses in verse_refs, highlights the search_terms, and
-    returns a list of verses adding context verses on either side of each.
+    start, end = span
+    return '%s-%s' % (sword_search.verse_ref(start),
+                      sword_search.verse_ref(end))
+
+
+def spans_to_refs(span_list: list) -> list:
+    """ Returns a sorted list of all the references in the spans of verse ids
+    in span_list.
+
+    """
+
+    ref_list = []
+    last_end = -1
+    for start, end in sorted(span_list):
+        # Don't repeat verses of overlapping spans.
+        start = max(start, last_end + 1)
+        if start <= end:
+            ref_list.extend(sword_search.span_refs((start, end)))
+        last_end = max(last_end, end)
+
+    return ref_list
+
+
+def parse_lookup(verse_refs, search_terms: str='', context=0):
+    """ Returns a tuple of the set of valid references in verse_refs, the
+    sorted list of them with their context, the search terms without any
+    strongs numbers, and the list of terms to highlight.
 
     """
 
     # Get a set of valid verse references asked for.
-    verse_refs = sword_search.parse_verse_range(verse_refs)
+    with stage(app_metrics, 'lookup.parse_range'):
+        verse_refs = sword_search.parse_verse_range(verse_refs)
 
     # Add the context.
     chapter = False if context >= 0 else True
-    verse_list = sword_search.add_context(verse_refs, context, chapter)
+    with stage(app_metrics, 'lookup.context'):
+        verse_list = sword_search.add_context(verse_refs, context, chapter)
 
     # Get a sorted list of the verse set, because it is faster to lookup
     # verses from a sorted list than from a randomized one.
@@ -372,71 +434,125 @@ def lookup_verses(verse_refs, search_terms: str='', context=0):
     terms_list = [''.join(i) for i in search_regx.findall(search_terms)]
     terms_list = [i for i in terms_list if not i.startswith('!')]
 
-    # The results list.
-    results_list = []
+    return verse_refs, verse_list, search_terms, terms_list
+
+
+def lookup_tokens(verse_refs, search_terms: str='', context=0):
+    """ Looks up the verses in verse_refs and returns a dictionary of their
+    tokens, for the client to render and highlight itself.
+
+    """
+
+    verse_refs, verse_list, _, terms_list = \
+            parse_lookup(verse_refs, search_terms, context)
+
+    highlight_regx = build_highlight(terms_list)
+    kjv_lookup = sword_search.Lookup('KJV')
+
+    token_table = TokenTable()
+    with stage(app_metrics, 'render.tokens'):
+        for ref in verse_list:
+            highlight = ref in verse_refs
+            token_table.add_verse(ref, kjv_lookup.get_raw_text(ref), highlight,
+                                  highlight_regx if highlight else None)
+
+    return token_table.to_dict()
+
+
+def lookup_verses(verse_refs, search_terms: str='', context=0):
+    """ Looks up the verses in verse_refs, highlights the search_terms, and
+    returns a list of verses adding context verses on either side of each.
+
+    """
+
+    return list(iter_verses(verse_refs, search_terms, context))
+
+
+def iter_verses(verse_refs, search_terms: str='', context=0):
+    """ Looks up the verses in verse_refs, highlights the search_terms, and
+    yields each verse as it is rendered, adding context verses on either
+    side of each.
+
+    """
+
+    verse_refs, verse_list, search_terms, terms_list = \
+            parse_lookup(verse_refs, search_terms, context)
+
     last_ref = ''
 
-    # Highlight colors.
-    highlight_text = '<span class="query-highlight">\\1</span>'
+    # Build a regular expression that can be used to highlight the search
+    # query in the output text.
+    highlight_regx = build_highlight(terms_list)
+
+    # The highlighted html of a verse depends only on the highlight regex.
+    highlight_key = (highlight_regx.pattern,
+                     highlight_regx.flags) if highlight_regx else None
+
+    # The raw text is only needed for the verses that get highlighted, or
+    # when the html has not been pre-rendered and is not in the cache.
+    kjv_lookup = sword_search.Lookup('KJV')
+
+    # The time spent getting, highlighting, and rendering the verses is
+    # added up and recorded once, when all the verses are done.
+    fetch_time = highlight_time = osis_time = 0.0
 
     # Build dictionary of verse references and text.
-    for ref, verse_text in sword_search.VerseTextIter(iter(verse_list),
-                                                      strongs=True, morph=True,
-                                                      render='raw'):
+    for ref in verse_list:
 
         # Highlight only in the verses found during the search, not in
         # any of the context verses.
-        if ref in verse_refs:
-            # Build a regular expression that can be used to highlight
-            # the search query in the output text.
-            # print(terms_list)
-            reel = build_highlight_regx(terms_list, False,
-                                        color_tag='</?span[^>]*>',
-                                        extra_tag='</span>')
-
-            # Change all tags that contain the word strong to stronk so
-            # the highlighting will not break the html.
-            verse_text = re.sub(r'(stron)g(:|Morph:|sMarkup)', '\\1k\\2',
-                                verse_text, flags=re.IGNORECASE)
-
-            # Apply the highlight regex to highlight the verse text.
-            verse_text = highlight_search_terms(verse_text, reel,
-                                                highlight_text,
-                                                color_tag='</?span[^>]*>')
-
-            # Change stronk back to strong.
-            verse_text = re.sub(r'(stron)k(:|Morph:|sMarkup)', '\\1g\\2',
-                                verse_text, flags=re.IGNORECASE)
-
-        # Setup the verse text for highlighting and put the headings,
-        # notes, and paragraph markers in.
-        verse_text = tag_regx.sub(tag_func, verse_text)
-
-        if results_list and last_ref:
-            # last_ref = results_list[-1]['verseref']
+        highlight = ref in verse_refs and highlight_regx
+        verse_id = sword_search.verse_id(ref)
+
+        start = perf_counter()
+        if not highlight and verse_html:
+            # Nothing to highlight so just use the pre-rendered html.
+            verse_text = verse_html[verse_id]
+            fetch_time += perf_counter() - start
+        else:
+            cache_key = (verse_id, highlight_key if highlight else None)
+            verse_text = fragment_cache.get(cache_key)
+            if verse_text is None:
+                verse_text = kjv_lookup.get_raw_text(ref)
+                highlight_start = perf_counter()
+                fetch_time += highlight_start - start
+                if highlight:
+                    entry = verse_plain[verse_id] if verse_plain else ''
+                    verse_text = highlight_osis(verse_text, highlight_regx,
+                                                entry)
+
+                # Put the headings, notes, and paragraph markers in.
+                osis_start = perf_counter()
+                highlight_time += osis_start - highlight_start
+                verse_text = render_osis(verse_text)
+                osis_time += perf_counter() - osis_start
+                fragment_cache[cache_key] = verse_text
+            else:
+                fetch_time += perf_counter() - start
+
+        if last_ref:
             last_book, _ = last_ref.rsplit(' ', 1)
             cur_book, _ = ref.rsplit(' ', 1)
 
             # Put a break between books.
             if cur_book != last_book:
-                results_list.append({
+                yield {
                     "highlight": False,
                     "verseref": '',
                     "versetext": '',
-                })
+                }
 
         last_ref = ref
 
-        # Build a list of the results.
-        results_list.append({
+        yield {
             "highlight": ref in verse_refs,
             "verseref": ref if search_terms else '',
             "versetext": verse_text,
-        })
+        }
 
-    # Return the list of results and the list of strongs numbers in the
-    # search query.
-    return results_list
+    app_metrics.observe_stage('render.fetch', fetch_time)
+    app_metrics.observe_stage('render.highlight', highlight_time)
+    app_metrics.observe_stage('render.osis', osis_time)
 
 
 def do_search(search_terms: str='', min_range: str="Genesis",
@@ -448,17 +564,30 @@ def do_search(search_terms: str='', min_range: str="Genesis",
 
     """
 
-    # Make a valid range string.
-    range_str = "%s-%s" % (min_range, max_range)
+    # Reuse the results if the same search was done recently.
+    rid = result_id(search_terms, min_range, max_range)
+    result = result_cache.get(rid)
+    if result:
+        sorted_verse_list = result['references']
+    else:
+        # Make a valid range string.
+        range_str = "%s-%s" % (min_range, max_range)
 
-    # Split the search terms in to '"' quoted groups.
-    terms_list = [''.join(i) for i in search_regx.findall(search_terms)]
+        # Split the search terms in to '"' quoted groups.
+        terms_list = [''.join(i) for i in search_regx.findall(search_terms)]
+
+        # Get a set of verse references that match the search criteria.
+        verse_set = bible_search.mixed_search(terms_list, range_str=range_str)
+
+        # Build the return list of dictionaries.
+        with stage(app_metrics, 'search.sort'):
+            sorted_verse_list = sorted(verse_set, key=sword_search.sort_key)
 
-    # Get a set of verse references that match the search criteria.
-    verse_set = bible_search.mixed_search(terms_list, range_str=range_str)
+        result_cache.add(search_terms, min_range, max_range,
+                         sorted_verse_list)
 
-    # Build the return list of dictionaries.
-    sorted_verse_list = sorted(verse_set, key=sword_search.sort_key)
+    # Let the javascript reuse the results.
+    response.set_header('X-Result-Id', rid)
 
     # Verse list cookie.
     response.set_cookie('search_terms', json.dumps(search_terms),
@@ -467,12 +596,22 @@ def do_search(search_terms: str='', min_range: str="Genesis",
     return sorted_verse_list
 
 
+def get_result(rid: str) -> dict:
+    """ Return the search result with the id rid, or an empty dict if there
+    is none.
+
+    """
+
+    return result_cache.get(rid, {}) if rid else {}
+
+
 def build_search_page(verse_list: str='', verses: str='',
                       strongs_morph: str='', context: int=0, min_range:
                       str="Genesis", max_range: str="Revelation", verse_ref:
                       str="Genesis 1:1", devotional_date: str="today",
-                      search_terms: str=""):
-    """ Build the search page and return a dictionary.
+                      search_terms: str="", rid: str=''):
+    """ Build the search page and return a dictionary.  The forms keep the
+    result id rid.
 
     """
 
@@ -482,7 +621,8 @@ def build_search_page(verse_list: str='', verses: str='',
             'id': 'dcontext',
             'href': '#',
             'label': 'Context',
-            'value': context
+            'value': context,
+            'rid': rid
         },
         {
             'name': 'range_dropdown',
@@ -490,14 +630,16 @@ def build_search_page(verse_list: str='', verses: str='',
             'href': '#',
             'label': 'Range',
             'min_range': min_range,
-            'max_range': max_range
+            'max_range': max_range,
+            'rid': rid
         },
         {
             'name': 'lookup_dropdown',
             'id': 'dlookup',
             'href': '#',
             'label': 'Reference',
-            'reference': verse_ref
+            'reference': verse_ref,
+            'rid': rid
         },
         {
             'name': 'devotional_dropdown',
@@ -508,25 +650,37 @@ def build_search_page(verse_list: str='', verses: str='',
         },
     ]
 
-    dropdowns = '\n'.join([template(i['name'], **i) for i in drop_list])
+    dropdowns = '\n'.join([dropdown_html(**i) for i in drop_list])
 
-    return template('biblesearch', verse_list=verse_list, verses=verses,
-                    strongs_morph=strongs_morph, dropdowns=dropdowns,
-                    search_terms=html_escape(search_terms))
+    return search_page.render(verse_list=verse_list, verses=verses,
+                              strongs_morph=strongs_morph, dropdowns=dropdowns,
+                              search_terms=html_escape(search_terms))
 
 
-def build_page(reference_list: list=[], search_terms: str='', context: int=0):
+def build_page(reference_list: list=[], search_terms: str='', context: int=0,
+               rid: str=''):
     """ Build a webpage of the verses in reference list with the words and
     phrases in search_terms highlighted.  A context is added to each verse.
+    The search and its range come from the result id rid if it is known,
+    otherwise from the cookies.
 
     """
 
     # Get cookie data to use in the page.
-    min_range = json.loads(request.get_cookie('min_range', '"Genesis"'))
-    max_range = json.loads(request.get_cookie('max_range', '"Revelation"'))
     verse_ref = json.loads(request.get_cookie('reference', '"Genesis 1:1"'))
     devotional_date = json.loads(request.get_cookie('devotional', '"today"'))
 
+    result = get_result(rid)
+    if result:
+        min_range = result['min_range']
+        max_range = result['max_range']
+        search_terms = search_terms or result['search_terms']
+        reference_list = reference_list or result['references']
+    else:
+        min_range = json.loads(request.get_cookie('min_range', '"Genesis"'))
+        max_range = json.loads(request.get_cookie('max_range',
+                                                  '"Revelation"'))
+
     if not search_terms:
         search_terms = json.loads(request.get_cookie('search_terms', '""'))
 
@@ -534,22 +688,27 @@ def build_page(reference_list: list=[], search_terms: str='', context: int=0):
         reference_list = do_search(search_terms, min_range=min_range,
                                    max_range=max_range)
 
+    if search_terms and not result:
+        rid = result_id(search_terms, min_range, max_range)
+
     if not context:
         context = json.loads(request.get_cookie('context', '0'))
 
     verses = lookup_verses(reference_list, search_terms, context)
-    verses_html = template('verses', output=verses)
+    with stage(app_metrics, 'render.template'):
+        verses_html = template('verses', output=verses)
 
     # Build the result page.
     search_page_dict = {
-        'verse_list': build_verselist(','.join(reference_list)),
+        'verse_list': build_verselist(','.join(reference_list), rid),
         'verses': verses_html,
         'context': context,
         'min_range': min_range,
         'max_range': max_range,
         'verse_ref': verse_ref,
         'devotional_date': devotional_date,
-        'search_terms': search_terms
+        'search_terms': search_terms,
+        'rid': rid
     }
 
     return build_search_page(**search_page_dict)
@@ -564,7 +723,7 @@ def handle_static(path):
     """
 
     # Return the requested static file.
-    return static_file(path, join(project_root, "assets"))
+    return asset_store.response(path, request)
 
 
 @bible_app.route("/biblesearch/context")
@@ -576,7 +735,7 @@ def context():
     context = request.query.get('context', 0, type=int)
     response.set_cookie('context', json.dumps(context), path='/biblesearch')
 
-    return build_page(context=context)
+    return build_page(context=context, rid=request.query.get('rid', ''))
 
 
 @bible_app.route("/biblesearch/range")
@@ -595,12 +754,17 @@ def range():
     response.set_cookie('max_range', json.dumps(max_range),
                         path='/biblesearch')
 
-    # Re-search using the new range.
-    search_terms = json.loads(request.get_cookie('search_terms', '""'))
+    # Re-search the terms of the result id, or the cookie, using the new
+    # range.
+    result = get_result(request.query.get('rid', ''))
+    search_terms = result.get('search_terms', None)
+    if search_terms is None:
+        search_terms = json.loads(request.get_cookie('search_terms', '""'))
     sorted_verse_list = do_search(search_terms, min_range, max_range)
 
     # Return the built page.
-    return build_page(sorted_verse_list, search_terms)
+    return build_page(sorted_verse_list, search_terms,
+                      rid=result_id(search_terms, min_range, max_range))
 
 
 @bible_app.route("/biblesearch/search")
@@ -635,13 +799,22 @@ def search(ext: str=''):
     sorted_verse_list = do_search(search_terms, min_range, max_range)
 
     if ext == '.json':
-        return {'references': sorted_verse_list}
+        # Stream the references, so a big search doesn't have to be
+        # encoded all at once.
+        if wants_ndjson(request):
+            response.content_type = 'application/x-ndjson'
+            return ndjson_stream(sorted_verse_list)
+
+        response.content_type = 'application/json'
+        return json_list_stream('references', sorted_verse_list)
     else:
-        return build_page(sorted_verse_list, search_terms)
+        return build_page(sorted_verse_list, search_terms,
+                          rid=result_id(search_terms, min_range, max_range))
 
 
 @bible_app.route("/biblesearch/references")
 @bible_app.route("/biblesearch/references<ext>")
+@conditional()
 def references(ext: str=''):
     """ Returns and html verse list of the requested references.
 
@@ -658,6 +831,7 @@ def references(ext: str=''):
 
 @bible_app.route("/biblesearch/chapter")
 @bible_app.route("/biblesearch/chapter<ext>")
+@conditional()
 def chapter(ext: str=''):
     """ Attempts to find the chapter.
 
@@ -672,16 +846,18 @@ def chapter(ext: str=''):
     verse_list = make_valid(verse_refs)
 
     # Build a chapter for each verse in the list.
-    verse_refs = [get_chapter(i) for i in verse_list]
+    with stage(app_metrics, 'lookup.chapter'):
+        span_list = sorted({get_chapter(i) for i in verse_list})
 
     if ext == '.json':
-        return {'references': verse_refs}
+        return {'references': [span_to_str(i) for i in span_list]}
     else:
-        return build_page(make_valid(verse_refs))
+        return build_page(spans_to_refs(span_list))
 
 
 @bible_app.route("/biblesearch/paragraph")
 @bible_app.route("/biblesearch/paragraph<ext>")
+@conditional()
 def paragraph(ext: str=''):
     """ Attempts to find the start and end of the paragraph and returns all
     those verses.
@@ -697,28 +873,44 @@ def paragraph(ext: str=''):
     verse_list = make_valid(verse_refs)
 
     # Build a paragraph for each verse in the list.
-    verse_refs = [get_paragraph(i) for i in verse_list]
+    with stage(app_metrics, 'lookup.paragraph'):
+        span_list = sorted({get_paragraph(i) for i in verse_list})
 
     if ext == '.json':
-        return {'references': verse_refs}
+        return {'references': [span_to_str(i) for i in span_list]}
     else:
-        return build_page(make_valid(verse_refs))
+        return build_page(spans_to_refs(span_list))
 
 
 @bible_app.route("/biblesearch/lookup")
 @bible_app.route("/biblesearch/lookup<ext>")
+@conditional(ext_list=('.tokens',))
+@conditional('private, no-cache', cookie_list=('search_terms', 'context'),
+             accept_func=wants_ndjson, send_cached=False)
 def lookup(ext: str=''):
     """ Lookup the verse reference and return the verse text and the verse text
     for all the verses in the requested context.
 
     """
 
+    if ext == '.tokens':
+        # Only use the query, so the response can be cached by its url.
+        verse_refs = request.query.get('verse_refs', '').replace('+', ' ')
+        search_terms = request.query.get('terms', '').strip()
+        context = request.query.get('context', 0, type=int)
+
+        return lookup_tokens(verse_refs.strip(), search_terms, context)
+
     # Get the search_terms cookie as a fallback
     search_terms = json.loads(request.get_cookie('search_terms', '""'))
 
     # Get the context cookie as a fallback.
     context = json.loads(request.get_cookie('context', '0'))
 
+    # The search terms of the result id come before the cookie.
+    rid = request.query.get('rid', '')
+    search_terms = get_result(rid).get('search_terms', search_terms)
+
     # Get the search terms, verse references, and context.
     search_terms = request.query.get('terms', search_terms).strip()
     verse_refs = request.query.get('verse_refs', '').strip()
@@ -730,20 +922,27 @@ def lookup(ext: str=''):
     response.set_cookie('context', json.dumps(context), path='/biblesearch')
 
     if ext == '.json':
-        # Lookup the verses in verse_refs.
-        lines = lookup_verses(verse_refs, search_terms, context)
-
-        # Generate the result html.
-        result_str = template('verses', output=lines)
-
-        # Return json data to the javascript.
-        return {'html': result_str}
+        # Lookup the verses in verse_refs as they are sent.
+        verse_iter = iter_verses(verse_refs, search_terms, context)
+
+        if wants_ndjson(request):
+            # Send each verse on its own line.
+            response.content_type = 'application/x-ndjson'
+            return ndjson_stream(verse_iter)
+
+        # Generate the result html and stream it as json data to the
+        # javascript.
+        response.content_type = 'application/json'
+        html_iter = template_stream('verses', output=verse_iter)
+        return json_str_stream('html', html_iter)
     else:
-        return build_page(make_valid(verse_refs), search_terms, context)
+        return build_page(make_valid(verse_refs), search_terms, context, rid)
 
 
 @bible_app.route("/biblesearch/devotional")
 @bible_app.route("/biblesearch/devotional<ext>")
+@conditional('private, no-cache', key_func=lambda: strftime('%m.%d'),
+             send_cached=False)
 def devotional(ext: str=''):
     """ Lookup the daily devotional.
 
@@ -764,7 +963,7 @@ def devotional(ext: str=''):
     devotional_text = devotional_lookup.get_raw_text(devotional_date)
 
     # Make the verse lists at the end into links.
-    devotional_text = tag_regx.sub(tag_func, devotional_text)
+    devotional_text = render_osis(devotional_text)
 
     # Return json data to the javascript.
     if ext == '.json':
@@ -776,6 +975,7 @@ def devotional(ext: str=''):
 
 @bible_app.route("/biblesearch/strongs")
 @bible_app.route("/biblesearch/strongs<ext>")
+@conditional()
 def strongs(ext: str=''):
     """ Lookup the strongs/morph and return the appropriate text.
 
@@ -839,6 +1039,7 @@ def strongs(ext: str=''):
         # Get the tag definition.
         lookup = sword_search.Lookup(module_name="Robinson")
         text = lookup.get_raw_text(tag_name.upper())
+        morph_regx = re.compile(morph_pattern, re.I | re.X)
 
         # If the tag does not match the regular expression, just append
         # it to the text list.
@@ -849,7 +1050,8 @@ def strongs(ext: str=''):
         for match in morph_regx.finditer(text):
             text_list.append('<i>{1}</i>{2}<br/>'.format(*match.groups()))
 
-    strongs_morph_html = template('strongs', output=text_list)
+    with stage(app_metrics, 'render.template'):
+        strongs_morph_html = template('strongs', output=text_list)
     if ext == '.json':
         return {'html': strongs_morph_html}
     else:
@@ -858,6 +1060,7 @@ def strongs(ext: str=''):
 
 @bible_app.route("/biblesearch/books")
 @bible_app.route("/biblesearch/books<ext>")
+@conditional(ext_list=('', '.json'))
 def books(ext: str=''):
     """ Search the census data and return a jsond dict of the results.
 
@@ -866,6 +1069,44 @@ def books(ext: str=''):
     return {'array': sword_search.book_list}
 
 
+@bible_app.route("/healthz")
+def healthz():
+    """ Tell the launcher or a load balancer that the server is running.
+
+    """
+
+    response.set_header('Cache-Control', 'no-store')
+
+    return {'status': 'ok'}
+
+
+@bible_app.route("/readyz")
+def readyz():
+    """ Return 200 once the index is open and the caches are warm, and 503
+    until then.
+
+    """
+
+    response.set_header('Cache-Control', 'no-store')
+    if not app_ready.is_set():
+        response.status = 503
+
+    return {'ready': app_ready.is_set(), 'error': warm_up_error}
+
+
+@bible_app.route("/metrics")
+def metrics():
+    """ Return the request, stage, and cache metrics in the Prometheus
+    text format.
+
+    """
+
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    response.set_header('Cache-Control', 'no-store')
+
+    return app_metrics.render()
+
+
 # Handle the index page
 @bible_app.route("/")
 @bible_app.route("/<location>")
@@ -877,17 +1118,30 @@ def index(location='biblesearch'):
 
     if location == 'biblesearch':
         if request.get_cookie('javascript'):
-            print('javascript: yep')
             return build_search_page()
         else:
-            print('javascript: nope')
             return build_page()
 
     return template(location)
 
 
+# The app to serve, with the html and json responses compressed.  The
+# compressed bodies share the fragment cache with the verse html.  The time
+# of every request is recorded, including compressing and sending it.
+compressed_app = Compress(bible_app, min_size=1024, level=6,
+                          cache=fragment_cache)
+application = RequestMetrics(compressed_app, app_metrics)
+
+app_metrics.set_gauge('biblesearch_startup_seconds',
+                      perf_counter() - import_start,
+                      'Time to load the app, without opening the index.')
+
+
 if __name__ == "__main__":
     # Run under local testing server
     from socket import gethostname, gethostbyname
-    bible_app.run(host=gethostbyname(gethostname()), port=8081, reloader=True,
-                  server='tornado', debug=True)
+    from server import AsyncTornadoServer
+    start_warm_up()
+    run(application, host=gethostbyname(gethostname()), port=8081,
+        reloader=True, server=AsyncTornadoServer, workers=4, timeout=30,
+        debug=True)
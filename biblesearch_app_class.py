@@ -22,42 +22,40 @@ from os.path import join, dirname
 from socket import gethostname, gethostbyname
 from multiprocessing import Process
 import threading
-from bottle import run, debug, jinja2_template as template
-from bottle import request, response, redirect, static_file, Bottle
+from urllib.parse import urlencode
+from wsgiref.util import setup_testing_defaults
+from io import BytesIO
+from bottle import run, debug
+from bottle import request, response, redirect, Bottle
 from string import printable as string_printable
 from html import escape as html_escape
-from time import strftime
+from time import strftime, perf_counter
 import json
+import sys
+import os
 import re
 
 import sword_search
-from sword_search import build_highlight_regx, highlight_search_terms
+from render import render_osis, build_highlight, highlight_osis
+from render import FragmentCache, TokenTable
+from stream import template_stream, json_str_stream, json_list_stream
+from stream import ndjson_stream, wants_ndjson
+from templates import template, dropdown_html, PageShell
+from httpcache import Conditional
+from static import AssetStore
+from compress import Compress
+from results import ResultCache, result_id
+from metrics import Metrics, RequestMetrics, stage, debug_timing
+from profiler import Profiler
+import templates
+import render
 import errors
+from server import AsyncTornadoServer
 
 
 class BiblesearchApp(object):
     # Global variables
 
-    # Seperates tags and there attributes and text into groups.
-    tag_regx = re.compile(r'''
-                <(?P<tag>
-                [Ss]eg|[Nn]ote|[Ww]|[Mm]ilestone|[Ff]oreign|
-                [Tt]itle|trans[cC]hange|divine[nN]ame|
-                scrip[Rr]ef|[Qq])
-                (?P<attr>[^>]*)(?:(?P<end>/>)|>
-                (?P<text>[\w\W]*?)
-                </(?P=tag)>)
-                ''', re.X)
-
-    # Seperates tag attributes into the attribute name and its value.
-    attr_regx = re.compile(r'''\s*(?P<name>[^=]+)="(?P<value>[^"]+)\s*"''')
-
-    title_regx = re.compile(r'''
-                <(?P<tag>[Tt]itle)(?P<attr>[^>]*)>
-                (?P<text>[\w\W]*?)
-                </(?P=tag)>
-                ''', re.X)
-
     # Extracts the language from a StrongsReal uri.
     strongs_regx = re.compile(r'''
             sword://StrongsReal(H|G)(ebrew|reek)/(\d+?)
@@ -66,21 +64,17 @@ class BiblesearchApp(object):
     # Extracts the languages from a strongs number.
     strongs_lang_regx = re.compile(r'((H|G)\d+)', re.I)
 
-    # Regex for formatting morphology definitions.
-    morph_regx = re.compile(r'''
+    # Regex for formatting morphology definitions.  It is slow to compile,
+    # so it is compiled, and cached by re, when a morphology tag is looked
+    # up.
+    morph_pattern = r'''
             (?:<(?P<italic>hi)      # The opening highlight
             [^>]+?>                 # Tag attributes
             ([^<]+)                 # Tag text
             </(?P=italic)>          # Tag end
             ([^><]+)                # Break after text
             <(?P<break>lb)/>)       # Break tag
-            ''', re.I | re.X)
-
-    added_regx = re.compile(r'''
-            <transChange\s+type="added">
-            ([^<]+)
-            </transChange>
-            ''', re.I | re.X)
+            '''
 
     # Splits a search query into quoted groups and non-quoted words.
     search_regx = re.compile(r'''(?:"(?P<quoted>[^"]+)"|(?P<unquoted>[^\s"]+))''')
@@ -88,32 +82,103 @@ class BiblesearchApp(object):
     # Find paragraph markers.
     paragraph_regx = re.compile(r'''marker="[^"]+"''')
 
-    # Split a reference into book, chapter, and verse groups.
-    # ref_regx = re.compile(r'''(?P<book>\d*\D+)(?P<chap>\d*):?(?P<verse>\d*)''')
-    ref_regx = re.compile(r'''
-        (?P<book>\d?[^\d-]+)
-        \s*
-        (?P<chap>[\d,-]*)
-        :
-        (?P<verse>[\d,-]*)
-        ''', re.X)
+    # The searches and chapters people ask for most, which warm_up sends
+    # through the app so their first requests hit the caches.  The
+    # BIBLESEARCH_WARM_UP_FILE variable can name a json file with other
+    # "queries" and "chapters" lists, and BIBLESEARCH_WARM_UP_TOP is how
+    # many of each to send.
+    warm_up_queries = ['love', 'faith', 'grace', 'peace', '"in the beginning"',
+                       '"the lord is my shepherd"', 'God so loved the world',
+                       'faith hope charity', 'jesus wept', 'holy spirit']
+    warm_up_chapters = ['John 3', 'Psalms 23', 'Genesis 1', 'Romans 8',
+                        '1 Corinthians 13', 'Matthew 5', 'Psalms 91',
+                        'Isaiah 53', 'John 1', 'Romans 12']
 
     def __init__(self, daemon: bool=True):
         """ Initialize the webapp.
 
         """
 
+        startup_start = perf_counter()
+
         self.thread = None
         self.daemon = daemon
 
+        # Set when the index is open and the caches are warm.
+        self.app_ready = threading.Event()
+
+        # The error that stopped the warm up, if any.
+        self.warm_up_error = ''
+
+        # The thread start_warm_up runs warm_up in.
+        self.warm_up_thread = None
+
         # The main bottle app.
         self.bible_app = Bottle()
         self.bible_app.error_handler = errors.handler
 
         self.project_root = dirname(__file__)
 
+        # The request, stage, and cache metrics served at /metrics.
+        self.metrics = Metrics()
+        sword_search.set_stage_hook(self.metrics.observe_stage)
+
+        # Add the stage times to the json when the query has debug=timing.
+        self.bible_app.install(debug_timing(self.metrics))
+
+        # Profile live requests when the BIBLESEARCH_PROFILE_* variables are
+        # set.
+        self.bible_app.install(Profiler())
+
+        # The index is opened by warm_up, or by the first search if it
+        # comes first.
         self.bible_search = sword_search.Search(multiword=True)
 
+        # The pre-rendered html of every verse, and the plain entries
+        # highlight_osis searches.  Run render.py to build them.
+        self.verse_html = sword_search.open_html_table()
+        self.verse_plain = sword_search.open_html_table(kind='plain')
+
+        # The rendered html of highlighted verses, shared by all the routes.
+        self.fragment_cache = FragmentCache()
+
+        # The results of recent searches by result id.
+        self.result_cache = ResultCache()
+
+        # The search page with everything but the fields already rendered.
+        self.search_page = PageShell('biblesearch', ['verse_list', 'verses',
+                                                     'strongs_morph',
+                                                     'dropdowns',
+                                                     'search_terms'])
+
+        # ETags for the responses that only change when the index or the
+        # templates are rebuilt.
+        self.conditional = Conditional(sword_search.INDEX_PATH,
+                                       join(self.project_root, 'views'))
+
+        # Every asset and its compressed copies, so they are served from
+        # memory.
+        self.asset_store = AssetStore()
+
+        self.metrics.add_cache('fragments', self.fragment_cache.stats)
+        self.metrics.add_cache('results', self.result_cache.stats)
+        self.metrics.add_cache('highlight_regex',
+                               render._highlight_regex.cache_info)
+        self.metrics.add_cache('plain_text', render._plain_text.cache_info)
+        self.metrics.add_cache('dropdowns',
+                               templates._cached_dropdown.cache_info)
+        for name in sword_search.regex_cache_info():
+            self.metrics.add_cache(name, lambda name=name:
+                                   sword_search.regex_cache_info()[name])
+
+        # The app to serve, with the html and json responses compressed.
+        # The compressed bodies share the fragment cache with the verse
+        # html.  The time of every request is recorded, including
+        # compressing and sending it.
+        self.compressed_app = Compress(self.bible_app, min_size=1024,
+                                       level=6, cache=self.fragment_cache)
+        self.application = RequestMetrics(self.compressed_app, self.metrics)
+
         # Handle static files
         # @bible_app.route('/<path>')
         @self.bible_app.route('/assets/<path:path>')
@@ -123,7 +188,7 @@ class BiblesearchApp(object):
             """
 
             # Return the requested static file.
-            return static_file(path, join(self.project_root, "assets"))
+            return self.asset_store.response(path, request)
 
 
         @self.bible_app.route("/biblesearch/context")
@@ -135,7 +200,8 @@ class BiblesearchApp(object):
             context = request.query.get('context', 0, type=int)
             response.set_cookie('context', json.dumps(context), path='/biblesearch')
 
-            return self.build_page(context=context)
+            return self.build_page(context=context,
+                                   rid=request.query.get('rid', ''))
 
 
         @self.bible_app.route("/biblesearch/range")
@@ -154,12 +220,18 @@ class BiblesearchApp(object):
             response.set_cookie('max_range', json.dumps(max_range),
                                 path='/biblesearch')
 
-            # Re-search using the new range.
-            search_terms = json.loads(request.get_cookie('search_terms', '""'))
+            # Re-search the terms of the result id, or the cookie, using the
+            # new range.
+            result = self.get_result(request.query.get('rid', ''))
+            search_terms = result.get('search_terms', None)
+            if search_terms is None:
+                search_terms = json.loads(request.get_cookie('search_terms', '""'))
             sorted_verse_list = self.do_search(search_terms, min_range, max_range)
 
             # Return the built page.
-            return self.build_page(sorted_verse_list, search_terms)
+            return self.build_page(sorted_verse_list, search_terms,
+                                   rid=result_id(search_terms, min_range,
+                                                 max_range))
 
 
         @self.bible_app.route("/biblesearch/search")
@@ -194,13 +266,23 @@ class BiblesearchApp(object):
             sorted_verse_list = self.do_search(search_terms, min_range, max_range)
 
             if ext == '.json':
-                return {'references': sorted_verse_list}
+                # Stream the references, so a big search doesn't have to be
+                # encoded all at once.
+                if wants_ndjson(request):
+                    response.content_type = 'application/x-ndjson'
+                    return ndjson_stream(sorted_verse_list)
+
+                response.content_type = 'application/json'
+                return json_list_stream('references', sorted_verse_list)
             else:
-                return self.build_page(sorted_verse_list, search_terms)
+                return self.build_page(sorted_verse_list, search_terms,
+                                       rid=result_id(search_terms, min_range,
+                                                     max_range))
 
 
         @self.bible_app.route("/biblesearch/references")
         @self.bible_app.route("/biblesearch/references<ext>")
+        @self.conditional()
         def references(ext: str=''):
             """ Returns and html verse list of the requested references.
 
@@ -217,6 +299,7 @@ class BiblesearchApp(object):
 
         @self.bible_app.route("/biblesearch/paragraph")
         @self.bible_app.route("/biblesearch/paragraph<ext>")
+        @self.conditional()
         def paragraph(ext: str=''):
             """ Attempts to find the start and end of the paragraph and returns all
             those verses.
@@ -232,28 +315,47 @@ class BiblesearchApp(object):
             verse_list = self.make_valid(verse_refs)
 
             # Build a paragraph for each verse in the list.
-            verse_refs = [self.get_paragraph(i) for i in verse_list]
+            with stage(self.metrics, 'lookup.paragraph'):
+                span_list = sorted({self.get_paragraph(i)
+                                    for i in verse_list})
 
             if ext == '.json':
-                return {'references': verse_refs}
+                return {'references': [self.span_to_str(i) for i in span_list]}
             else:
-                return self.build_page(self.make_valid(verse_refs))
+                return self.build_page(self.spans_to_refs(span_list))
 
 
         @self.bible_app.route("/biblesearch/lookup")
         @self.bible_app.route("/biblesearch/lookup<ext>")
+        @self.conditional(ext_list=('.tokens',))
+        @self.conditional('private, no-cache',
+                          cookie_list=('search_terms', 'context'),
+                          accept_func=wants_ndjson, send_cached=False)
         def lookup(ext: str=''):
             """ Lookup the verse reference and return the verse text and the verse text
             for all the verses in the requested context.
 
             """
 
+            if ext == '.tokens':
+                # Only use the query, so the response can be cached by its url.
+                verse_refs = request.query.get('verse_refs', '').replace('+', ' ')
+                search_terms = request.query.get('terms', '').strip()
+                context = request.query.get('context', 0, type=int)
+
+                return self.lookup_tokens(verse_refs.strip(), search_terms, context)
+
             # Get the search_terms cookie as a fallback
             search_terms = json.loads(request.get_cookie('search_terms', '""'))
 
             # Get the context cookie as a fallback.
             context = json.loads(request.get_cookie('context', '0'))
 
+            # The search terms of the result id come before the cookie.
+            rid = request.query.get('rid', '')
+            search_terms = self.get_result(rid).get('search_terms',
+                                                    search_terms)
+
             # Get the search terms, verse references, and context.
             search_terms = request.query.get('terms', search_terms).strip()
             verse_refs = request.query.get('verse_refs', '').strip()
@@ -265,20 +367,30 @@ class BiblesearchApp(object):
             response.set_cookie('context', json.dumps(context), path='/biblesearch')
 
             if ext == '.json':
-                # Lookup the verses in verse_refs.
-                lines = self.lookup_verses(verse_refs, search_terms, context)
-
-                # Generate the result html.
-                result_str = template('verses', output=lines)
-
-                # Return json data to the javascript.
-                return {'html': result_str}
+                # Lookup the verses in verse_refs as they are sent.
+                verse_iter = self.iter_verses(verse_refs, search_terms,
+                                              context)
+
+                if wants_ndjson(request):
+                    # Send each verse on its own line.
+                    response.content_type = 'application/x-ndjson'
+                    return ndjson_stream(verse_iter)
+
+                # Generate the result html and stream it as json data to the
+                # javascript.
+                response.content_type = 'application/json'
+                html_iter = template_stream('verses', output=verse_iter)
+                return json_str_stream('html', html_iter)
             else:
-                return self.build_page(self.make_valid(verse_refs), search_terms, context)
+                return self.build_page(self.make_valid(verse_refs), search_terms,
+                                       context, rid)
 
 
         @self.bible_app.route("/biblesearch/devotional")
         @self.bible_app.route("/biblesearch/devotional<ext>")
+        @self.conditional('private, no-cache',
+                          key_func=lambda: strftime('%m.%d'),
+                          send_cached=False)
         def devotional(ext: str=''):
             """ Lookup the daily devotional.
 
@@ -299,7 +411,7 @@ class BiblesearchApp(object):
             devotional_text = devotional_lookup.get_raw_text(devotional_date)
 
             # Make the verse lists at the end into links.
-            devotional_text = self.tag_regx.sub(self.tag_func, devotional_text)
+            devotional_text = render_osis(devotional_text)
 
             # Return json data to the javascript.
             if ext == '.json':
@@ -311,6 +423,7 @@ class BiblesearchApp(object):
 
         @self.bible_app.route("/biblesearch/strongs")
         @self.bible_app.route("/biblesearch/strongs<ext>")
+        @self.conditional()
         def strongs(ext: str=''):
             """ Lookup the strongs/morph and return the appropriate text.
 
@@ -374,17 +487,19 @@ class BiblesearchApp(object):
                 # Get the tag definition.
                 lookup = sword_search.Lookup(module_name="Robinson")
                 text = lookup.get_raw_text(tag_name.upper())
+                morph_regx = re.compile(self.morph_pattern, re.I | re.X)
 
                 # If the tag does not match the regular expression, just append
                 # it to the text list.
-                if not self.morph_regx.match(text):
+                if not morph_regx.match(text):
                     text_list.append(text)
 
                 # Convert the raw tag text to valid html.
-                for match in self.morph_regx.finditer(text):
+                for match in morph_regx.finditer(text):
                     text_list.append('<i>{1}</i>{2}<br/>'.format(*match.groups()))
 
-            strongs_morph_html = template('strongs', output=text_list)
+            with stage(self.metrics, 'render.template'):
+                strongs_morph_html = template('strongs', output=text_list)
             if ext == '.json':
                 return {'html': strongs_morph_html}
             else:
@@ -393,6 +508,7 @@ class BiblesearchApp(object):
 
         @self.bible_app.route("/biblesearch/books")
         @self.bible_app.route("/biblesearch/books<ext>")
+        @self.conditional(ext_list=('', '.json'))
         def books(ext: str=''):
             """ Search the census data and return a jsond dict of the results.
 
@@ -401,6 +517,46 @@ class BiblesearchApp(object):
             return {'array': sword_search.book_list}
 
 
+        @self.bible_app.route("/healthz")
+        def healthz():
+            """ Tell the launcher or a load balancer that the server is
+            running.
+
+            """
+
+            response.set_header('Cache-Control', 'no-store')
+
+            return {'status': 'ok'}
+
+
+        @self.bible_app.route("/readyz")
+        def readyz():
+            """ Return 200 once the index is open and the caches are warm,
+            and 503 until then.
+
+            """
+
+            response.set_header('Cache-Control', 'no-store')
+            if not self.app_ready.is_set():
+                response.status = 503
+
+            return {'ready': self.app_ready.is_set(),
+                    'error': self.warm_up_error}
+
+
+        @self.bible_app.route("/metrics")
+        def metrics():
+            """ Return the request, stage, and cache metrics in the
+            Prometheus text format.
+
+            """
+
+            response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            response.set_header('Cache-Control', 'no-store')
+
+            return self.metrics.render()
+
+
         # Handle the index page
         @self.bible_app.route("/")
         @self.bible_app.route("/<location>")
@@ -412,113 +568,30 @@ class BiblesearchApp(object):
 
             if location == 'biblesearch':
                 if request.get_cookie('javascript'):
-                    print('javascript: yep')
                     return self.build_search_page()
                 else:
-                    print('javascript: nope')
                     return self.build_page()
 
             return template(location)
 
+        self.metrics.set_gauge('biblesearch_startup_seconds',
+                               perf_counter() - startup_start,
+                               'Time to load the app, without opening the '
+                               'index.')
 
-    def tag_func(self, match):
-        """ Modify the verse text to italicize, uppercase and extract headings.
 
-        """
-
-        # Get a dictionary of the matched text each key is one of the labels
-        # in the regex.
-        match_dict = match.groupdict()
-
-        # Set the text to '' empty string if it is None.
-        if not match_dict['text']:
-            match_dict['text'] = ''
-
-        # Get the most used values out of the dictionary.
-        tag = match_dict.get('tag', '').lower()
-        attr = match_dict.get('attr', '')
-        text = match_dict.get('text', '')
-
-        # Use another regex to get a dictionary of all the name=value pairs
-        # in the attributes of this tag.
-        attr_dict = dict(self.attr_regx.findall(attr.lower()))
-
-        # Depending on the tag return an appropriate replacement.
-        if 'transchange' in tag:
-            if attr_dict.get('type', '') == 'added':
-                return '<span class="added-text">%s</span>' % text
-        if 'divinename' in tag:
-            return '<span class="divine-name">%s</span>' % text
-        if 'title' in tag:
-            text = self.tag_regx.sub(self.tag_func, text)
-            return '<span class="title-text">%s</span> ' % text
-        if 'foreign' in tag:
-            if 'n' in attr_dict:
-                match_dict.update(attr_dict)
-                foreign_str = '<span class="foreign-text">{n}</span> {text}'
-                return foreign_str.format(**match_dict)
-        if 'milestone' in tag:
-            if 'marker' in attr_dict:
-                match_dict.update(attr_dict)
-                marker = '<span class="paragraph-marker">{marker}</span> {text}'
-                return marker.format(**match_dict)
-        if 'w' == tag:
-            word_span = '<span class="word" '
-            lemma_str = 'data-lemma="{lemma}" '
-            morph_str = 'data-morph="{morph}"'
-            close_span = '>{text}</span>'
-
-            attr_dict = dict(self.attr_regx.findall(attr))
-            if 'lemma' in attr_dict:
-                word_span += lemma_str
-            if 'morph' in attr_dict:
-                word_span += morph_str
-            word_span += close_span
-            match_dict.update(attr_dict)
-            match_dict['text'] = self.tag_regx.sub(self.tag_func, match_dict['text'])
-            return word_span.format(**match_dict)
-        if 'seg' == tag:
-            seg_span = '<span class="seg">%s</span>'
-            return seg_span % self.tag_regx.sub(self.tag_func, match_dict['text'])
-        if 'note' == tag:
-            note_span = '<span class="note">{text}</span>'
-            return note_span.format(**match_dict)
-        if 'scripref' == tag:
-            passage_href = 'href="/biblesearch/lookup?verse_refs=%s">%s</a>'
-            passage_a = '<a class="verseref verselist" ' + passage_href
-            passage_str = attr_dict.get('passage', '')
-            ref_list = []
-            last_book = ''
-            for book, chapter, verse in self.ref_regx.findall(passage_str.strip()):
-                book = book.strip()
-                if not book:
-                    book = last_book
-                last_book = book
-                # Attempt to fix the book name to destinguish between Judges
-                # and Jude.
-                if book.lower() == 'jud':
-                    book = 'Judg'
-                    text = text.replace('Jud ', 'Judg ')
-                ref_list.append('%s+%s:%s' % (book, chapter, verse))
-            refs = ';'.join(ref_list)
-
-            return passage_a % (refs, text)
-        if 'q' == tag:
-            q_span = '<span class="red-quote">%s</span>'
-            match_dict['text'] = self.tag_regx.sub(self.tag_func, match_dict['text'])
-            return q_span % match_dict['text']
-
-
-    def build_verselist(self, verse_refs: str) -> str:
-        """ Build the verse list html from a string of verse references.
+    def build_verselist(self, verse_refs: str, rid: str='') -> str:
+        """ Build the verse list html from a string of verse references.  The
+        links keep the result id rid.
 
         """
 
         sorted_verse_list = self.make_valid(verse_refs)
 
         # Generate the result html.
-        return template('verselist', output=sorted_verse_list,
-                        count=len(sorted_verse_list))
+        with stage(self.metrics, 'render.template'):
+            return template('verselist', output=sorted_verse_list,
+                            count=len(sorted_verse_list), rid=rid)
 
 
     def make_valid(self, verse_refs: str) -> list:
@@ -528,7 +601,8 @@ class BiblesearchApp(object):
         """
 
         # Get a set of valid verse references asked for.
-        verse_refs = sword_search.parse_verse_range(verse_refs)
+        with stage(self.metrics, 'lookup.parse_range'):
+            verse_refs = sword_search.parse_verse_range(verse_refs)
 
         # Get a sorted list of the verse set, because it is faster to
         # lookup verses from a sorted list than from a randomized one.
@@ -547,16 +621,6 @@ class BiblesearchApp(object):
                                                         strongs=True,
                                                         morph=True,
                                                         render='raw'):
-            ref_match = self.ref_regx.search(ref)
-            last_match = self.ref_regx.search(last_ref)
-
-            # Assume paragraphs don't cross into other books.
-            if last_ref and ref_match:
-                book = ref_match.groupdict().get('book', '').strip()
-                last_book = last_match.groupdict().get('book', '').strip()
-                if last_book != book:
-                    return last_ref
-
             # Check for a paragraph in the verse text.
             if self.paragraph_regx.search(verse_text):
                 return ref if inclusive else last_ref
@@ -569,47 +633,82 @@ class BiblesearchApp(object):
         return ref if inclusive else last_ref
 
 
-    def get_paragraph(self, verse_ref: str) -> str:
-        """ Finds and returns the paragraph that verse_ref belongs to.
+    def get_paragraph(self, verse_ref: str) -> tuple:
+        """ Finds and returns the span of verse ids of the paragraph that
+        verse_ref belongs to.
 
         """
 
-        # Get verses on either side to try and find the entire paragraph.
-        verse_list = sword_search.add_context([verse_ref], 200)
-        sorted_verse_list = sorted(verse_list, key=sword_search.sort_key)
+        verse_id = sword_search.verse_id(verse_ref)
 
-        # Get the index of this verse.
-        verse_index = sorted_verse_list.index(verse_ref)
+        # Assume paragraphs don't cross into other books, so only look at
+        # the verses on either side that are in the same book.
+        book_start, book_end = sword_search.book_span(verse_id)
 
         # Get the first half including the current reference.
-        first_half = reversed(sorted_verse_list[:verse_index + 1])
+        first_half = sword_search.span_refs((max(book_start, verse_id - 200),
+                                             verse_id))
 
         # Get the second half not including the current reference.
-        last_half = sorted_verse_list[verse_index + 1:]
+        last_half = sword_search.span_refs((verse_id + 1,
+                                            min(book_end, verse_id + 200)))
 
         # Find the start of the paragraph by searching backwards from the
         # target reference.
-        start_ref = self.find_paragraph(first_half, inclusive=True, default=verse_ref)
+        start_ref = self.find_paragraph(reversed(first_half), inclusive=True,
+                                        default=verse_ref)
 
         # Search forwards to find the end of the paragraph (start of the
         # next paragraph).
-        end_ref = self.find_paragraph(last_half, inclusive=False, default=verse_ref)
+        end_ref = self.find_paragraph(last_half, inclusive=False,
+                                      default=verse_ref)
 
-        # Make it a range.
-        return '%s-%s' % (start_ref, end_ref)
+        return (sword_search.verse_id(start_ref),
+                sword_search.verse_id(end_ref))
 
 
-    def lookup_verses(self, verse_refs, search_terms: str='', context=0):
-        """ Looks up the verses in verse_refs, highlights the search_terms, and
-        returns a list of verses adding context verses on either side of each.
+    def span_to_str(self, span: tuple) -> str:
+        """ Make a range string out of a span of verse ids.
+
+        """
+
+        start, end = span
+        return '%s-%s' % (sword_search.verse_ref(start),
+                          sword_search.verse_ref(end))
+
+
+    def spans_to_refs(self, span_list: list) -> list:
+        """ Returns a sorted list of all the references in the spans of verse
+        ids in span_list.
+
+        """
+
+        ref_list = []
+        last_end = -1
+        for start, end in sorted(span_list):
+            # Don't repeat verses of overlapping spans.
+            start = max(start, last_end + 1)
+            if start <= end:
+                ref_list.extend(sword_search.span_refs((start, end)))
+            last_end = max(last_end, end)
+
+        return ref_list
+
+
+    def parse_lookup(self, verse_refs, search_terms: str='', context=0):
+        """ Returns a tuple of the set of valid references in verse_refs, the
+        sorted list of them with their context, the search terms without any
+        strongs numbers, and the list of terms to highlight.
 
         """
 
         # Get a set of valid verse references asked for.
-        verse_refs = sword_search.parse_verse_range(verse_refs)
+        with stage(self.metrics, 'lookup.parse_range'):
+            verse_refs = sword_search.parse_verse_range(verse_refs)
 
         # Add the context.
-        verse_list = sword_search.add_context(verse_refs, context)
+        with stage(self.metrics, 'lookup.context'):
+            verse_list = sword_search.add_context(verse_refs, context)
 
         # Get a sorted list of the verse set, because it is faster to lookup
         # verses from a sorted list than from a randomized one.
@@ -625,70 +724,127 @@ class BiblesearchApp(object):
         terms_list = [''.join(i) for i in self.search_regx.findall(search_terms)]
         terms_list = [i for i in terms_list if not i.startswith('!')]
 
-        # The results list.
-        results_list = []
+        return verse_refs, verse_list, search_terms, terms_list
+
+
+    def lookup_tokens(self, verse_refs, search_terms: str='', context=0):
+        """ Looks up the verses in verse_refs and returns a dictionary of their
+        tokens, for the client to render and highlight itself.
+
+        """
+
+        verse_refs, verse_list, _, terms_list = \
+                self.parse_lookup(verse_refs, search_terms, context)
+
+        highlight_regx = build_highlight(terms_list)
+        kjv_lookup = sword_search.Lookup('KJV')
+
+        token_table = TokenTable()
+        with stage(self.metrics, 'render.tokens'):
+            for ref in verse_list:
+                highlight = ref in verse_refs
+                token_table.add_verse(ref, kjv_lookup.get_raw_text(ref),
+                                      highlight,
+                                      highlight_regx if highlight else None)
+
+        return token_table.to_dict()
+
+
+    def lookup_verses(self, verse_refs, search_terms: str='', context=0):
+        """ Looks up the verses in verse_refs, highlights the search_terms, and
+        returns a list of verses adding context verses on either side of each.
+
+        """
+
+        return list(self.iter_verses(verse_refs, search_terms, context))
+
+
+    def iter_verses(self, verse_refs, search_terms: str='', context=0):
+        """ Looks up the verses in verse_refs, highlights the search_terms, and
+        yields each verse as it is rendered, adding context verses on either
+        side of each.
+
+        """
+
+        verse_refs, verse_list, search_terms, terms_list = \
+                self.parse_lookup(verse_refs, search_terms, context)
+
         last_ref = ''
 
-        # Highlight colors.
-        highlight_text = '<span class="query-highlight">\\1</span>'
+        # Build a regular expression that can be used to highlight the search
+        # query in the output text.
+        highlight_regx = build_highlight(terms_list)
+
+        # The highlighted html of a verse depends only on the highlight regex.
+        highlight_key = (highlight_regx.pattern,
+                         highlight_regx.flags) if highlight_regx else None
+
+        # The raw text is only needed for the verses that get highlighted, or
+        # when the html has not been pre-rendered and is not in the cache.
+        kjv_lookup = sword_search.Lookup('KJV')
+
+        # The time spent getting, highlighting, and rendering the verses is
+        # added up and recorded once, when all the verses are done.
+        fetch_time = highlight_time = osis_time = 0.0
 
         # Build dictionary of verse references and text.
-        for ref, verse_text in sword_search.VerseTextIter(iter(verse_list),
-                                                        strongs=True, morph=True,
-                                                        render='raw'):
+        for ref in verse_list:
 
             # Highlight only in the verses found during the search, not in
             # any of the context verses.
-            if ref in verse_refs:
-                # Build a regular expression that can be used to highlight
-                # the search query in the output text.
-                reel = build_highlight_regx(terms_list, False,
-                                            color_tag='</?span[^>]*>',
-                                            extra_tag='</span>')
-
-                # Change all tags that contain the word strong to stronk so
-                # the highlighting will not break the html.
-                verse_text = re.sub(r'(stron)g(:|Morph:|sMarkup)', '\\1k\\2',
-                                    verse_text, flags=re.IGNORECASE)
-
-                # Apply the highlight regex to highlight the verse text.
-                verse_text = highlight_search_terms(verse_text, reel,
-                                                    highlight_text,
-                                                    color_tag='</?span[^>]*>')
-
-                # Change stronk back to strong.
-                verse_text = re.sub(r'(stron)k(:|Morph:|sMarkup)', '\\1g\\2',
-                                    verse_text, flags=re.IGNORECASE)
-
-            # Setup the verse text for highlighting and put the headings,
-            # notes, and paragraph markers in.
-            verse_text = self.tag_regx.sub(self.tag_func, verse_text)
-
-            if results_list and last_ref:
-                # last_ref = results_list[-1]['verseref']
+            highlight = ref in verse_refs and highlight_regx
+            verse_id = sword_search.verse_id(ref)
+
+            start = perf_counter()
+            if not highlight and self.verse_html:
+                # Nothing to highlight so just use the pre-rendered html.
+                verse_text = self.verse_html[verse_id]
+                fetch_time += perf_counter() - start
+            else:
+                cache_key = (verse_id, highlight_key if highlight else None)
+                verse_text = self.fragment_cache.get(cache_key)
+                if verse_text is None:
+                    verse_text = kjv_lookup.get_raw_text(ref)
+                    highlight_start = perf_counter()
+                    fetch_time += highlight_start - start
+                    if highlight:
+                        entry = (self.verse_plain[verse_id]
+                                 if self.verse_plain else '')
+                        verse_text = highlight_osis(verse_text,
+                                                    highlight_regx, entry)
+
+                    # Put the headings, notes, and paragraph markers in.
+                    osis_start = perf_counter()
+                    highlight_time += osis_start - highlight_start
+                    verse_text = render_osis(verse_text)
+                    osis_time += perf_counter() - osis_start
+                    self.fragment_cache[cache_key] = verse_text
+                else:
+                    fetch_time += perf_counter() - start
+
+            if last_ref:
                 last_book, _ = last_ref.rsplit(' ', 1)
                 cur_book, _ = ref.rsplit(' ', 1)
 
                 # Put a break between books.
                 if cur_book != last_book:
-                    results_list.append({
+                    yield {
                         "highlight": False,
                         "verseref": '',
                         "versetext": '',
-                    })
+                    }
 
             last_ref = ref
 
-            # Build a list of the results.
-            results_list.append({
+            yield {
                 "highlight": ref in verse_refs,
                 "verseref": ref if search_terms else '',
                 "versetext": verse_text,
-            })
+            }
 
-        # Return the list of results and the list of strongs numbers in the
-        # search query.
-        return results_list
+        self.metrics.observe_stage('render.fetch', fetch_time)
+        self.metrics.observe_stage('render.highlight', highlight_time)
+        self.metrics.observe_stage('render.osis', osis_time)
 
 
     def do_search(self, search_terms: str='', min_range: str="Genesis",
@@ -700,17 +856,31 @@ class BiblesearchApp(object):
 
         """
 
-        # Make a valid range string.
-        range_str = "%s-%s" % (min_range, max_range)
+        # Reuse the results if the same search was done recently.
+        rid = result_id(search_terms, min_range, max_range)
+        result = self.result_cache.get(rid)
+        if result:
+            sorted_verse_list = result['references']
+        else:
+            # Make a valid range string.
+            range_str = "%s-%s" % (min_range, max_range)
 
-        # Split the search terms in to '"' quoted groups.
-        terms_list = [''.join(i) for i in self.search_regx.findall(search_terms)]
+            # Split the search terms in to '"' quoted groups.
+            terms_list = [''.join(i) for i in self.search_regx.findall(search_terms)]
 
-        # Get a set of verse references that match the search criteria.
-        verse_set = self.bible_search.mixed_search(terms_list, range_str=range_str)
+            # Get a set of verse references that match the search criteria.
+            verse_set = self.bible_search.mixed_search(terms_list, range_str=range_str)
 
-        # Build the return list of dictionaries.
-        sorted_verse_list = sorted(verse_set, key=sword_search.sort_key)
+            # Build the return list of dictionaries.
+            with stage(self.metrics, 'search.sort'):
+                sorted_verse_list = sorted(verse_set,
+                                           key=sword_search.sort_key)
+
+            self.result_cache.add(search_terms, min_range, max_range,
+                                  sorted_verse_list)
+
+        # Let the javascript reuse the results.
+        response.set_header('X-Result-Id', rid)
 
         # Verse list cookie.
         response.set_cookie('search_terms', json.dumps(search_terms),
@@ -719,12 +889,150 @@ class BiblesearchApp(object):
         return sorted_verse_list
 
 
+    def warm_up_paths(self) -> list:
+        """ Return the paths of the requests to warm up the caches with.
+
+        """
+
+        queries, chapters = self.warm_up_queries, self.warm_up_chapters
+
+        filename = os.getenv('BIBLESEARCH_WARM_UP_FILE', '')
+        if filename:
+            try:
+                with open(filename, 'r') as warm_up_file:
+                    warm_up_dict = json.load(warm_up_file)
+                queries = warm_up_dict.get('queries', queries)
+                chapters = warm_up_dict.get('chapters', chapters)
+            except (OSError, ValueError) as err:
+                print("Error reading %s: %s" % (filename, err),
+                      file=sys.stderr)
+
+        top = int(os.getenv('BIBLESEARCH_WARM_UP_TOP', '10') or 0)
+
+        path_list = ['/biblesearch/books.json']
+        path_list.extend('/biblesearch/search.json?%s' % urlencode(
+                         {'search': i}) for i in queries[:top])
+        path_list.extend('/biblesearch/lookup.json?%s' % urlencode(
+                         {'verse_refs': i}) for i in chapters[:top])
+
+        return path_list
+
+
+    def warm_request(self, path: str):
+        """ Send a request for path through the compressed app, leaving out
+        the request metrics.
+
+        """
+
+        path_info, _, query = path.partition('?')
+        environ = {
+            'PATH_INFO': path_info,
+            'QUERY_STRING': query,
+            'HTTP_ACCEPT_ENCODING': 'gzip',
+            'wsgi.input': BytesIO(),
+        }
+        setup_testing_defaults(environ)
+
+        status_list = []
+
+        def start_response(status, headers, exc_info=None):
+            """ Save the status.
+
+            """
+
+            status_list.append(status)
+            return lambda data: None
+
+        body = self.compressed_app(environ, start_response)
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        if not status_list[0].startswith('200'):
+            print("Warming up %s returned %s." % (path, status_list[0]),
+                  file=sys.stderr)
+
+
+    def warm_up(self):
+        """ Open the search index and load its lower case map, then send the
+        books, top searches, and top chapters through the app, and set
+        app_ready.  This runs in warm_up_thread when the server starts.
+
+        """
+
+        try:
+            index_start = perf_counter()
+            self.bible_search.open()
+            self.metrics.set_gauge('biblesearch_index_open_seconds',
+                                   perf_counter() - index_start,
+                                   'Time to open the search index.')
+
+            cache_start = perf_counter()
+            for path in self.warm_up_paths():
+                self.warm_request(path)
+            self.metrics.set_gauge('biblesearch_warm_up_seconds',
+                                   perf_counter() - cache_start,
+                                   'Time to warm up the caches.')
+        except (Exception, SystemExit) as err:
+            # The index calls sys.exit when it is broken or missing.
+            self.warm_up_error = str(err) or err.__class__.__name__
+            print("Error warming up: %s" % self.warm_up_error,
+                  file=sys.stderr)
+        else:
+            self.app_ready.set()
+
+
+    def start_warm_up(self) -> threading.Thread:
+        """ Start warm_up in warm_up_thread, if it isn't started yet, and
+        return the thread.  run calls this, so making the app doesn't open
+        the index.  A server that forks should join the thread first, so
+        the processes share the index and caches.
+
+        """
+
+        if self.warm_up_thread is None:
+            self.warm_up_thread = threading.Thread(target=self.warm_up,
+                                                   name='warm_up',
+                                                   daemon=True)
+            self.warm_up_thread.start()
+
+        return self.warm_up_thread
+
+
+    def reopen_index(self):
+        """ Give a forked server process its own handle on the search index.
+        The index items already loaded and the mmap'd verse html stay shared
+        with the other processes.
+
+        """
+
+        index_start = perf_counter()
+        self.bible_search.reopen()
+        self.metrics.set_gauge('biblesearch_index_open_seconds',
+                               perf_counter() - index_start,
+                               'Time to open the search index.')
+        self.conditional.refresh()
+
+
+    def get_result(self, rid: str) -> dict:
+        """ Return the search result with the id rid, or an empty dict if
+        there is none.
+
+        """
+
+        return self.result_cache.get(rid, {}) if rid else {}
+
+
     def build_search_page(self, verse_list: str='', verses: str='',
                         strongs_morph: str='', context: int=0, min_range:
                         str="Genesis", max_range: str="Revelation", verse_ref:
                         str="Genesis 1:1", devotional_date: str="today",
-                        search_terms: str=""):
-        """ Build the search page and return a dictionary.
+                        search_terms: str="", rid: str=''):
+        """ Build the search page and return a dictionary.  The forms keep the
+        result id rid.
 
         """
 
@@ -734,7 +1042,8 @@ class BiblesearchApp(object):
                 'id': 'dcontext',
                 'href': '#',
                 'label': 'Context',
-                'value': context
+                'value': context,
+                'rid': rid
             },
             {
                 'name': 'range_dropdown',
@@ -742,14 +1051,16 @@ class BiblesearchApp(object):
                 'href': '#',
                 'label': 'Range',
                 'min_range': min_range,
-                'max_range': max_range
+                'max_range': max_range,
+                'rid': rid
             },
             {
                 'name': 'lookup_dropdown',
                 'id': 'dlookup',
                 'href': '#',
                 'label': 'Reference',
-                'reference': verse_ref
+                'reference': verse_ref,
+                'rid': rid
             },
             {
                 'name': 'devotional_dropdown',
@@ -760,48 +1071,65 @@ class BiblesearchApp(object):
             },
         ]
 
-        dropdowns = '\n'.join([template(i['name'], **i) for i in drop_list])
+        dropdowns = '\n'.join([dropdown_html(**i) for i in drop_list])
 
-        return template('biblesearch', verse_list=verse_list, verses=verses,
-                        strongs_morph=strongs_morph, dropdowns=dropdowns,
-                        search_terms=html_escape(search_terms))
+        return self.search_page.render(verse_list=verse_list, verses=verses,
+                                       strongs_morph=strongs_morph,
+                                       dropdowns=dropdowns,
+                                       search_terms=html_escape(search_terms))
 
 
-    def build_page(self, reference_list: list=[], search_terms: str='', context: int=0):
+    def build_page(self, reference_list: list=[], search_terms: str='', context: int=0,
+                   rid: str=''):
         """ Build a webpage of the verses in reference list with the words and
         phrases in search_terms highlighted.  A context is added to each verse.
+        The search and its range come from the result id rid if it is known,
+        otherwise from the cookies.
 
         """
 
         # Get cookie data to use in the page.
-        min_range = json.loads(request.get_cookie('min_range', '"Genesis"'))
-        max_range = json.loads(request.get_cookie('max_range', '"Revelation"'))
         verse_ref = json.loads(request.get_cookie('reference', '"Genesis 1:1"'))
         devotional_date = json.loads(request.get_cookie('devotional', '"today"'))
 
+        result = self.get_result(rid)
+        if result:
+            min_range = result['min_range']
+            max_range = result['max_range']
+            search_terms = search_terms or result['search_terms']
+            reference_list = reference_list or result['references']
+        else:
+            min_range = json.loads(request.get_cookie('min_range', '"Genesis"'))
+            max_range = json.loads(request.get_cookie('max_range', '"Revelation"'))
+
         if not search_terms:
             search_terms = json.loads(request.get_cookie('search_terms', '""'))
 
         if not reference_list and search_terms:
-            reference_list = do_search(search_terms, min_range=min_range,
-                                    max_range=max_range)
+            reference_list = self.do_search(search_terms, min_range=min_range,
+                                            max_range=max_range)
+
+        if search_terms and not result:
+            rid = result_id(search_terms, min_range, max_range)
 
         if not context:
             context = json.loads(request.get_cookie('context', '0'))
 
         verses = self.lookup_verses(reference_list, search_terms, context)
-        verses_html = template('verses', output=verses)
+        with stage(self.metrics, 'render.template'):
+            verses_html = template('verses', output=verses)
 
         # Build the result page.
         search_page_dict = {
-            'verse_list': self.build_verselist(','.join(reference_list)),
+            'verse_list': self.build_verselist(','.join(reference_list), rid),
             'verses': verses_html,
             'context': context,
             'min_range': min_range,
             'max_range': max_range,
             'verse_ref': verse_ref,
             'devotional_date': devotional_date,
-            'search_terms': search_terms
+            'search_terms': search_terms,
+            'rid': rid
         }
 
         return self.build_search_page(**search_page_dict)
@@ -812,9 +1140,12 @@ class BiblesearchApp(object):
 
         """
 
+        self.start_warm_up()
+
         if not self.daemon:
-            self.bible_app.run(host=gethostbyname(gethostname()), port=8081,
-                            reloader=True, server='tornado')
+            run(self.application, host=gethostbyname(gethostname()),
+                port=8081, reloader=True, server=AsyncTornadoServer,
+                workers=4, timeout=30)
         else:
             self.start_thread()
 
@@ -823,7 +1154,7 @@ class BiblesearchApp(object):
 
         """
 
-        self.thread = threading.Thread(target=self.bible_app.run, kwargs={"host":gethostbyname(gethostname()), "port":8081})
+        self.thread = threading.Thread(target=run, kwargs={"app": self.application, "host":gethostbyname(gethostname()), "port":8081})
         self.thread.daemon = self.daemon
         self.thread.start()
 
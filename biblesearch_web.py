@@ -3,37 +3,51 @@ gi_require_version('Gtk', '3.0')
 gi_require_version('WebKit2', '4.0')
 
 
-def server_proc():
-    """Create a process for the webserver and return the process."""
-    from multiprocessing import Process
+def serve(ready):
+    """Warm up the app, then serve it, and set the ready event once it is
+    listening.
+    """
     from socket import gethostbyname, gethostname
+    from bottle import run
 
+    # Import here, so the warm up runs in this process.
     import biblesearch_app
+    from server import AsyncTornadoServer
+
+    # The page is loaded once ready is set, so warm up first.  If the warm
+    # up fails, the error is printed and is in /readyz.
+    biblesearch_app.start_warm_up().join()
+
+    run(app=biblesearch_app.application,
+        host=gethostbyname(gethostname()), port=8081,
+        server=AsyncTornadoServer, workers=4, timeout=30,
+        listening=ready.set)
+
+
+def server_proc(ready):
+    """Create a process for the webserver and return the process."""
+    from multiprocessing import Process
 
-    return Process(target=biblesearch_app.bible_app.run,
-                   kwargs={"host": gethostbyname(gethostname()), "port": 8081,
-                           "server": "tornado"})
+    return Process(target=serve, args=(ready,))
 
 
 def webkit_window(url: str = 'http://127.0.1.1:8081', width: int = 1280,
                   height: int = 720):
     """Open the biblesearch webpage in a simple webkit window."""
     import os
-    import requests
+    from multiprocessing import Event
     from gi.repository import GLib, Gtk
     from gi.repository import WebKit2
 
-    proc = server_proc()
+    ready = Event()
+    proc = server_proc(ready)
     proc.start()
 
-    # Wait for the server to start before loading the page.
-    while True:
-        try:
-            _ = requests.get(url)
-        except requests.exceptions.ConnectionError:
-            continue
-        else:
-            break
+    # Wait for the server to start and warm up before loading the page.
+    while not ready.wait(0.5):
+        if not proc.is_alive():
+            raise SystemExit("The server exited with status %s before it was "
+                             "ready." % proc.exitcode)
 
     GLib.set_prgname('org.biblesearch.web')
     webview = WebKit2.WebView()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Response compression for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Wsgi middleware that compresses the html and json responses with gzip or
+deflate.  Streamed responses are compressed a chunk at a time, so they stay
+streamed.  Responses with an ETag always have the same body, so their
+compressed bodies are cached by ETag and only compressed once, and a route
+can send the cached body with cached_response without doing any work.
+Routes that never send the cached body call skip_cache, so theirs isn't
+stored.
+
+"""
+
+import zlib
+
+from bottle import HTTPResponse
+
+from static import accepted_encodings
+
+
+# The content types that are worth compressing.
+compress_types = ('text/html', 'text/plain', 'text/css', 'application/json',
+                  'application/x-ndjson', 'application/javascript',
+                  'text/javascript')
+
+# The zlib wbits for each encoding.
+encoding_wbits = {'gzip': 31, 'deflate': 15}
+
+# The environ key for the cache and the encoding of the request.
+environ_key = 'biblesearch.compress'
+
+
+class CompressedBody(bytes):
+    """ A compressed response body that remembers its content type.
+
+    """
+
+    content_type = ''
+
+
+def weak_etag(etag: str) -> str:
+    """ The compressed body is different from the plain one, so its ETag is
+    weak.  The conditional requests compare them weakly.
+
+    """
+
+    return etag if etag.startswith('W/') else 'W/%s' % etag
+
+
+def cached_response(environ: dict, etag: str, headers: dict) -> object:
+    """ Return a response with the cached compressed body of the response
+    tagged etag, or None if it isn't cached.
+
+    """
+
+    cache, encoding = environ.get(environ_key, (None, ''))
+    if cache is None:
+        return None
+
+    compressed = cache.get((etag, encoding))
+    if compressed is None:
+        return None
+
+    headers = dict(headers, ETag=weak_etag(etag))
+    headers['Content-Encoding'] = encoding
+    headers['Content-Type'] = compressed.content_type
+    headers['Vary'] = ', '.join(filter(None, (headers.get('Vary', ''),
+                                              'Accept-Encoding')))
+    # Servers like wsgiref only take bytes itself, not a subclass.
+    return HTTPResponse(bytes(compressed), headers=headers)
+
+
+def skip_cache(environ: dict):
+    """ Don't cache the compressed body of this response.  It is for routes
+    that never send the cached body, so it would only push other things out
+    of the cache.
+
+    """
+
+    if environ_key in environ:
+        environ[environ_key] = (None, environ[environ_key][1])
+
+
+class Compress(object):
+    """ Compress the responses of a wsgi app that are at least min_size
+    bytes, with the zlib level.  The compressed bodies of responses with an
+    ETag are stored in cache, if it is given.
+
+    """
+
+    def __init__(self, app: object, min_size: int=1024, level: int=6,
+                 cache: object=None):
+        """ Wrap app.
+
+        """
+
+        self._app = app
+        self._min_size = min_size
+        self._level = level
+        self._cache = cache
+
+    def __call__(self, environ: dict, start_response: object) -> iter:
+        """ Call the app, and compress its response if the client accepts
+        it.
+
+        """
+
+        accept = accepted_encodings(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        encoding = next((i for i in ('gzip', 'deflate') if i in accept), '')
+        if not encoding or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self._app(environ, start_response)
+
+        environ[environ_key] = (self._cache, encoding)
+
+        response = []
+
+        def save_response(status, headers, exc_info=None):
+            """ Hold on to the status and headers until it is known whether
+            the body gets compressed.
+
+            """
+
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response[:] = [status, headers]
+            return lambda data: None
+
+        body = self._app(environ, save_response)
+        status, headers = response
+
+        header_dict = {name.lower(): value for name, value in headers}
+        content_type = header_dict.get('content-type', '').split(';')[0]
+        length = int(header_dict.get('content-length', self._min_size))
+        if (not status.startswith('200') or length < self._min_size or
+                'content-encoding' in header_dict or
+                content_type.strip() not in compress_types):
+            start_response(status, headers)
+            return body
+
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'etag', 'vary')]
+        headers.append(('Content-Encoding', encoding))
+        headers.append(('Vary', ', '.join(filter(None, (
+            header_dict.get('vary', ''), 'Accept-Encoding')))))
+
+        etag = header_dict.get('etag', '')
+        if etag:
+            headers.append(('ETag', weak_etag(etag)))
+
+        # The route may have asked for its body not to be cached.
+        cached = etag and environ[environ_key][0] is not None
+
+        start_response(status, headers)
+        return self._compress_iter(body, encoding,
+                                   (etag, encoding) if cached else None,
+                                   header_dict.get('content-type', ''))
+
+    def _compress_iter(self, body: iter, encoding: str, key: tuple,
+                       content_type: str) -> iter:
+        """ Compress and yield each chunk of body as soon as it is made, and
+        cache the whole compressed body under key.
+
+        """
+
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                      encoding_wbits[encoding])
+        chunk_list = []
+
+        try:
+            for chunk in body:
+                if not chunk:
+                    continue
+                # Flush each chunk, so the client gets it now instead of
+                # when the compressor's buffer fills.
+                data = compressor.compress(chunk)
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                chunk_list.append(data)
+                yield data
+
+            data = compressor.flush()
+            chunk_list.append(data)
+            yield data
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        if key and self._cache is not None:
+            compressed = CompressedBody(b''.join(chunk_list))
+            compressed.content_type = content_type
+            self._cache[key] = compressed
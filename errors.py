@@ -18,7 +18,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from bottle import redirect, error, jinja2_template as template
+from bottle import redirect, error
+
+# Use the shared settings, so the templates can link to the assets.
+from templates import template
 
 
 def errors(error):
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Conditional request handling for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" ETags and Last-Modified headers for responses that only change when the
+index or the templates are rebuilt.  A request that already has the current
+response gets a 304 before any lookup or render work is done.
+
+"""
+
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from functools import wraps
+from hashlib import sha1
+import os
+
+from bottle import request, response, HTTPResponse
+
+from compress import cached_response, skip_cache, weak_etag, environ_key
+from static import etag_matches
+
+
+def content_version(*dir_list) -> tuple:
+    """ Return a hash of the names, sizes, and modification times of the
+    files in the directories in dir_list, and the latest modification time.
+    Any rebuild of the files changes the hash.
+
+    """
+
+    version = sha1()
+    last_modified = 0
+
+    for dir_name in dir_list:
+        if not os.path.isdir(dir_name):
+            continue
+        for entry in sorted(os.scandir(dir_name), key=lambda i: i.name):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            version.update(('%s:%s:%s\n' % (entry.name, stat.st_size,
+                                            stat.st_mtime)).encode())
+            last_modified = max(last_modified, int(stat.st_mtime))
+
+    return version.hexdigest()[:16], last_modified
+
+
+class Conditional(object):
+    """ Makes decorators that give a route an ETag built from the content
+    version and its normalized query, and answer conditional requests with
+    a 304.
+
+    """
+
+    def __init__(self, *dir_list):
+        """ Get the version of the files in dir_list.
+
+        """
+
+        self._dir_list = dir_list
+        self.refresh()
+
+    def refresh(self):
+        """ Update the version after the files are rebuilt.
+
+        """
+
+        self.version, self.last_modified = content_version(*self._dir_list)
+
+    def etag(self, *key_list) -> str:
+        """ Return the ETag for a response that depends on key_list.
+
+        """
+
+        key = '\0'.join(str(i) for i in (request.path,) + key_list)
+        return '"%s-%s"' % (self.version, sha1(key.encode()).hexdigest()[:16])
+
+    def not_modified(self, etag: str, last_modified: int) -> bool:
+        """ Check if the client already has the response.
+
+        """
+
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match:
+            # Compare weakly, since a compressed response may be tagged W/.
+            return etag_matches(if_none_match, etag)
+
+        if_modified_since = request.headers.get('If-Modified-Since', '')
+        if if_modified_since and last_modified:
+            date = parsedate_tz(if_modified_since)
+            return bool(date) and mktime_tz(date) >= last_modified
+
+        return False
+
+    def headers_304(self, etag: str, headers: dict) -> dict:
+        """ Return the headers of a 304 for the response tagged etag.  The
+        ETag is weak, like the one on the compressed response, if the
+        client has the compressed response, or would get it.
+
+        """
+
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match:
+            compressed = weak_etag(etag) in if_none_match
+        else:
+            compressed = environ_key in request.environ
+
+        if not compressed:
+            return headers
+
+        return dict(headers, ETag=weak_etag(etag),
+                    Vary=', '.join(filter(None, (headers.get('Vary', ''),
+                                                 'Accept-Encoding'))))
+
+    def __call__(self, cache_control: str='public, max-age=86400',
+                 ext_list: tuple=('.json',), cookie_list: tuple=(),
+                 key_func: object=None, accept_func: object=None,
+                 send_cached: bool=True) -> object:
+        """ Return a decorator for routes whose ext is in ext_list.  The
+        ETag depends on the query, the cookies in cookie_list, what key_func
+        returns, and what accept_func returns for the request.  Routes with
+        a key_func don't get Last-Modified, since they change without the
+        files changing, and neither do routes that vary on cookies or the
+        Accept header, since If-Modified-Since can't tell which version the
+        client has.  accept_func is for routes that pick the
+        representation from the Accept header, so they vary on it.  The
+        cached compressed body is sent without calling the route, so routes
+        that set cookies pass send_cached=False, and their compressed bodies
+        aren't cached.
+
+        """
+
+        def decorator(func):
+            """ Wrap func with the conditional request handling.
+
+            """
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                """ Send a 304 or call func with the cache headers set.
+
+                """
+
+                if kwargs.get('ext', '') not in ext_list:
+                    return func(*args, **kwargs)
+
+                # Normalize the query so equivalent urls share one ETag.
+                query = sorted((k, v.replace('+', ' ').strip())
+                               for k, v in request.query.allitems())
+                cookies = [request.get_cookie(i, '') for i in cookie_list]
+                extra = key_func() if key_func else ''
+                accept = accept_func(request) if accept_func else ''
+                etag = self.etag(query, cookies, extra, accept)
+                varies = key_func or cookie_list or accept_func
+                last_modified = 0 if varies else self.last_modified
+
+                headers = {'ETag': etag, 'Cache-Control': cache_control}
+                if last_modified:
+                    headers['Last-Modified'] = formatdate(last_modified,
+                                                          usegmt=True)
+                vary_list = []
+                if cookie_list:
+                    vary_list.append('Cookie')
+                if accept_func:
+                    vary_list.append('Accept')
+                if vary_list:
+                    headers['Vary'] = ', '.join(vary_list)
+
+                if self.not_modified(etag, last_modified):
+                    return HTTPResponse(status=304,
+                                        headers=self.headers_304(etag,
+                                                                 headers))
+
+                # Send the compressed body if it is already cached.
+                if send_cached:
+                    cached = cached_response(request.environ, etag, headers)
+                    if cached:
+                        return cached
+                else:
+                    skip_cache(request.environ)
+
+                for name, value in headers.items():
+                    response.set_header(name, value)
+
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Request and stage metrics for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Latency histograms for every route and every timed stage of a request,
+and the counters of all the caches, in the Prometheus text format.
+Recording a time is only a few additions, and the text is only made when
+/metrics is requested.  The stages of each request are also added up
+separately and sent back in its Server-Timing header, and in its json when
+the query has debug=timing.
+
+"""
+
+from collections import defaultdict
+from functools import wraps
+from bisect import bisect_left
+from threading import Lock, local
+from time import perf_counter
+import resource
+import json
+import os
+
+from bottle import request, response
+
+
+# The upper bounds in seconds of the histogram buckets.
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """ Counts observations in buckets by their upper bound.
+
+    """
+
+    def __init__(self, buckets: tuple=default_buckets):
+        """ Make the empty buckets.
+
+        """
+
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        """ Count value in its bucket.
+
+        """
+
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def samples(self, name: str, labels: str) -> list:
+        """ Return the lines of the histogram as name with labels.
+
+        """
+
+        with self._lock:
+            counts = self._counts[:]
+            total = self._sum
+
+        sep = ',' if labels else ''
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self._buckets + ('+Inf',), counts):
+            count += bucket_count
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep,
+                                                       bound, count))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %r' % (name, labels, total))
+        lines.append('%s_count%s %d' % (name, labels, count))
+
+        return lines
+
+
+def _label_str(label_dict: dict) -> str:
+    """ Format the labels in label_dict.
+
+    """
+
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                    for key, value in sorted(label_dict.items()))
+
+
+def process_rss() -> int:
+    """ Return the resident memory of this process in bytes.
+
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Fall back to the peak, which is in kilobytes on linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics(object):
+    """ Holds the request and stage histograms, and the functions that get
+    the cache counters.
+
+    """
+
+    def __init__(self):
+        """ Start with nothing recorded.
+
+        """
+
+        self._requests = defaultdict(Histogram)
+        self._stages = defaultdict(Histogram)
+        self._gauges = {}
+        self._caches = {}
+        self._lock = Lock()
+        self._first_request = True
+
+        # The stage times of the request being handled by each thread.
+        self._local = local()
+
+    def observe_request(self, route: str, method: str, status: str,
+                        seconds: float):
+        """ Record the time a request took.
+
+        """
+
+        if self._first_request:
+            # It includes opening anything that wasn't warmed up yet.
+            self._first_request = False
+            self.set_gauge('biblesearch_first_request_seconds', seconds,
+                           'Time the first request took.')
+
+        key = (route, method, status)
+        histogram = self._requests.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._requests[key]
+        histogram.observe(seconds)
+
+    def observe_stage(self, name: str, seconds: float):
+        """ Record the time a stage took.
+
+        """
+
+        histogram = self._stages.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages[name]
+        histogram.observe(seconds)
+
+        timing = getattr(self._local, 'timing', None)
+        if timing is not None:
+            timing[name] = timing.get(name, 0.0) + seconds
+
+    def start_request(self):
+        """ Start adding up the stages of a new request in this thread.
+
+        """
+
+        self._local.timing = {}
+        self._local.start = perf_counter()
+
+    def end_request(self):
+        """ Stop adding up stages in this thread.  Stages that run later,
+        while a streamed body is sent, only go in the histograms.
+
+        """
+
+        self._local.timing = None
+
+    def request_timing(self) -> dict:
+        """ Return the milliseconds spent in each stage of the request in
+        this thread so far, and the total.
+
+        """
+
+        timing = getattr(self._local, 'timing', None)
+        if timing is None:
+            return {}
+
+        timing_dict = {name: round(seconds * 1000, 3)
+                       for name, seconds in timing.items()}
+        timing_dict['total'] = round((perf_counter() - self._local.start) *
+                                     1000, 3)
+
+        return timing_dict
+
+    def server_timing(self) -> str:
+        """ Return the Server-Timing header of the request in this thread.
+
+        """
+
+        return ', '.join('%s;dur=%s' % item
+                         for item in self.request_timing().items())
+
+    def set_gauge(self, name: str, value: float, help_text: str=''):
+        """ Set the gauge name to value.
+
+        """
+
+        self._gauges[name] = (value, help_text)
+
+    def add_cache(self, name: str, stats_func: object):
+        """ Add a cache whose stats_func returns a dict with hits and misses,
+        and optionally evictions.  A functools.lru_cache cache_info function
+        works too.
+
+        """
+
+        self._caches[name] = stats_func
+
+    def _cache_stats(self) -> dict:
+        """ Return the stats of every cache as dicts.
+
+        """
+
+        stats_dict = {}
+        for name, stats_func in sorted(self._caches.items()):
+            stats = stats_func()
+            if hasattr(stats, '_asdict'):
+                stats = stats._asdict()
+            stats_dict[name] = stats
+
+        return stats_dict
+
+    def render(self) -> str:
+        """ Return all the metrics in the Prometheus text format.
+
+        """
+
+        lines = [
+            '# HELP biblesearch_request_seconds Time to handle a request.',
+            '# TYPE biblesearch_request_seconds histogram',
+        ]
+        for (route, method, status), histogram in sorted(
+                self._requests.items()):
+            labels = _label_str({'route': route, 'method': method,
+                                 'status': status})
+            lines.extend(histogram.samples('biblesearch_request_seconds',
+                                           labels))
+
+        lines.extend([
+            '# HELP biblesearch_stage_seconds Time spent in each stage.',
+            '# TYPE biblesearch_stage_seconds histogram',
+        ])
+        for name, histogram in sorted(self._stages.items()):
+            lines.extend(histogram.samples('biblesearch_stage_seconds',
+                                           _label_str({'stage': name})))
+
+        cache_stats = self._cache_stats()
+        for key in ('hits', 'misses', 'evictions'):
+            metric = 'biblesearch_cache_%s_total' % key
+            lines.append('# TYPE %s counter' % metric)
+            for name, stats in cache_stats.items():
+                if key in stats:
+                    lines.append('%s{%s} %s' % (metric,
+                                                _label_str({'cache': name}),
+                                                stats[key]))
+
+        gauges = dict(self._gauges)
+        gauges['process_resident_memory_bytes'] = (
+            process_rss(), 'Resident memory size in bytes.')
+        for name, (value, help_text) in sorted(gauges.items()):
+            if help_text:
+                lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class stage(object):
+    """ Times the code in a with statement and records it as the stage
+    name.
+
+    """
+
+    __slots__ = ('_metrics', '_name', '_start')
+
+    def __init__(self, metrics: Metrics, name: str):
+        """ Set the stage name.
+
+        """
+
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        """ Start the timer.
+
+        """
+
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Record the time.
+
+        """
+
+        self._metrics.observe_stage(self._name, perf_counter() - self._start)
+        return False
+
+
+class RequestMetrics(object):
+    """ Wsgi middleware that records the time each request takes, including
+    sending a streamed body, by the bottle route that handled it, and sends
+    the stage times in the Server-Timing header.
+
+    """
+
+    def __init__(self, app: object, metrics: Metrics):
+        """ Wrap app.
+
+        """
+
+        self._app = app
+        self._metrics = metrics
+
+    def __call__(self, environ: dict, start_response: object) -> iter:
+        """ Call the app and time it.
+
+        """
+
+        start = perf_counter()
+        status_list = []
+
+        def save_status(status, headers, exc_info=None):
+            """ Remember the status code, and add the stage times.
+
+            """
+
+            status_list[:] = [status.split(' ', 1)[0]]
+            server_timing = self._metrics.server_timing()
+            if server_timing:
+                headers = headers + [('Server-Timing', server_timing)]
+            return start_response(status, headers, exc_info)
+
+        self._metrics.start_request()
+        try:
+            body = self._app(environ, save_status)
+        except Exception:
+            self._observe(environ, '500', start)
+            raise
+        finally:
+            self._metrics.end_request()
+
+        return self._timed_iter(body, environ, status_list, start)
+
+    def _observe(self, environ: dict, status: str, start: float):
+        """ Record the time since start for the route in environ.
+
+        """
+
+        route = environ.get('bottle.route')
+        self._metrics.observe_request(route.rule if route else 'none',
+                                      environ.get('REQUEST_METHOD', ''),
+                                      status, perf_counter() - start)
+
+    def _timed_iter(self, body: iter, environ: dict, status_list: list,
+                    start: float) -> iter:
+        """ Yield the body, and record the time when it is all sent.
+
+        """
+
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._observe(environ, status_list[0] if status_list else '500',
+                          start)
+
+
+def debug_timing(metrics: Metrics) -> object:
+    """ Return a bottle plugin that adds the stage times to the json of a
+    route, when the query has debug=timing.  A streamed json body is made
+    all at once so its stages are in the timing, and a streamed ndjson body
+    gets a last line with the timing.  Those responses don't get an ETag,
+    so they are never cached.
+
+    """
+
+    def plugin(callback):
+        """ Wrap the route callback.
+
+        """
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            """ Add the timing to the json callback returns.
+
+            """
+
+            body = callback(*args, **kwargs)
+            if request.query.debug != 'timing':
+                return body
+
+            content_type = response.content_type.split(';')[0].strip()
+            if isinstance(body, dict):
+                body = dict(body, timing=metrics.request_timing())
+            elif not hasattr(body, '__next__'):
+                return body
+            elif content_type == 'application/json':
+                body = json.loads(''.join(body))
+                body['timing'] = metrics.request_timing()
+            elif content_type == 'application/x-ndjson':
+                body = ''.join(body)
+                body += '%s\n' % json.dumps({'timing':
+                                              metrics.request_timing()})
+            else:
+                return body
+
+            for name in ('ETag', 'Last-Modified'):
+                response.headers.pop(name, None)
+            response.set_header('Cache-Control', 'no-store')
+
+            return body
+
+        return wrapper
+
+    return plugin
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Live request profiling for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A bottle plugin that profiles live requests, set up with environment
+variables:
+
+    BIBLESEARCH_PROFILE_EVERY   -   Profile one request in this many.
+    BIBLESEARCH_PROFILE_TOKEN   -   Profile a request with ?profile=1 if it
+                                    has this in its X-Profile-Token header.
+    BIBLESEARCH_PROFILE_OUTPUT  -   pstats for cProfile stats, or collapsed
+                                    to sample the stack into a file for
+                                    flamegraph.pl.
+    BIBLESEARCH_PROFILE_DIR     -   Where to write the profiles.
+
+With neither of the first two set, the routes aren't touched.  Only one
+request is profiled at a time, and each profile is named by its route and
+normalized query, which are also listed in profiles.log.
+
+"""
+
+from os.path import join, dirname, basename
+from collections import Counter
+from urllib.parse import urlencode
+from threading import Lock, Thread, get_ident
+from functools import wraps
+from hashlib import sha1
+from time import strftime, sleep
+import itertools
+import cProfile
+import hmac
+import sys
+import os
+import re
+
+from bottle import request
+
+
+profile_path = join(dirname(__file__), 'cache', 'profiles')
+
+
+def normalized_query(query: object) -> str:
+    """ Return the query sorted and stripped, without the profile key.
+
+    """
+
+    return urlencode(sorted((key, value.strip())
+                            for key, value in query.allitems()
+                            if key != 'profile'))
+
+
+class StatsSession(object):
+    """ Profiles the deterministic way with cProfile.  It is enabled only
+    while the request's code is running, so the time spent waiting to send
+    a streamed body is left out.
+
+    """
+
+    ext = '.pstats'
+
+    def __init__(self):
+        """ Make the profiler.
+
+        """
+
+        self._profile = cProfile.Profile()
+
+    def __enter__(self):
+        """ Start profiling the current thread.
+
+        """
+
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Stop profiling.
+
+        """
+
+        self._profile.disable()
+        return False
+
+    def write(self, filename: str, label: str):
+        """ Write the stats to filename.
+
+        """
+
+        self._profile.dump_stats(filename)
+
+
+class SampleSession(object):
+    """ Samples the stack of the thread running the request every interval
+    seconds, and writes them as collapsed stacks.
+
+    """
+
+    ext = '.collapsed'
+
+    def __init__(self, interval: float=0.001):
+        """ Start the sampling thread.
+
+        """
+
+        self._interval = interval
+        self._stacks = Counter()
+        self._target = None
+        self._running = True
+        self._thread = Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        """ Add the stack of the target thread to the counts.
+
+        """
+
+        while self._running:
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append('%s (%s:%s)' % (code.co_name,
+                                             basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
+            sleep(self._interval)
+
+    def __enter__(self):
+        """ Sample the current thread.
+
+        """
+
+        self._target = get_ident()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Stop sampling.
+
+        """
+
+        self._target = None
+        return False
+
+    def write(self, filename: str, label: str):
+        """ Stop the sampling thread and write the stacks to filename, each
+        under label.
+
+        """
+
+        self._running = False
+        self._thread.join()
+
+        # Frame names can't have the separators in them.
+        label = label.replace(';', ',').replace(' ', '_')
+        with open(filename, 'w') as out_file:
+            for stack, count in sorted(self._stacks.items()):
+                out_file.write('%s;%s %d\n' % (label, stack, count))
+
+
+class Profiler(object):
+    """ A bottle plugin that profiles one request in every, or the
+    requests with ?profile=1 and the token, and writes the profiles in
+    path.
+
+    """
+
+    def __init__(self, every: int=None, token: str=None, output: str=None,
+                 path: str=None):
+        """ Fill in the settings not given from the environment.
+
+        """
+
+        if every is None:
+            every = int(os.getenv('BIBLESEARCH_PROFILE_EVERY', '0') or 0)
+        if token is None:
+            token = os.getenv('BIBLESEARCH_PROFILE_TOKEN', '')
+        if output is None:
+            output = os.getenv('BIBLESEARCH_PROFILE_OUTPUT', 'pstats')
+        if path is None:
+            path = os.getenv('BIBLESEARCH_PROFILE_DIR', profile_path)
+
+        self._every = every
+        self._token = token
+        self._session_type = SampleSession if output == 'collapsed' \
+                else StatsSession
+        self._path = path
+
+        self._counter = itertools.count(1)
+
+        # cProfile can't profile two threads at once.
+        self._lock = Lock()
+
+    def enabled(self) -> bool:
+        """ Check if any request could be profiled.
+
+        """
+
+        return bool(self._every or self._token)
+
+    def wanted(self) -> bool:
+        """ Check if the current request should be profiled.
+
+        """
+
+        if self._every and next(self._counter) % self._every == 0:
+            return True
+
+        if self._token and request.query.profile == '1':
+            return hmac.compare_digest(request.get_header('X-Profile-Token',
+                                                          ''),
+                                       self._token)
+
+        return False
+
+    def __call__(self, callback: object) -> object:
+        """ Wrap callback to profile it when wanted.
+
+        """
+
+        if not self.enabled():
+            return callback
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            """ Profile callback and the body it returns.
+
+            """
+
+            if not self.wanted() or not self._lock.acquire(blocking=False):
+                return callback(*args, **kwargs)
+
+            rule = request.route.rule
+            label = '%s %s?%s' % (request.method, rule,
+                                  normalized_query(request.query))
+
+            session = self._session_type()
+            try:
+                with session:
+                    body = callback(*args, **kwargs)
+            except BaseException:
+                self._finish(session, rule, label)
+                raise
+
+            if hasattr(body, '__next__'):
+                # Keep profiling while the streamed body is made.
+                return self._profile_iter(body, session, rule, label)
+
+            self._finish(session, rule, label)
+            return body
+
+        return wrapper
+
+    def _profile_iter(self, body: iter, session: object, rule: str,
+                      label: str) -> iter:
+        """ Yield the chunks of body, profiling the making of each one.
+
+        """
+
+        try:
+            while True:
+                with session:
+                    try:
+                        chunk = next(body)
+                    except StopIteration:
+                        break
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._finish(session, rule, label)
+
+    def _finish(self, session: object, rule: str, label: str):
+        """ Write the profile, named by the route and query, and let the
+        next request be profiled.
+
+        """
+
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            name = '%s-%s-%s-%s%s' % (
+                strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                re.sub(r'\W+', '_', rule).strip('_') or 'index',
+                sha1(label.encode()).hexdigest()[:8], session.ext)
+            session.write(join(self._path, name), label)
+
+            with open(join(self._path, 'profiles.log'), 'a') as log_file:
+                log_file.write('%s\t%s\n' % (name, label))
+        except OSError as err:
+            print("Error writing profile of %s: %s" % (label, err),
+                  file=sys.stderr)
+        finally:
+            self._lock.release()
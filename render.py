@@ -0,0 +1,674 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Render the OSIS markup in raw sword KJV verse text to html.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A single pass OSIS to html renderer and search term highlighter.
+
+render_osis produces the same html as substituting tag_regx with tag_func
+(kept in benchmarks/osis_regex.py), but it walks the text once with a stack
+instead of recursively running the substitution on the text of every nested
+tag.
+
+highlight_osis marks the words that match the search terms.  It searches
+the text with each tag replaced by one character, which is a quarter of
+the length, with the one regular expression build_highlight compiles for
+all the verses.  Splitting the tags out is most of the work, so the plain
+entry of every verse (the replaced text and the tag offsets) is written to
+a table with the pre-rendered html.  Texts without one are split when they
+are highlighted, and the split text of recent ones is cached.
+
+"""
+
+from collections import OrderedDict
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate, count
+from operator import sub
+from threading import Lock
+import sys
+import re
+
+
+# Finds every start, end, and empty tag.
+token_regx = re.compile(r'<(/?)([A-Za-z]+)([^>]*)>')
+
+# Seperates tag attributes into the attribute name and its value.
+attr_regx = re.compile(r'''\s*(?P<name>[^=]+)="(?P<value>[^"]+)\s*"''')
+
+# Split a reference into book, chapter, and verse groups.
+ref_regx = re.compile(r'''
+    (?P<book>\d?[^\d-]+)
+    \s*
+    (?P<chap>[\d,-]*)
+    :
+    (?P<verse>[\d,-]*)
+    ''', re.X)
+
+# The tags that are rendered, in the spellings tag_regx accepts.
+tag_names = {
+    'seg', 'Seg', 'note', 'Note', 'w', 'W', 'milestone', 'Milestone',
+    'foreign', 'Foreign', 'title', 'Title', 'transChange', 'transchange',
+    'divineName', 'divinename', 'scripRef', 'scripref', 'q', 'Q',
+}
+
+# Tags whose text is rendered too.  The text of any other tag is used as is.
+nested_tags = {'w', 'seg', 'title', 'q'}
+
+# Splits the text into tags and the text between them.
+tag_split_regx = re.compile(r'(<[^>]*>)')
+
+# Stands for each tag in the text that is searched for the highlighted
+# words.  The regular expressions see it as white space, the same as the
+# tag, and since it is never in the verse text the tags before a match can
+# be counted.
+tag_mark = '\x1f'
+
+# Separates the text from the tag offsets in a plain entry.
+plain_sep = '\x1e'
+
+# Finds each word.
+word_regx = re.compile(r'\w+')
+
+# Splits a search term into its words.  The *'s are kept for partial words.
+term_word_regx = re.compile(r'[\w\*]+')
+
+# Wraps a highlighted word.
+highlight_html = '<span class="query-highlight">%s</span>'
+
+# Splits the text between tags into words and punctuation, and the white
+# space before each.
+text_token_regx = re.compile(r'(\s*)(\w+|[^\w\s]+)')
+
+# Removes the 'strong:' and 'robinson:' prefixes from word attributes.
+attr_prefix_regx = re.compile(r'\b\w+:')
+
+# The token flags.
+FLAG_SPACE = 1          # There is white space before the token.
+FLAG_ADDED = 2          # Text added by the translators.
+FLAG_DIVINE = 4         # The divine name.
+FLAG_RED = 8            # The words of Christ.
+FLAG_TITLE = 16         # A title or heading.
+FLAG_NOTE = 32          # A note.
+FLAG_PARAGRAPH = 64     # A paragraph marker.
+
+# The flags set on the text inside each tag.
+tag_flags = {
+    'divinename': FLAG_DIVINE,
+    'q': FLAG_RED,
+    'title': FLAG_TITLE,
+    'note': FLAG_NOTE,
+}
+
+
+def _scripref_html(passage_str: str, text: str) -> str:
+    """ Make a scripRef into a verse list link.
+
+    """
+
+    passage_href = 'href="/biblesearch/lookup?verse_refs=%s">%s</a>'
+    passage_a = '<a class="verseref verselist" ' + passage_href
+    ref_list = []
+    last_book = ''
+    for book, chapter, verse in ref_regx.findall(passage_str.strip()):
+        book = book.strip()
+        if not book:
+            book = last_book
+        last_book = book
+        # Attempt to fix the book name to destinguish between Judges
+        # and Jude.
+        if book.lower() == 'jud':
+            book = 'Judg'
+            text = text.replace('Jud ', 'Judg ')
+        ref_list.append('%s+%s:%s' % (book, chapter, verse))
+    refs = ';'.join(ref_list)
+
+    return passage_a % (refs, text)
+
+
+def render_tag(tag: str, attr: str, text: str) -> str:
+    """ Return the html for one tag.  tag is the lowercase tag name, attr is
+    the raw attribute string, and text is the (already rendered) tag text.
+
+    """
+
+    if tag == 'w':
+        # The word attributes keep their case.
+        attr_dict = dict(attr_regx.findall(attr)) if attr else {}
+        word_span = '<span class="word" '
+        if 'lemma' in attr_dict:
+            word_span += 'data-lemma="%s" ' % attr_dict['lemma']
+        if 'morph' in attr_dict:
+            word_span += 'data-morph="%s"' % attr_dict['morph']
+        return '%s>%s</span>' % (word_span, text)
+    if tag == 'seg':
+        return '<span class="seg">%s</span>' % text
+    if tag == 'q':
+        return '<span class="red-quote">%s</span>' % text
+    if tag == 'divinename':
+        return '<span class="divine-name">%s</span>' % text
+    if tag == 'title':
+        return '<span class="title-text">%s</span> ' % text
+    if tag == 'note':
+        return '<span class="note">%s</span>' % text
+
+    attr_dict = dict(attr_regx.findall(attr.lower())) if attr else {}
+
+    if tag == 'transchange':
+        if attr_dict.get('type', '') == 'added':
+            return '<span class="added-text">%s</span>' % text
+    elif tag == 'milestone':
+        if 'marker' in attr_dict:
+            return '<span class="paragraph-marker">%s</span> %s' % \
+                    (attr_dict['marker'], text)
+    elif tag == 'foreign':
+        if 'n' in attr_dict:
+            return '<span class="foreign-text">%s</span> %s' % \
+                    (attr_dict['n'], text)
+    elif tag == 'scripref':
+        return _scripref_html(attr_dict.get('passage', ''), text)
+
+    # Anything else is dropped.
+    return ''
+
+
+def render_osis(text: str) -> str:
+    """ Render the OSIS tags in text to html in one pass.
+
+    """
+
+    # Each stack item holds the tag name, its attributes, its start tag
+    # text, and the output list of its parent.
+    stack = []
+    open_names = set()
+    output = []
+
+    # last is the start of the text that has not been output yet.
+    last = pos = 0
+    search = token_regx.search
+    while True:
+        match = search(text, pos)
+        if not match:
+            break
+
+        start, pos = match.span()
+        is_end, name, attr = match.groups()
+        if name not in tag_names:
+            continue
+
+        if is_end:
+            if name not in open_names:
+                continue
+
+            output.append(text[last:start])
+            last = pos
+
+            # Anything opened inside this tag that was not closed is
+            # left as it was.
+            while stack[-1][0] != name:
+                output = _unwind(stack, open_names, output)
+
+            _, attr, _, parent = stack.pop()
+            open_names.discard(name)
+            parent.append(render_tag(name.lower(), attr, ''.join(output)))
+            output = parent
+        elif attr.endswith('/'):
+            output.append(text[last:start])
+            last = pos
+            output.append(render_tag(name.lower(), attr[:-1], ''))
+        elif name.lower() not in nested_tags:
+            # The text of these tags is not rendered, so just skip to the
+            # end tag.
+            end_tag = '</%s>' % name
+            end = text.find(end_tag, pos)
+            if end == -1:
+                continue
+
+            output.append(text[last:start])
+            output.append(render_tag(name.lower(), attr, text[pos:end]))
+            last = pos = end + len(end_tag)
+        elif name not in open_names:
+            output.append(text[last:start])
+            last = pos
+            stack.append((name, attr, match.group(), output))
+            open_names.add(name)
+            output = []
+
+    output.append(text[last:])
+
+    # Anything left open was never closed.
+    while stack:
+        output = _unwind(stack, open_names, output)
+
+    return ''.join(output)
+
+
+def _unwind(stack: list, open_names: set, output: list) -> list:
+    """ Pop the top tag off the stack and put its start tag and output in its
+    parent, the same as if it had never been matched.  Returns the parent.
+
+    """
+
+    name, _, start_tag, parent = stack.pop()
+    open_names.discard(name)
+    parent.append(start_tag)
+    parent.extend(output)
+
+    return parent
+
+
+def build_highlight(terms_list: list, case_sensitive: bool=False) -> object:
+    """ Build one regular expression that matches any of the search terms in
+    terms_list in the text of a verse with its tags blanked out.  Returns
+    None if there is nothing to highlight.
+
+    """
+
+    return _highlight_regex(tuple(terms_list), case_sensitive)
+
+
+@lru_cache(maxsize=256)
+def _highlight_regex(terms_tup: tuple, case_sensitive: bool) -> object:
+    """ Build and cache the highlight regular expression for build_highlight,
+    so repeated searches don't have to build it again.
+
+    """
+
+    reg_list = []
+    for item in terms_tup:
+        item = item.strip()
+        if not item:
+            continue
+
+        if item.startswith('&'):
+            # '&' marks the term as a regular expression.
+            reg_list.append('(?:%s)' % item[1:])
+            continue
+
+        word_list = [re.escape(word).replace(r'\*', r'\w*')
+                     for word in term_word_regx.findall(item)]
+        if not word_list:
+            continue
+
+        # A sloppy phrase can have other words between its words.
+        space_str = r'(?:\W+\w+)*?\W+' if '~' in item else r'\W+'
+        reg_list.append(r'\b%s\b' % space_str.join(word_list))
+
+    if not reg_list:
+        return None
+
+    flags = 0 if case_sensitive else re.I
+    try:
+        return re.compile('|'.join(reg_list), flags)
+    except Exception as err:
+        print("An error occured while compiling the highlight regular "
+              "expression %s: %s.  There will be no highlighting." % \
+              ('|'.join(reg_list), err), file=sys.stderr)
+        return None
+
+
+def plain_entry(text: str) -> str:
+    """ Return text with each tag replaced by tag_mark, then plain_sep, then
+    one character for each tag, whose code is how many characters the tags
+    up to and including it add to the text.  Verses are far shorter than
+    the first surrogate code, so the entry can be written to a table.
+
+    """
+
+    part_list = tag_split_regx.split(text)
+    tag_list = part_list[1::2]
+
+    # Each tag is one tag_mark in the plain text.
+    offset_iter = map(sub, accumulate(map(len, tag_list)), count(1))
+
+    return '%s%s%s' % (tag_mark.join(part_list[0::2]), plain_sep,
+                       ''.join(map(chr, offset_iter)))
+
+
+@lru_cache(maxsize=4096)
+def _plain_text(text: str) -> tuple:
+    """ Return text with each tag replaced by tag_mark, and the list of the
+    tags and the text between them, for the texts that don't have a plain
+    entry.  Recent ones are cached, so the verses that are highlighted
+    again only have to be split once.
+
+    """
+
+    part_list = tag_split_regx.split(text)
+
+    return tag_mark.join(part_list[0::2]), part_list
+
+
+def _text_pos(plain_text: str, part_list: list, pos: int) -> int:
+    """ Return the position in the raw text of pos in plain_text.
+
+    """
+
+    tag_count = plain_text.count(tag_mark, 0, pos)
+
+    return pos - tag_count + sum(map(len, part_list[1:2 * tag_count:2]))
+
+
+def _entry_pos(plain_text: str, offsets: str, pos: int) -> int:
+    """ Return the position in the raw text of pos in the plain_text of a
+    plain entry, with its offsets.
+
+    """
+
+    tag_count = plain_text.count(tag_mark, 0, pos)
+
+    return pos + ord(offsets[tag_count - 1]) if tag_count else pos
+
+
+def highlight_osis(text: str, highlight_regx: object, entry: str='') -> str:
+    """ Wrap each word in the raw OSIS text that is part of a match of
+    highlight_regx in a query-highlight span.  Only the text between the
+    tags is searched, so the tag attributes are never highlighted.  entry
+    is the plain entry of text from the table, if there is one.
+
+    """
+
+    if entry:
+        plain_text, _, offsets = entry.partition(plain_sep)
+        text_pos = _entry_pos
+    else:
+        plain_text, offsets = _plain_text(text)
+        text_pos = _text_pos
+
+    output = []
+    last = 0
+    for match in highlight_regx.finditer(plain_text):
+        # Highlight each word in the match separately, so the spans don't
+        # cross any tags.
+        for word in word_regx.finditer(plain_text, *match.span()):
+            start = text_pos(plain_text, offsets, word.start())
+            end = start + word.end() - word.start()
+            output.append(text[last:start])
+            output.append(highlight_html % text[start:end])
+            last = end
+
+    if not output:
+        return text
+
+    output.append(text[last:])
+
+    return ''.join(output)
+
+
+def osis_tokens(text: str, highlight_regx: object=None) -> tuple:
+    """ Split the raw OSIS text into a list of (token, flags, lemma, morph)
+    tuples, where lemma and morph are the attributes of the word the token
+    is in.  Returns the list and a list of [start, end) token index pairs
+    of the words highlight_regx matches.
+
+    """
+
+    token_list = []
+    token_starts = []
+
+    # Each stack item holds the tag name and the flags, lemma, and morph
+    # of the text inside it.
+    stack = [('', 0, '', '')]
+
+    # White space between tags belongs to the next token.
+    space_list = [False]
+
+    def add_tokens(start: int, end: int):
+        """ Add the tokens in text[start:end].
+
+        """
+
+        _, flags, lemma, morph = stack[-1]
+        for match in text_token_regx.finditer(text, start, end):
+            space, token = match.groups()
+            if space or space_list[0]:
+                token_list.append((token, flags | FLAG_SPACE, lemma, morph))
+            else:
+                token_list.append((token, flags, lemma, morph))
+            token_starts.append(match.start(2))
+            space_list[0] = False
+
+        if start < end and text[end - 1].isspace():
+            space_list[0] = True
+
+    last = 0
+    for match in token_regx.finditer(text):
+        is_end, name, attr = match.groups()
+        name = name.lower()
+        add_tokens(last, match.start())
+        last = match.end()
+
+        if is_end:
+            # Close the tag, and any tags left open inside it.
+            if any(item[0] == name for item in stack[1:]):
+                while stack.pop()[0] != name:
+                    pass
+        elif attr.endswith('/'):
+            if name == 'milestone':
+                marker = dict(attr_regx.findall(attr[:-1])).get('marker')
+                if marker:
+                    token_list.append((marker, FLAG_PARAGRAPH, '', ''))
+                    token_starts.append(match.start())
+                    space_list[0] = False
+        else:
+            _, flags, lemma, morph = stack[-1]
+            if name == 'w':
+                attr_dict = dict(attr_regx.findall(attr))
+                lemma = attr_prefix_regx.sub('', attr_dict.get('lemma', ''))
+                morph = attr_prefix_regx.sub('', attr_dict.get('morph', ''))
+            elif name == 'transchange':
+                if 'added' in attr.lower():
+                    flags |= FLAG_ADDED
+            else:
+                flags |= tag_flags.get(name, 0)
+            stack.append((name, flags, lemma, morph))
+
+    add_tokens(last, len(text))
+
+    mark_list = []
+    if highlight_regx and token_list:
+        # Find the matches the same way highlight_osis does, and turn them
+        # into token index ranges.
+        plain_text, part_list = _plain_text(text)
+        for match in highlight_regx.finditer(plain_text):
+            start, end = match.span()
+            if start != end:
+                start = _text_pos(plain_text, part_list, start)
+                end = _text_pos(plain_text, part_list, end)
+                mark_list.append([bisect_left(token_starts, start),
+                                  bisect_left(token_starts, end)])
+
+    return token_list, mark_list
+
+
+class TokenTable(object):
+    """ Builds a compact token stream of verses.  Each verse has parallel
+    arrays of word, lemma, and morph ids into vocabularies shared by all
+    the verses, the token flags, and the highlighted token ranges.
+
+    """
+
+    def __init__(self):
+        """ Initialize empty vocabularies.
+
+        """
+
+        self._vocab = {'': 0}
+        self._lemmas = {'': 0}
+        self._morphs = {'': 0}
+
+        self._verse_list = []
+
+    def _id(self, table: dict, value: str) -> int:
+        """ Return the id of value in table, adding it if it is new.
+
+        """
+
+        item_id = table.get(value)
+        if item_id is None:
+            item_id = table[value] = len(table)
+        return item_id
+
+    def add_verse(self, verse_ref: str, text: str, highlight: bool=False,
+                  highlight_regx: object=None):
+        """ Add the tokens of the raw OSIS text of verse_ref.
+
+        """
+
+        token_list, mark_list = osis_tokens(text, highlight_regx)
+
+        self._verse_list.append({
+            'ref': verse_ref,
+            'highlight': highlight,
+            'words': [self._id(self._vocab, token)
+                      for token, _, _, _ in token_list],
+            'lemmas': [self._id(self._lemmas, lemma)
+                       for _, _, lemma, _ in token_list],
+            'morphs': [self._id(self._morphs, morph)
+                       for _, _, _, morph in token_list],
+            'flags': [flags for _, flags, _, _ in token_list],
+            'marks': mark_list,
+        })
+
+    def to_dict(self) -> dict:
+        """ Returns a json-able dictionary of the vocabularies, flag values,
+        and verses.
+
+        """
+
+        return {
+            'vocab': list(self._vocab),
+            'lemmas': list(self._lemmas),
+            'morphs': list(self._morphs),
+            'flag_bits': {
+                'space': FLAG_SPACE,
+                'added': FLAG_ADDED,
+                'divine': FLAG_DIVINE,
+                'red': FLAG_RED,
+                'title': FLAG_TITLE,
+                'note': FLAG_NOTE,
+                'paragraph': FLAG_PARAGRAPH,
+            },
+            'verses': self._verse_list,
+        }
+
+
+class FragmentCache(object):
+    """ A least recently used cache of rendered verse html.  The keys are
+    tuples of the verse id and a signature of how it was rendered, and the
+    cache holds at most max_size characters of html.  The compressed
+    responses are kept here too, by their ETag and encoding.
+
+    """
+
+    def __init__(self, max_size: int=16 * 1024 * 1024):
+        """ Initialize an empty cache.
+
+        """
+
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self) -> int:
+        """ The number of fragments in the cache.
+
+        """
+
+        return len(self._cache)
+
+    def get(self, key: tuple, default: str=None) -> str:
+        """ Return the fragment at key and mark it as recently used, or
+        default if it is not in the cache.
+
+        """
+
+        with self._lock:
+            fragment = self._cache.get(key)
+            if fragment is None:
+                self._misses += 1
+                return default
+
+            self._cache.move_to_end(key)
+            self._hits += 1
+
+            return fragment
+
+    def __setitem__(self, key: tuple, fragment: str):
+        """ Add fragment to the cache, and evict the least recently used
+        fragments until it fits.
+
+        """
+
+        # Don't let one fragment flush the whole cache.
+        if len(fragment) > self._max_size:
+            return
+
+        with self._lock:
+            old_fragment = self._cache.pop(key, None)
+            if old_fragment is not None:
+                self._size -= len(old_fragment)
+
+            self._cache[key] = fragment
+            self._size += len(fragment)
+
+            while self._size > self._max_size:
+                _, old_fragment = self._cache.popitem(last=False)
+                self._size -= len(old_fragment)
+                self._evictions += 1
+
+    def clear(self):
+        """ Empty the cache.
+
+        """
+
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """ Returns a dictionary of the cache size, hits, misses, evictions,
+        and hit rate.
+
+        """
+
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'fragments': len(self._cache),
+                'size': self._size,
+                'max_size': self._max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+            }
+
+
+if __name__ == '__main__':
+    # Pre-render the html of every verse, so lookups only have to render
+    # the verses they highlight, and the plain entries of every verse, so
+    # highlighting them doesn't have to split out the tags.
+    import sword_search
+    print(sword_search.make_html_table(render_osis))
+    print(sword_search.make_html_table(plain_entry, kind='plain'))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Search result handles for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Every search gets a result id, a hash of its normalized query, and its
+results are kept under that id.  Pages pass the id along in their urls as
+rid, so changing the context or range, or looking up a verse, reuses the
+search instead of repeating it, and the page depends only on its url.
+
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+
+def normalize_query(search_terms: str, min_range: str,
+                    max_range: str) -> tuple:
+    """ Return the query with the extra whitespace removed.
+
+    """
+
+    return (' '.join(search_terms.split()), ' '.join(min_range.split()),
+            ' '.join(max_range.split()))
+
+
+def result_id(search_terms: str, min_range: str, max_range: str) -> str:
+    """ Return the result id of the search.
+
+    """
+
+    query = '\0'.join(normalize_query(search_terms, min_range, max_range))
+    return sha1(query.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultCache(object):
+    """ A least recently used cache of search results by result id.  Each
+    result is a dict of the search_terms, min_range, max_range, and the
+    sorted references.  It holds no more than max_results results and
+    max_references references in all, since one search can find the whole
+    Bible.
+
+    """
+
+    def __init__(self, max_results: int=1024, max_references: int=262144):
+        """ Initialize an empty cache.
+
+        """
+
+        self._max_results = max_results
+        self._max_references = max_references
+        self._references = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        """ The number of results in the cache.
+
+        """
+
+        return len(self._cache)
+
+    def get(self, rid: str, default: dict=None) -> dict:
+        """ Return the result with the id rid, or default.
+
+        """
+
+        with self._lock:
+            result = self._cache.get(rid)
+            if result is None:
+                self._misses += 1
+                return default
+
+            self._cache.move_to_end(rid)
+            self._hits += 1
+
+            return result
+
+    def add(self, search_terms: str, min_range: str, max_range: str,
+            references: list) -> str:
+        """ Store the references found by the search and return its result
+        id.
+
+        """
+
+        rid = result_id(search_terms, min_range, max_range)
+        search_terms, min_range, max_range = normalize_query(search_terms,
+                                                             min_range,
+                                                             max_range)
+        result = {
+            'rid': rid,
+            'search_terms': search_terms,
+            'min_range': min_range,
+            'max_range': max_range,
+            'references': references,
+        }
+
+        # A result bigger than the whole cache would only empty it.
+        if len(references) > self._max_references:
+            return rid
+
+        with self._lock:
+            old_result = self._cache.pop(rid, None)
+            if old_result:
+                self._references -= len(old_result['references'])
+
+            self._cache[rid] = result
+            self._references += len(references)
+            while (len(self._cache) > self._max_results or
+                   self._references > self._max_references):
+                _, old_result = self._cache.popitem(last=False)
+                self._references -= len(old_result['references'])
+
+        return rid
+
+    def stats(self) -> dict:
+        """ Return the hit and miss counts.
+
+        """
+
+        lookups = self._hits + self._misses
+        return {
+            'results': len(self._cache),
+            'max_results': self._max_results,
+            'references': self._references,
+            'max_references': self._max_references,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': self._hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Asynchronous tornado server for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A bottle server adapter that keeps tornado's IO loop free.  Bottle's
+tornado adapter runs every request on the IO loop, so one slow search
+stalls every other client.  This one runs the requests in a bounded thread
+pool with a timeout, and only the cheap routes run on the loop itself.
+Once backlog requests are waiting for a thread, new ones get a 503 right
+away instead of waiting behind them.
+
+Use it with bottle_app.run(server=AsyncTornadoServer, workers=4,
+timeout=30, backlog=64).  With processes=N it pre-forks N worker processes
+that share one listening socket, and everything the app loaded before the
+fork, like the mmap'd verse html, is shared copy-on-write.  The master
+restarts any worker that exits, so max_requests=N recycles a worker after
+it serves N requests, and sending the master SIGHUP gracefully replaces
+every worker.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from threading import Event, Lock
+from io import BytesIO
+import traceback
+import argparse
+import asyncio
+import signal
+import sys
+import os
+import re
+
+from bottle import ServerAdapter, run
+
+try:
+    from tornado.web import RequestHandler, Application
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.escape import url_unescape
+    from tornado.netutil import bind_sockets
+    from tornado.iostream import StreamClosedError
+except ImportError:
+    RequestHandler = object
+    Application = None
+
+
+# The routes that are fast enough to run right on the IO loop.
+INLINE_ROUTES = r'^/(?:assets/|biblesearch/books)'
+
+
+def wsgi_environ(request: object) -> dict:
+    """ Build a wsgi environment from the tornado request.
+
+    """
+
+    if ':' in request.host:
+        host, port = request.host.rsplit(':', 1)
+    else:
+        host = request.host
+        port = '443' if request.protocol == 'https' else '80'
+
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': url_unescape(request.path, encoding=None,
+                                  plus=False).decode('latin1'),
+        'QUERY_STRING': request.query,
+        'REMOTE_ADDR': request.remote_ip,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port,
+        'SERVER_PROTOCOL': request.version,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.protocol,
+        'wsgi.input': BytesIO(request.body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in request.headers.get_all():
+        if name == 'Content-Type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'Content-Length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_%s' % name.replace('-', '_').upper()
+            if key in environ:
+                value = '%s,%s' % (environ[key], value)
+            environ[key] = value
+
+    return environ
+
+
+def call_wsgi(wsgi_app: object, environ: dict) -> tuple:
+    """ Call the wsgi app and return its status, headers, and an iterator
+    over the body.
+
+    """
+
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        """ Save the status and headers.
+
+        """
+
+        response[:] = [status, headers]
+        return lambda data: None
+
+    body = wsgi_app(environ, start_response)
+
+    return response[0], response[1], body
+
+
+def drain_wsgi(wsgi_app: object, environ: dict, put: object, stop: object):
+    """ Call the wsgi app, and pass its status and headers, and then each
+    chunk of its body, to put.  The whole body is made in this thread, so
+    the thread locals the app uses, like bottle's request and the stage
+    times, belong to this request the whole time.  Stops early once stop
+    is set, and doesn't call the app at all if it was set while the request
+    waited for a thread.
+
+    """
+
+    if stop.is_set():
+        return
+
+    status, headers, body = call_wsgi(wsgi_app, environ)
+    try:
+        put((status, headers))
+        for chunk in body:
+            if stop.is_set():
+                break
+            if chunk:
+                put(chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+class WSGIHandler(RequestHandler):
+    """ Runs the bottle app for every request, either on the IO loop or in
+    the thread pool.
+
+    """
+
+    def initialize(self, wsgi_app: object, worker: object, timeout: float,
+                   inline_regx: object):
+        """ Set the app and how it is run.
+
+        """
+
+        self._wsgi_app = wsgi_app
+        self._worker = worker
+        self._timeout = timeout
+        self._inline_regx = inline_regx
+
+    def _produce(self, environ: dict, loop: object, queue: object,
+                 stop: object):
+        """ Run the app with drain_wsgi, putting the status and headers,
+        each chunk, and then None or the exception it raised on queue.
+
+        """
+
+        def put(item):
+            """ Put item on the queue from any thread.
+
+            """
+
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        try:
+            drain_wsgi(self._wsgi_app, environ, put, stop)
+        except BaseException as err:
+            # Raise it in the handler, like the thread pool would.
+            put(err)
+        else:
+            put(None)
+
+    async def _next(self, queue: object) -> object:
+        """ Return the next item the app made, waiting no longer than the
+        time left before the deadline.
+
+        """
+
+        if queue.empty():
+            time_left = self._deadline - IOLoop.current().time()
+            item = await asyncio.wait_for(queue.get(), max(time_left, 0))
+        else:
+            item = queue.get_nowait()
+
+        if isinstance(item, BaseException):
+            raise item
+
+        return item
+
+    async def _handle(self):
+        """ Handle any request by passing it to the wsgi app.
+
+        """
+
+        self._worker.started()
+        try:
+            await self._respond()
+        except StreamClosedError:
+            # The client went away.
+            pass
+        finally:
+            self._worker.finished()
+
+    async def _respond(self):
+        """ Run the wsgi app on the IO loop if the request is cheap,
+        otherwise in the thread pool, and send its response.
+
+        """
+
+        inline = bool(self._inline_regx.match(self.request.path))
+        self._deadline = IOLoop.current().time() + self._timeout
+
+        environ = wsgi_environ(self.request)
+        queue = asyncio.Queue()
+        stop = Event()
+        args = (environ, asyncio.get_running_loop(), queue, stop)
+        if inline:
+            self._produce(*args)
+        elif not self._worker.submit(self._produce, *args):
+            # Too many requests are waiting already, so this one would only
+            # time out behind them.
+            self.set_status(503)
+            self.set_header('Retry-After', '1')
+            self.write("The server is too busy.")
+            await self.finish()
+            return
+
+        try:
+            status, headers = await self._next(queue)
+
+            code, reason = status.split(' ', 1)
+            self.set_status(int(code), reason)
+            self.clear_header('Content-Type')
+            for name, value in headers:
+                self.add_header(name, value)
+
+            # Send each chunk as soon as it is made, so streamed responses
+            # stay streamed.
+            while True:
+                chunk = await self._next(queue)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                await self.flush()
+        except asyncio.TimeoutError:
+            # The worker thread can't be stopped, but the client doesn't
+            # have to keep waiting for it.
+            print("Request timed out after %ss: %s" % (self._timeout,
+                                                      self.request.uri),
+                  file=sys.stderr)
+            if self._headers_written:
+                # Drop the connection so the client can't mistake part of
+                # the response for all of it.
+                self.request.connection.close()
+                return
+            self.clear()
+            self.set_status(504)
+            self.write("The request took too long.")
+        finally:
+            # Let the thread stop making a body nobody will get.
+            stop.set()
+
+        await self.finish()
+
+    get = post = put = delete = patch = head = options = _handle
+
+
+class Worker(object):
+    """ Counts the requests a server is handling, and stops it once the
+    requests it is handling are done.  No more than backlog requests wait
+    for a thread in the pool (0 for no limit).
+
+    """
+
+    def __init__(self, workers: int, max_requests: int, grace: float,
+                 backlog: int=0):
+        """ Make the thread pool.
+
+        """
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.server = None
+
+        self._backlog = backlog
+        self._waiting = 0
+        self._waiting_lock = Lock()
+
+        self._max_requests = max_requests
+        self._grace = grace
+        self._served = 0
+        self._active = 0
+        self._stopping = False
+
+    def submit(self, func: object, *args) -> bool:
+        """ Run func(*args) in the thread pool, and return True, unless
+        backlog requests are already waiting for a thread, then return
+        False.
+
+        """
+
+        with self._waiting_lock:
+            if self._backlog and self._waiting >= self._backlog:
+                return False
+            self._waiting += 1
+
+        self.executor.submit(self._run, func, *args)
+        return True
+
+    def _run(self, func: object, *args):
+        """ Run func(*args) now that it has a thread.
+
+        """
+
+        with self._waiting_lock:
+            self._waiting -= 1
+
+        func(*args)
+
+    def started(self):
+        """ A request was started.
+
+        """
+
+        self._active += 1
+
+    def finished(self):
+        """ A request was finished, so stop if this worker has served enough.
+
+        """
+
+        self._active -= 1
+        self._served += 1
+
+        if self._max_requests and self._served >= self._max_requests:
+            self.stop()
+
+    def stop(self):
+        """ Stop taking new requests, and stop the IO loop when the current
+        ones are done, or after the grace period.
+
+        """
+
+        if self._stopping:
+            return
+
+        self._stopping = True
+        self.server.stop()
+
+        loop = IOLoop.current()
+        self._deadline = loop.time() + self._grace
+        loop.call_later(0.5, self._stop_when_idle)
+
+    def _stop_when_idle(self):
+        """ Stop the IO loop if no requests are left, checking again later
+        if there are.  Connections that were accepted but not read yet get
+        the half second between checks to start their requests.
+
+        """
+
+        loop = IOLoop.current()
+        if not self._active or loop.time() >= self._deadline:
+            loop.stop()
+        else:
+            loop.call_later(0.5, self._stop_when_idle)
+
+
+def prefork(serve: object, processes: int):
+    """ Fork processes children that each call serve, and keep that many
+    running until the master gets SIGTERM or SIGINT.  On SIGHUP a new set
+    of children is started and the old ones are told to stop.
+
+    """
+
+    children = set()
+    retired = set()
+    running = True
+
+    def spawn():
+        """ Fork a child to run serve.
+
+        """
+
+        pid = os.fork()
+        if not pid:
+            # Only the master handles Ctrl-C and SIGHUP.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                serve()
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+
+        children.add(pid)
+
+    def retire(pid_list):
+        """ Tell the children in pid_list to stop.
+
+        """
+
+        for pid in pid_list:
+            retired.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(signum, frame):
+        """ Replace all the children.
+
+        """
+
+        old_children = set(children)
+        for _ in range(processes):
+            spawn()
+        retire(old_children)
+
+    def shutdown(signum, frame):
+        """ Stop all the children and exit.
+
+        """
+
+        nonlocal running
+        running = False
+        retire(set(children))
+
+    signal.signal(signal.SIGHUP, reload)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for _ in range(processes):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        children.discard(pid)
+        if pid in retired:
+            retired.discard(pid)
+        elif running:
+            if status:
+                print("Worker %s exited with status %s, restarting it." %
+                      (pid, status), file=sys.stderr)
+            spawn()
+
+
+class AsyncTornadoServer(ServerAdapter):
+    """ Run the app with tornado, off of the IO loop.  The options are
+    workers, the number of threads in the pool, timeout, the number of
+    seconds before a request gives up, backlog, the number of requests that
+    can wait for a thread before new ones get a 503, inline, a regular
+    expression of the paths that run on the IO loop, processes, the number
+    of processes to fork (0 for one per cpu), max_requests, the number of
+    requests a process serves before it is replaced, after_fork, a function
+    each process calls before it starts serving, and listening, a function
+    called once the sockets are listening.
+
+    """
+
+    def serve(self, handler: object, sockets: list):
+        """ Serve the app on sockets until the worker is stopped.
+
+        """
+
+        after_fork = self.options.get('after_fork', None)
+        if after_fork:
+            after_fork()
+
+        timeout = self.options.get('timeout', 30)
+        worker = Worker(self.options.get('workers', 4),
+                        self.options.get('max_requests', 0), timeout,
+                        self.options.get('backlog', 64))
+        handler_args = {
+            'wsgi_app': handler,
+            'worker': worker,
+            'timeout': timeout,
+            'inline_regx': re.compile(self.options.get('inline',
+                                                       INLINE_ROUTES)),
+        }
+
+        application = Application([(r'.*', WSGIHandler, handler_args)])
+        worker.server = HTTPServer(application, xheaders=True)
+        worker.server.add_sockets(sockets)
+
+        loop = IOLoop.current()
+        if self.options['processes'] > 1:
+            loop.asyncio_loop.add_signal_handler(signal.SIGTERM, worker.stop)
+
+        try:
+            loop.start()
+        finally:
+            worker.executor.shutdown(wait=False)
+
+    def run(self, handler):
+        """ Start tornado and serve the app.
+
+        """
+
+        if not Application:
+            raise ImportError("The async server needs tornado.")
+
+        # Bind before forking so all the processes share the one socket.
+        sockets = bind_sockets(self.port, address=self.host)
+
+        listening = self.options.get('listening', None)
+        if listening:
+            listening()
+
+        processes = self.options.get('processes', 1)
+        processes = processes if processes > 0 else cpu_count()
+        self.options['processes'] = processes
+        if processes == 1:
+            self.serve(handler, sockets)
+        else:
+            prefork(lambda: self.serve(handler, sockets), processes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve biblesearch with a "
+                                     "pre-forked set of processes.")
+    parser.add_argument('--host', default='0.0.0.0',
+                        help='The address to listen on.')
+    parser.add_argument('-p', '--port', type=int, default=8081,
+                        help='The port to listen on.')
+    parser.add_argument('-n', '--processes', type=int, default=0,
+                        help='Number of processes, 0 for one per cpu.')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of threads in each process.')
+    parser.add_argument('-t', '--timeout', type=float, default=30,
+                        help='Seconds before a request gives up.')
+    parser.add_argument('-m', '--max-requests', type=int, default=0,
+                        help='Requests a process serves before it is '
+                        'replaced, 0 for no limit.')
+    parser.add_argument('-b', '--backlog', type=int, default=64,
+                        help='Requests that can wait for a thread before '
+                        'new ones get a 503, 0 for no limit.')
+    args = parser.parse_args()
+
+    # Load the app, and with it the index, before forking so the processes
+    # share it.
+    import biblesearch_app
+    biblesearch_app.start_warm_up().join()
+
+    run(biblesearch_app.application, server=AsyncTornadoServer,
+        host=args.host, port=args.port, processes=args.processes,
+        workers=args.workers, timeout=args.timeout, backlog=args.backlog,
+        max_requests=args.max_requests,
+        after_fork=biblesearch_app.reopen_index)
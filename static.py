@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Static asset building and serving for the biblesearch web app.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Run this to copy the assets into cache/assets with a hash of their
+contents in their names, along with gzip and brotli compressed copies.  The
+templates link to the hashed names through the asset function, so the
+browser can cache them forever.  AssetStore keeps all the assets and their
+compressed copies in memory and serves them without touching the disk.
+
+"""
+
+from os.path import join, dirname, relpath, splitext, isfile
+from email.utils import formatdate
+from hashlib import sha1
+import mimetypes
+import posixpath
+import json
+import gzip
+import sys
+import os
+import re
+
+from bottle import HTTPResponse, static_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+asset_path = join(dirname(__file__), 'assets')
+build_path = join(dirname(__file__), 'cache', 'assets')
+manifest_name = 'manifest.json'
+
+# Only text compresses well enough to be worth it.
+compress_types = ('.css', '.js', '.svg', '.html', '.json', '.txt')
+
+# Relative urls in the css files, like url("../img/glyphicons.png").
+css_url_regx = re.compile(r'''url\(\s*(['"]?)(?P<url>[^'")\s]+)\1\s*\)''')
+
+# Hashed names don't change unless the file does.
+immutable_control = 'public, max-age=31536000, immutable'
+plain_control = 'public, max-age=3600'
+
+
+def load_manifest(path: str=build_path) -> dict:
+    """ Return the map of asset names to their hashed names, or an empty
+    dict if the assets haven't been built.
+
+    """
+
+    try:
+        with open(join(path, manifest_name), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+manifest = load_manifest()
+
+
+def asset(name: str) -> str:
+    """ Return the url of the named asset, using its hashed name if the
+    assets have been built.
+
+    """
+
+    return '/assets/%s' % manifest.get(name, name)
+
+
+def accepted_encodings(accept: str) -> set:
+    """ Return the encodings allowed by the Accept-Encoding header accept.
+
+    """
+
+    encoding_set = set()
+    for item in accept.split(','):
+        encoding, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and not params[2:].strip('0.'):
+            # q=0 means the encoding is not allowed.
+            continue
+        encoding_set.add(encoding.strip().lower())
+
+    return encoding_set
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """ Check if the If-None-Match header if_none_match lists etag.  The
+    tags are compared weakly, so W/ tags and '*' match as well.
+
+    """
+
+    tag_list = [i.strip().replace('W/', '', 1)
+                for i in if_none_match.split(',')]
+    return '*' in tag_list or etag.replace('W/', '', 1) in tag_list
+
+
+def _walk_assets(path: str) -> iter:
+    """ Yield the name of every file under path relative to path.
+
+    """
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            yield relpath(join(root, file_name), path).replace(os.sep, '/')
+
+
+def _write(filename: str, data: bytes):
+    """ Write data to filename, making the directories it needs.
+
+    """
+
+    os.makedirs(dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as out_file:
+        out_file.write(data)
+
+
+def _rewrite_css(name: str, data: bytes, manifest: dict) -> bytes:
+    """ Point the relative urls in the css file name at the hashed names.
+
+    """
+
+    css_dir = posixpath.dirname(name)
+
+    def url_func(match):
+        """ Replace the url with its hashed name.
+
+        """
+
+        url = match.group('url')
+        if ':' in url or url.startswith('/'):
+            return match.group(0)
+
+        target = posixpath.normpath(posixpath.join(css_dir, url))
+        if target not in manifest:
+            return match.group(0)
+
+        hashed = posixpath.relpath(manifest[target], css_dir)
+        return 'url(%s%s%s)' % (match.group(1), hashed, match.group(1))
+
+    return css_url_regx.sub(url_func, data.decode('utf-8')).encode('utf-8')
+
+
+def build_assets(path: str=asset_path, out_path: str=build_path) -> dict:
+    """ Copy every asset under path into out_path with a hash of its
+    contents in its name, write compressed copies of the text files, and
+    write the manifest.  The css files are done last, so the urls in them
+    can be pointed at the hashed images.
+
+    """
+
+    new_manifest = {}
+    name_list = sorted(_walk_assets(path),
+                       key=lambda name: (name.endswith('.css'), name))
+
+    for name in name_list:
+        with open(join(path, name), 'rb') as asset_file:
+            data = asset_file.read()
+
+        if name.endswith('.css'):
+            data = _rewrite_css(name, data, new_manifest)
+
+        root, ext = splitext(name)
+        hashed_name = '%s.%s%s' % (root, sha1(data).hexdigest()[:10], ext)
+        new_manifest[name] = hashed_name
+
+        filename = join(out_path, hashed_name)
+        _write(filename, data)
+        if ext in compress_types:
+            _write('%s.gz' % filename, gzip.compress(data, 9, mtime=0))
+            if brotli:
+                _write('%s.br' % filename, brotli.compress(data))
+
+    _write(join(out_path, manifest_name),
+           json.dumps(new_manifest, indent=4, sort_keys=True).encode())
+
+    return new_manifest
+
+
+class AssetStore(object):
+    """ All the assets and their compressed copies held in memory.
+
+    """
+
+    def __init__(self, path: str=asset_path, build: str=build_path):
+        """ Load the assets under path and the built assets under build.
+
+        """
+
+        self._path = path
+        self._assets = {}
+
+        for name in _walk_assets(path):
+            self._load(name, join(path, name), plain_control)
+
+        for hashed_name in load_manifest(build).values():
+            self._load(hashed_name, join(build, hashed_name),
+                       immutable_control)
+
+    def _load(self, name: str, filename: str, cache_control: str):
+        """ Read filename and its compressed copies into memory as name.
+
+        """
+
+        with open(filename, 'rb') as asset_file:
+            data = asset_file.read()
+
+        content_type, _ = mimetypes.guess_type(name)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type.endswith(
+                ('javascript', 'json', 'xml')):
+            content_type += '; charset=UTF-8'
+
+        variants = {'identity': data}
+        for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+            if isfile(filename + ext):
+                with open(filename + ext, 'rb') as asset_file:
+                    variants[encoding] = asset_file.read()
+        if splitext(name)[1] in compress_types and 'gzip' not in variants:
+            variants['gzip'] = gzip.compress(data, 6, mtime=0)
+
+        # Each encoding is a different representation, so it gets its own
+        # strong tag.
+        digest = sha1(data).hexdigest()[:16]
+        etags = {encoding: '"%s"' % digest if encoding == 'identity'
+                 else '"%s-%s"' % (digest, encoding)
+                 for encoding in variants}
+
+        self._assets[name] = {
+            'variants': variants,
+            'etags': etags,
+            'headers': {
+                'Content-Type': content_type,
+                'Cache-Control': cache_control,
+                'Last-Modified': formatdate(os.stat(filename).st_mtime,
+                                            usegmt=True),
+            },
+        }
+
+    def __contains__(self, name: str) -> bool:
+        """ Check if the asset name is in memory.
+
+        """
+
+        return name in self._assets
+
+    def stats(self) -> dict:
+        """ Return the number of assets and the bytes they use.
+
+        """
+
+        return {
+            'assets': len(self._assets),
+            'size': sum(len(data) for item in self._assets.values()
+                        for data in item['variants'].values()),
+        }
+
+    def response(self, name: str, request: object) -> HTTPResponse:
+        """ Return a response with the asset name, compressed the best way
+        the request accepts.  Assets added since loading are read from the
+        disk.
+
+        """
+
+        item = self._assets.get(name)
+        if not item:
+            return static_file(name, self._path)
+
+        headers = dict(item['headers'])
+        variants = item['variants']
+        if len(variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+
+        accept = accepted_encodings(request.headers.get('Accept-Encoding',
+                                                        ''))
+        encoding = 'identity'
+        for option in ('br', 'gzip'):
+            if option in variants and option in accept:
+                encoding = option
+                break
+        headers['ETag'] = item['etags'][encoding]
+
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match and etag_matches(if_none_match, headers['ETag']):
+            return HTTPResponse(status=304, headers=headers)
+
+        data = variants[encoding]
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        headers['Content-Length'] = str(len(data))
+
+        if request.method == 'HEAD':
+            data = b''
+
+        return HTTPResponse(data, headers=headers)
+
+
+if __name__ == '__main__':
+    new_manifest = build_assets()
+    print("Built %s assets in %s." % (len(new_manifest), build_path),
+          file=sys.stderr)
+    if not brotli:
+        print("Install brotli to also write .br files.", file=sys.stderr)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Streaming template and json responses.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Generators that produce a response a chunk at a time, so bottle can send
+the first verses while the rest are still being looked up.
+
+"""
+
+from bottle import Jinja2Template, TEMPLATES, TEMPLATE_PATH
+import json
+
+from templates import template_settings
+
+
+def template_stream(name: str, size: int=8192, **kwargs) -> iter:
+    """ Render the named jinja2 template in chunks of about size characters.
+
+    """
+
+    # Use the same cache as jinja2_template, so the template is only loaded
+    # once.
+    tplid = (id(TEMPLATE_PATH), name)
+    if tplid not in TEMPLATES:
+        TEMPLATES[tplid] = Jinja2Template(name=name, lookup=TEMPLATE_PATH,
+                                          **template_settings)
+
+    return chunk_join(TEMPLATES[tplid].tpl.generate(**kwargs), size)
+
+
+def chunk_join(str_iter: iter, size: int=8192) -> iter:
+    """ Join the many small strings from str_iter into chunks of about size
+    characters.
+
+    """
+
+    chunk_list = []
+    chunk_len = 0
+    for text in str_iter:
+        chunk_list.append(text)
+        chunk_len += len(text)
+        if chunk_len >= size:
+            yield ''.join(chunk_list)
+            chunk_list = []
+            chunk_len = 0
+
+    if chunk_list:
+        yield ''.join(chunk_list)
+
+
+def json_str_stream(key: str, str_iter: iter) -> iter:
+    """ Yield a json object with the text from str_iter as the string value
+    of key.
+
+    """
+
+    str_iter = iter(str_iter)
+
+    # Get the first chunk before starting the response, so any errors
+    # happen while an error page can still be sent.
+    first = next(str_iter, '')
+
+    yield '{%s: "%s' % (json.dumps(key), json.dumps(first)[1:-1])
+    for text in str_iter:
+        yield json.dumps(text)[1:-1]
+    yield '"}'
+
+
+def json_list_stream(key: str, item_iter: iter, size: int=8192) -> iter:
+    """ Yield a json object with the items from item_iter as the list value
+    of key.
+
+    """
+
+    def item_gen():
+        """ Yield each json encoded item with the commas between them.
+
+        """
+
+        sep = ''
+        for item in item_iter:
+            yield sep + json.dumps(item)
+            sep = ', '
+
+    yield '{%s: [' % json.dumps(key)
+    yield from chunk_join(item_gen(), size)
+    yield ']}'
+
+
+def ndjson_stream(item_iter: iter, size: int=8192) -> iter:
+    """ Yield each item from item_iter as one line of newline delimited
+    json.
+
+    """
+
+    return chunk_join(('%s\n' % json.dumps(item) for item in item_iter),
+                      size)
+
+
+def wants_ndjson(request: object) -> bool:
+    """ Returns True if the request asked for newline delimited json, either
+    with format=ndjson in the query or in the Accept header.
+
+    """
+
+    if request.query.get('format', '') == 'ndjson':
+        return True
+
+    return 'application/x-ndjson' in request.get_header('Accept', '')
@@ -19,3 +19,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .search import *
+
+
+def __getattr__(name):
+    """ Import the command line interface, and build the list of book
+    names, only when they are used.
+
+    """
+
+    if name in ('SearchCmd', 'copying_str', 'warranty_str'):
+        from . import cli
+        return getattr(cli, name)
+
+    if name == 'book_list':
+        from . import verses
+        return verses.book_list
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -18,631 +18,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-copying_str = \
-'''
-                        GNU GENERAL PUBLIC LICENSE
-                           Version 3, 29 June 2007
-
-     Copyright (C) 2007 Free Software Foundation, Inc. <http://fsf.org/>
-     Everyone is permitted to copy and distribute verbatim copies
-     of this license document, but changing it is not allowed.
-
-                                Preamble
-
-      The GNU General Public License is a free, copyleft license for
-    software and other kinds of works.
-
-      The licenses for most software and other practical works are designed
-    to take away your freedom to share and change the works.  By contrast,
-    the GNU General Public License is intended to guarantee your freedom to
-    share and change all versions of a program--to make sure it remains free
-    software for all its users.  We, the Free Software Foundation, use the
-    GNU General Public License for most of our software; it applies also to
-    any other work released this way by its authors.  You can apply it to
-    your programs, too.
-
-      When we speak of free software, we are referring to freedom, not
-    price.  Our General Public Licenses are designed to make sure that you
-    have the freedom to distribute copies of free software (and charge for
-    them if you wish), that you receive source code or can get it if you
-    want it, that you can change the software or use pieces of it in new
-    free programs, and that you know you can do these things.
-
-      To protect your rights, we need to prevent others from denying you
-    these rights or asking you to surrender the rights.  Therefore, you have
-    certain responsibilities if you distribute copies of the software, or if
-    you modify it: responsibilities to respect the freedom of others.
-
-      For example, if you distribute copies of such a program, whether
-    gratis or for a fee, you must pass on to the recipients the same
-    freedoms that you received.  You must make sure that they, too, receive
-    or can get the source code.  And you must show them these terms so they
-    know their rights.
-
-      Developers that use the GNU GPL protect your rights with two steps:
-    (1) assert copyright on the software, and (2) offer you this License
-    giving you legal permission to copy, distribute and/or modify it.
-
-      For the developers' and authors' protection, the GPL clearly explains
-    that there is no warranty for this free software.  For both users' and
-    authors' sake, the GPL requires that modified versions be marked as
-    changed, so that their problems will not be attributed erroneously to
-    authors of previous versions.
-
-      Some devices are designed to deny users access to install or run
-    modified versions of the software inside them, although the manufacturer
-    can do so.  This is fundamentally incompatible with the aim of
-    protecting users' freedom to change the software.  The systematic
-    pattern of such abuse occurs in the area of products for individuals to
-    use, which is precisely where it is most unacceptable.  Therefore, we
-    have designed this version of the GPL to prohibit the practice for those
-    products.  If such problems arise substantially in other domains, we
-    stand ready to extend this provision to those domains in future versions
-    of the GPL, as needed to protect the freedom of users.
-
-      Finally, every program is threatened constantly by software patents.
-    States should not allow patents to restrict development and use of
-    software on general-purpose computers, but in those that do, we wish to
-    avoid the special danger that patents applied to a free program could
-    make it effectively proprietary.  To prevent this, the GPL assures that
-    patents cannot be used to render the program non-free.
-
-      The precise terms and conditions for copying, distribution and
-    modification follow.
-
-                           TERMS AND CONDITIONS
-
-      0. Definitions.
-
-      "This License" refers to version 3 of the GNU General Public License.
-
-      "Copyright" also means copyright-like laws that apply to other kinds of
-    works, such as semiconductor masks.
-
-      "The Program" refers to any copyrightable work licensed under this
-    License.  Each licensee is addressed as "you".  "Licensees" and
-    "recipients" may be individuals or organizations.
-
-      To "modify" a work means to copy from or adapt all or part of the work
-    in a fashion requiring copyright permission, other than the making of an
-    exact copy.  The resulting work is called a "modified version" of the
-    earlier work or a work "based on" the earlier work.
-
-      A "covered work" means either the unmodified Program or a work based
-    on the Program.
-
-      To "propagate" a work means to do anything with it that, without
-    permission, would make you directly or secondarily liable for
-    infringement under applicable copyright law, except executing it on a
-    computer or modifying a private copy.  Propagation includes copying,
-    distribution (with or without modification), making available to the
-    public, and in some countries other activities as well.
-
-      To "convey" a work means any kind of propagation that enables other
-    parties to make or receive copies.  Mere interaction with a user through
-    a computer network, with no transfer of a copy, is not conveying.
-
-      An interactive user interface displays "Appropriate Legal Notices"
-    to the extent that it includes a convenient and prominently visible
-    feature that (1) displays an appropriate copyright notice, and (2)
-    tells the user that there is no warranty for the work (except to the
-    extent that warranties are provided), that licensees may convey the
-    work under this License, and how to view a copy of this License.  If
-    the interface presents a list of user commands or options, such as a
-    menu, a prominent item in the list meets this criterion.
-
-      1. Source Code.
-
-      The "source code" for a work means the preferred form of the work
-    for making modifications to it.  "Object code" means any non-source
-    form of a work.
-
-      A "Standard Interface" means an interface that either is an official
-    standard defined by a recognized standards body, or, in the case of
-    interfaces specified for a particular programming language, one that
-    is widely used among developers working in that language.
-
-      The "System Libraries" of an executable work include anything, other
-    than the work as a whole, that (a) is included in the normal form of
-    packaging a Major Component, but which is not part of that Major
-    Component, and (b) serves only to enable use of the work with that
-    Major Component, or to implement a Standard Interface for which an
-    implementation is available to the public in source code form.  A
-    "Major Component", in this context, means a major essential component
-    (kernel, window system, and so on) of the specific operating system
-    (if any) on which the executable work runs, or a compiler used to
-    produce the work, or an object code interpreter used to run it.
-
-      The "Corresponding Source" for a work in object code form means all
-    the source code needed to generate, install, and (for an executable
-    work) run the object code and to modify the work, including scripts to
-    control those activities.  However, it does not include the work's
-    System Libraries, or general-purpose tools or generally available free
-    programs which are used unmodified in performing those activities but
-    which are not part of the work.  For example, Corresponding Source
-    includes interface definition files associated with source files for
-    the work, and the source code for shared libraries and dynamically
-    linked subprograms that the work is specifically designed to require,
-    such as by intimate data communication or control flow between those
-    subprograms and other parts of the work.
-
-      The Corresponding Source need not include anything that users
-    can regenerate automatically from other parts of the Corresponding
-    Source.
-
-      The Corresponding Source for a work in source code form is that
-    same work.
-
-      2. Basic Permissions.
-
-      All rights granted under this License are granted for the term of
-    copyright on the Program, and are irrevocable provided the stated
-    conditions are met.  This License explicitly affirms your unlimited
-    permission to run the unmodified Program.  The output from running a
-    covered work is covered by this License only if the output, given its
-    content, constitutes a covered work.  This License acknowledges your
-    rights of fair use or other equivalent, as provided by copyright law.
-
-      You may make, run and propagate covered works that you do not
-    convey, without conditions so long as your license otherwise remains
-    in force.  You may convey covered works to others for the sole purpose
-    of having them make modifications exclusively for you, or provide you
-    with facilities for running those works, provided that you comply with
-    the terms of this License in conveying all material for which you do
-    not control copyright.  Those thus making or running the covered works
-    for you must do so exclusively on your behalf, under your direction
-    and control, on terms that prohibit them from making any copies of
-    your copyrighted material outside their relationship with you.
-
-      Conveying under any other circumstances is permitted solely under
-    the conditions stated below.  Sublicensing is not allowed; section 10
-    makes it unnecessary.
-
-      3. Protecting Users' Legal Rights From Anti-Circumvention Law.
-
-      No covered work shall be deemed part of an effective technological
-    measure under any applicable law fulfilling obligations under article
-    11 of the WIPO copyright treaty adopted on 20 December 1996, or
-    similar laws prohibiting or restricting circumvention of such
-    measures.
-
-      When you convey a covered work, you waive any legal power to forbid
-    circumvention of technological measures to the extent such circumvention
-    is effected by exercising rights under this License with respect to
-    the covered work, and you disclaim any intention to limit operation or
-    modification of the work as a means of enforcing, against the work's
-    users, your or third parties' legal rights to forbid circumvention of
-    technological measures.
-
-      4. Conveying Verbatim Copies.
-
-      You may convey verbatim copies of the Program's source code as you
-    receive it, in any medium, provided that you conspicuously and
-    appropriately publish on each copy an appropriate copyright notice;
-    keep intact all notices stating that this License and any
-    non-permissive terms added in accord with section 7 apply to the code;
-    keep intact all notices of the absence of any warranty; and give all
-    recipients a copy of this License along with the Program.
-
-      You may charge any price or no price for each copy that you convey,
-    and you may offer support or warranty protection for a fee.
-
-      5. Conveying Modified Source Versions.
-
-      You may convey a work based on the Program, or the modifications to
-    produce it from the Program, in the form of source code under the
-    terms of section 4, provided that you also meet all of these conditions:
-
-        a) The work must carry prominent notices stating that you modified
-        it, and giving a relevant date.
-
-        b) The work must carry prominent notices stating that it is
-        released under this License and any conditions added under section
-        7.  This requirement modifies the requirement in section 4 to
-        "keep intact all notices".
-
-        c) You must license the entire work, as a whole, under this
-        License to anyone who comes into possession of a copy.  This
-        License will therefore apply, along with any applicable section 7
-        additional terms, to the whole of the work, and all its parts,
-        regardless of how they are packaged.  This License gives no
-        permission to license the work in any other way, but it does not
-        invalidate such permission if you have separately received it.
-
-        d) If the work has interactive user interfaces, each must display
-        Appropriate Legal Notices; however, if the Program has interactive
-        interfaces that do not display Appropriate Legal Notices, your
-        work need not make them do so.
-
-      A compilation of a covered work with other separate and independent
-    works, which are not by their nature extensions of the covered work,
-    and which are not combined with it such as to form a larger program,
-    in or on a volume of a storage or distribution medium, is called an
-    "aggregate" if the compilation and its resulting copyright are not
-    used to limit the access or legal rights of the compilation's users
-    beyond what the individual works permit.  Inclusion of a covered work
-    in an aggregate does not cause this License to apply to the other
-    parts of the aggregate.
-
-      6. Conveying Non-Source Forms.
-
-      You may convey a covered work in object code form under the terms
-    of sections 4 and 5, provided that you also convey the
-    machine-readable Corresponding Source under the terms of this License,
-    in one of these ways:
-
-        a) Convey the object code in, or embodied in, a physical product
-        (including a physical distribution medium), accompanied by the
-        Corresponding Source fixed on a durable physical medium
-        customarily used for software interchange.
-
-        b) Convey the object code in, or embodied in, a physical product
-        (including a physical distribution medium), accompanied by a
-        written offer, valid for at least three years and valid for as
-        long as you offer spare parts or customer support for that product
-        model, to give anyone who possesses the object code either (1) a
-        copy of the Corresponding Source for all the software in the
-        product that is covered by this License, on a durable physical
-        medium customarily used for software interchange, for a price no
-        more than your reasonable cost of physically performing this
-        conveying of source, or (2) access to copy the
-        Corresponding Source from a network server at no charge.
-
-        c) Convey individual copies of the object code with a copy of the
-        written offer to provide the Corresponding Source.  This
-        alternative is allowed only occasionally and noncommercially, and
-        only if you received the object code with such an offer, in accord
-        with subsection 6b.
-
-        d) Convey the object code by offering access from a designated
-        place (gratis or for a charge), and offer equivalent access to the
-        Corresponding Source in the same way through the same place at no
-        further charge.  You need not require recipients to copy the
-        Corresponding Source along with the object code.  If the place to
-        copy the object code is a network server, the Corresponding Source
-        may be on a different server (operated by you or a third party)
-        that supports equivalent copying facilities, provided you maintain
-        clear directions next to the object code saying where to find the
-        Corresponding Source.  Regardless of what server hosts the
-        Corresponding Source, you remain obligated to ensure that it is
-        available for as long as needed to satisfy these requirements.
-
-        e) Convey the object code using peer-to-peer transmission, provided
-        you inform other peers where the object code and Corresponding
-        Source of the work are being offered to the general public at no
-        charge under subsection 6d.
-
-      A separable portion of the object code, whose source code is excluded
-    from the Corresponding Source as a System Library, need not be
-    included in conveying the object code work.
-
-      A "User Product" is either (1) a "consumer product", which means any
-    tangible personal property which is normally used for personal, family,
-    or household purposes, or (2) anything designed or sold for incorporation
-    into a dwelling.  In determining whether a product is a consumer product,
-    doubtful cases shall be resolved in favor of coverage.  For a particular
-    product received by a particular user, "normally used" refers to a
-    typical or common use of that class of product, regardless of the status
-    of the particular user or of the way in which the particular user
-    actually uses, or expects or is expected to use, the product.  A product
-    is a consumer product regardless of whether the product has substantial
-    commercial, industrial or non-consumer uses, unless such uses represent
-    the only significant mode of use of the product.
-
-      "Installation Information" for a User Product means any methods,
-    procedures, authorization keys, or other information required to install
-    and execute modified versions of a covered work in that User Product from
-    a modified version of its Corresponding Source.  The information must
-    suffice to ensure that the continued functioning of the modified object
-    code is in no case prevented or interfered with solely because
-    modification has been made.
-
-      If you convey an object code work under this section in, or with, or
-    specifically for use in, a User Product, and the conveying occurs as
-    part of a transaction in which the right of possession and use of the
-    User Product is transferred to the recipient in perpetuity or for a
-    fixed term (regardless of how the transaction is characterized), the
-    Corresponding Source conveyed under this section must be accompanied
-    by the Installation Information.  But this requirement does not apply
-    if neither you nor any third party retains the ability to install
-    modified object code on the User Product (for example, the work has
-    been installed in ROM).
-
-      The requirement to provide Installation Information does not include a
-    requirement to continue to provide support service, warranty, or updates
-    for a work that has been modified or installed by the recipient, or for
-    the User Product in which it has been modified or installed.  Access to a
-    network may be denied when the modification itself materially and
-    adversely affects the operation of the network or violates the rules and
-    protocols for communication across the network.
-
-      Corresponding Source conveyed, and Installation Information provided,
-    in accord with this section must be in a format that is publicly
-    documented (and with an implementation available to the public in
-    source code form), and must require no special password or key for
-    unpacking, reading or copying.
-
-      7. Additional Terms.
-
-      "Additional permissions" are terms that supplement the terms of this
-    License by making exceptions from one or more of its conditions.
-    Additional permissions that are applicable to the entire Program shall
-    be treated as though they were included in this License, to the extent
-    that they are valid under applicable law.  If additional permissions
-    apply only to part of the Program, that part may be used separately
-    under those permissions, but the entire Program remains governed by
-    this License without regard to the additional permissions.
-
-      When you convey a copy of a covered work, you may at your option
-    remove any additional permissions from that copy, or from any part of
-    it.  (Additional permissions may be written to require their own
-    removal in certain cases when you modify the work.)  You may place
-    additional permissions on material, added by you to a covered work,
-    for which you have or can give appropriate copyright permission.
-
-      Notwithstanding any other provision of this License, for material you
-    add to a covered work, you may (if authorized by the copyright holders of
-    that material) supplement the terms of this License with terms:
-
-        a) Disclaiming warranty or limiting liability differently from the
-        terms of sections 15 and 16 of this License; or
-
-        b) Requiring preservation of specified reasonable legal notices or
-        author attributions in that material or in the Appropriate Legal
-        Notices displayed by works containing it; or
-
-        c) Prohibiting misrepresentation of the origin of that material, or
-        requiring that modified versions of such material be marked in
-        reasonable ways as different from the original version; or
-
-        d) Limiting the use for publicity purposes of names of licensors or
-        authors of the material; or
-
-        e) Declining to grant rights under trademark law for use of some
-        trade names, trademarks, or service marks; or
-
-        f) Requiring indemnification of licensors and authors of that
-        material by anyone who conveys the material (or modified versions of
-        it) with contractual assumptions of liability to the recipient, for
-        any liability that these contractual assumptions directly impose on
-        those licensors and authors.
-
-      All other non-permissive additional terms are considered "further
-    restrictions" within the meaning of section 10.  If the Program as you
-    received it, or any part of it, contains a notice stating that it is
-    governed by this License along with a term that is a further
-    restriction, you may remove that term.  If a license document contains
-    a further restriction but permits relicensing or conveying under this
-    License, you may add to a covered work material governed by the terms
-    of that license document, provided that the further restriction does
-    not survive such relicensing or conveying.
-
-      If you add terms to a covered work in accord with this section, you
-    must place, in the relevant source files, a statement of the
-    additional terms that apply to those files, or a notice indicating
-    where to find the applicable terms.
-
-      Additional terms, permissive or non-permissive, may be stated in the
-    form of a separately written license, or stated as exceptions;
-    the above requirements apply either way.
-
-      8. Termination.
-
-      You may not propagate or modify a covered work except as expressly
-    provided under this License.  Any attempt otherwise to propagate or
-    modify it is void, and will automatically terminate your rights under
-    this License (including any patent licenses granted under the third
-    paragraph of section 11).
-
-      However, if you cease all violation of this License, then your
-    license from a particular copyright holder is reinstated (a)
-    provisionally, unless and until the copyright holder explicitly and
-    finally terminates your license, and (b) permanently, if the copyright
-    holder fails to notify you of the violation by some reasonable means
-    prior to 60 days after the cessation.
-
-      Moreover, your license from a particular copyright holder is
-    reinstated permanently if the copyright holder notifies you of the
-    violation by some reasonable means, this is the first time you have
-    received notice of violation of this License (for any work) from that
-    copyright holder, and you cure the violation prior to 30 days after
-    your receipt of the notice.
-
-      Termination of your rights under this section does not terminate the
-    licenses of parties who have received copies or rights from you under
-    this License.  If your rights have been terminated and not permanently
-    reinstated, you do not qualify to receive new licenses for the same
-    material under section 10.
-
-      9. Acceptance Not Required for Having Copies.
-
-      You are not required to accept this License in order to receive or
-    run a copy of the Program.  Ancillary propagation of a covered work
-    occurring solely as a consequence of using peer-to-peer transmission
-    to receive a copy likewise does not require acceptance.  However,
-    nothing other than this License grants you permission to propagate or
-    modify any covered work.  These actions infringe copyright if you do
-    not accept this License.  Therefore, by modifying or propagating a
-    covered work, you indicate your acceptance of this License to do so.
-
-      10. Automatic Licensing of Downstream Recipients.
-
-      Each time you convey a covered work, the recipient automatically
-    receives a license from the original licensors, to run, modify and
-    propagate that work, subject to this License.  You are not responsible
-    for enforcing compliance by third parties with this License.
-
-      An "entity transaction" is a transaction transferring control of an
-    organization, or substantially all assets of one, or subdividing an
-    organization, or merging organizations.  If propagation of a covered
-    work results from an entity transaction, each party to that
-    transaction who receives a copy of the work also receives whatever
-    licenses to the work the party's predecessor in interest had or could
-    give under the previous paragraph, plus a right to possession of the
-    Corresponding Source of the work from the predecessor in interest, if
-    the predecessor has it or can get it with reasonable efforts.
-
-      You may not impose any further restrictions on the exercise of the
-    rights granted or affirmed under this License.  For example, you may
-    not impose a license fee, royalty, or other charge for exercise of
-    rights granted under this License, and you may not initiate litigation
-    (including a cross-claim or counterclaim in a lawsuit) alleging that
-    any patent claim is infringed by making, using, selling, offering for
-    sale, or importing the Program or any portion of it.
-
-      11. Patents.
-
-      A "contributor" is a copyright holder who authorizes use under this
-    License of the Program or a work on which the Program is based.  The
-    work thus licensed is called the contributor's "contributor version".
-
-      A contributor's "essential patent claims" are all patent claims
-    owned or controlled by the contributor, whether already acquired or
-    hereafter acquired, that would be infringed by some manner, permitted
-    by this License, of making, using, or selling its contributor version,
-    but do not include claims that would be infringed only as a
-    consequence of further modification of the contributor version.  For
-    purposes of this definition, "control" includes the right to grant
-    patent sublicenses in a manner consistent with the requirements of
-    this License.
-
-      Each contributor grants you a non-exclusive, worldwide, royalty-free
-    patent license under the contributor's essential patent claims, to
-    make, use, sell, offer for sale, import and otherwise run, modify and
-    propagate the contents of its contributor version.
-
-      In the following three paragraphs, a "patent license" is any express
-    agreement or commitment, however denominated, not to enforce a patent
-    (such as an express permission to practice a patent or covenant not to
-    sue for patent infringement).  To "grant" such a patent license to a
-    party means to make such an agreement or commitment not to enforce a
-    patent against the party.
-
-      If you convey a covered work, knowingly relying on a patent license,
-    and the Corresponding Source of the work is not available for anyone
-    to copy, free of charge and under the terms of this License, through a
-    publicly available network server or other readily accessible means,
-    then you must either (1) cause the Corresponding Source to be so
-    available, or (2) arrange to deprive yourself of the benefit of the
-    patent license for this particular work, or (3) arrange, in a manner
-    consistent with the requirements of this License, to extend the patent
-    license to downstream recipients.  "Knowingly relying" means you have
-    actual knowledge that, but for the patent license, your conveying the
-    covered work in a country, or your recipient's use of the covered work
-    in a country, would infringe one or more identifiable patents in that
-    country that you have reason to believe are valid.
-
-      If, pursuant to or in connection with a single transaction or
-    arrangement, you convey, or propagate by procuring conveyance of, a
-    covered work, and grant a patent license to some of the parties
-    receiving the covered work authorizing them to use, propagate, modify
-    or convey a specific copy of the covered work, then the patent license
-    you grant is automatically extended to all recipients of the covered
-    work and works based on it.
-
-      A patent license is "discriminatory" if it does not include within
-    the scope of its coverage, prohibits the exercise of, or is
-    conditioned on the non-exercise of one or more of the rights that are
-    specifically granted under this License.  You may not convey a covered
-    work if you are a party to an arrangement with a third party that is
-    in the business of distributing software, under which you make payment
-    to the third party based on the extent of your activity of conveying
-    the work, and under which the third party grants, to any of the
-    parties who would receive the covered work from you, a discriminatory
-    patent license (a) in connection with copies of the covered work
-    conveyed by you (or copies made from those copies), or (b) primarily
-    for and in connection with specific products or compilations that
-    contain the covered work, unless you entered into that arrangement,
-    or that patent license was granted, prior to 28 March 2007.
-
-      Nothing in this License shall be construed as excluding or limiting
-    any implied license or other defenses to infringement that may
-    otherwise be available to you under applicable patent law.
-
-      12. No Surrender of Others' Freedom.
-
-      If conditions are imposed on you (whether by court order, agreement or
-    otherwise) that contradict the conditions of this License, they do not
-    excuse you from the conditions of this License.  If you cannot convey a
-    covered work so as to satisfy simultaneously your obligations under this
-    License and any other pertinent obligations, then as a consequence you may
-    not convey it at all.  For example, if you agree to terms that obligate you
-    to collect a royalty for further conveying from those to whom you convey
-    the Program, the only way you could satisfy both those terms and this
-    License would be to refrain entirely from conveying the Program.
-
-      13. Use with the GNU Affero General Public License.
-
-      Notwithstanding any other provision of this License, you have
-    permission to link or combine any covered work with a work licensed
-    under version 3 of the GNU Affero General Public License into a single
-    combined work, and to convey the resulting work.  The terms of this
-    License will continue to apply to the part which is the covered work,
-    but the special requirements of the GNU Affero General Public License,
-    section 13, concerning interaction through a network will apply to the
-    combination as such.
-
-      14. Revised Versions of this License.
-
-      The Free Software Foundation may publish revised and/or new versions of
-    the GNU General Public License from time to time.  Such new versions will
-    be similar in spirit to the present version, but may differ in detail to
-    address new problems or concerns.
-
-      Each version is given a distinguishing version number.  If the
-    Program specifies that a certain numbered version of the GNU General
-    Public License "or any later version" applies to it, you have the
-    option of following the terms and conditions either of that numbered
-    version or of any later version published by the Free Software
-    Foundation.  If the Program does not specify a version number of the
-    GNU General Public License, you may choose any version ever published
-    by the Free Software Foundation.
-
-      If the Program specifies that a proxy can decide which future
-    versions of the GNU General Public License can be used, that proxy's
-    public statement of acceptance of a version permanently authorizes you
-    to choose that version for the Program.
-
-      Later license versions may give you additional or different
-    permissions.  However, no additional obligations are imposed on any
-    author or copyright holder as a result of your choosing to follow a
-    later version.
-'''
-warranty_str = \
-'''
-      15. Disclaimer of Warranty.
-
-      THERE IS NO WARRANTY FOR THE PROGRAM, TO THE EXTENT PERMITTED BY
-    APPLICABLE LAW.  EXCEPT WHEN OTHERWISE STATED IN WRITING THE COPYRIGHT
-    HOLDERS AND/OR OTHER PARTIES PROVIDE THE PROGRAM "AS IS" WITHOUT WARRANTY
-    OF ANY KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING, BUT NOT LIMITED TO,
-    THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
-    PURPOSE.  THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM
-    IS WITH YOU.  SHOULD THE PROGRAM PROVE DEFECTIVE, YOU ASSUME THE COST OF
-    ALL NECESSARY SERVICING, REPAIR OR CORRECTION.
-
-      16. Limitation of Liability.
-
-      IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING
-    WILL ANY COPYRIGHT HOLDER, OR ANY OTHER PARTY WHO MODIFIES AND/OR CONVEYS
-    THE PROGRAM AS PERMITTED ABOVE, BE LIABLE TO YOU FOR DAMAGES, INCLUDING ANY
-    GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING OUT OF THE
-    USE OR INABILITY TO USE THE PROGRAM (INCLUDING BUT NOT LIMITED TO LOSS OF
-    DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU OR THIRD
-    PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER PROGRAMS),
-    EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE POSSIBILITY OF
-    SUCH DAMAGES.
-
-      17. Interpretation of Sections 15 and 16.
-
-      If the disclaimer of warranty and limitation of liability provided
-    above cannot be given local legal effect according to their terms,
-    reviewing courts shall apply local law that most closely approximates
-    an absolute waiver of all civil liability in connection with the
-    Program, unless a warranty or assumption of liability accompanies a
-    copy of the Program in return for a fee.
-'''
-
 """ KJV indexer and search modules.
 
 BibleSearch:  Can index and search the 'KJV' sword module using different types
@@ -658,10 +33,8 @@ of searches, including the following:
 
 """
 
-from sys import argv, exit
-from cmd import Cmd
-from difflib import get_close_matches
-from functools import wraps
+from sys import exit
+from functools import wraps, lru_cache
 from time import strftime
 from textwrap import fill
 from collections import defaultdict
@@ -1033,8 +406,21 @@ def build_highlight_regx(search_list, case_sensitive, sloppy=False,
 
     """
 
-    if not search_list:
-        return []
+    # The cached list is shared, so return a copy that can be changed.
+    return list(_build_highlight_regx(tuple(search_list), case_sensitive,
+                                      sloppy, color_tag, extra_tag))
+
+
+@lru_cache(maxsize=256)
+def _build_highlight_regx(search_tup, case_sensitive, sloppy, color_tag,
+                          extra_tag):
+    """ Build and cache the tuple of highlight regular expressions for the
+    items in search_tup.
+
+    """
+
+    if not search_tup:
+        return ()
 
     regx_list = []
     # Extra word boundry to catch ansi color escape sequences.
@@ -1043,7 +429,7 @@ def build_highlight_regx(search_list, case_sensitive, sloppy=False,
     # Extra space filler to pass over ansi color escape sequences.
     extra_space = '|{0}|{1}'.format(color_tag, extra_tag)
     # print(word_bound, extra_space, '(?:\033\[[\d+;]*m|\\b)+')
-    for item in search_list:
+    for item in search_tup:
         item = item.strip()
         is_regex = (('*' in item and ' ' not in item) or item.startswith('&'))
         if ('*' in item and ' ' not in item) and  not item.startswith('&'):
@@ -1060,7 +446,29 @@ def build_highlight_regx(search_list, case_sensitive, sloppy=False,
                 word_bound=escaped_word_bound, extra_space=extra_space,
                 sloppy=(sloppy or '~' in item), is_regex=is_regex))
 
-    return regx_list
+    return tuple(regx_list)
+
+
+def regex_cache_info():
+    """ Returns a dictionary of the size, hits, misses, and hit rate of the
+    compiled search and highlight regular expression caches.
+
+    """
+
+    info_dict = {}
+    for name, func in (('search_terms_to_regex', Search._terms_regex),
+                       ('build_highlight_regx', _build_highlight_regx),
+                       ('partial_word_regex', partial_word_regex)):
+        hits, misses, maxsize, currsize = func.cache_info()
+        info_dict[name] = {
+            'size': currsize,
+            'maxsize': maxsize,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    return info_dict
 
 
 def mod_lookup(mod, items):
@@ -1426,12 +834,40 @@ class Search(object):
         self._module_name = module
         self._multi = multiword
 
+    def open(self):
+        """ Open the index now, instead of when it is first searched.
+
+        """
+
+        self._index_dict.open()
+
+    def reopen(self):
+        """ Reopen the index database after a fork, keeping the items that
+        are already loaded.
+
+        """
+
+        self._index_dict.reopen()
+
     @classmethod
     def search_terms_to_regex(cls, search_terms, case_sensitive,
                               word_bound='\\\\b', extra_space='',
                               sloppy=False, is_regex=False):
         """ Build a regular expression from the search_terms to match a verse
-        in the Bible.
+        in the Bible.  The compiled regular expressions are cached, so
+        repeated terms don't have to be built again.
+
+        """
+
+        return cls._terms_regex(search_terms, case_sensitive, word_bound,
+                                extra_space, sloppy, is_regex)
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _terms_regex(cls, search_terms, case_sensitive, word_bound,
+                     extra_space, sloppy, is_regex):
+        """ Build and cache the compiled regular expression for
+        search_terms_to_regex.
 
         """
 
@@ -1590,29 +1026,32 @@ class Search(object):
                 # Combine the terms for use by the different methods.
                 search_terms = ' '.join(search_terms)
 
-            # Get a valid set of verse references that conform to the passed
-            # range.
-            range_set = parse_verse_range(range_str)
-
-            if func.__name__ not in ['regex_search', 'partial_word_search']:
-                # Try to catch and fix any Strong's Numbers or Morphological
-                # Tags.
-                search_terms = self._fix_strongs_morph(search_terms)
-
-            # Regular expression and combined searches get the search terms as
-            # they were passed.
-            if func.__name__ in ['multiword_search', 'anyword_search',
-                                 'phrase_search', 'mixed_phrase_search']:
-                # Get rid of any non-alphanumeric or '-' characters from
-                # the search string.
-                search_str = self._clean_text(search_terms).strip()
-                if strongs or morph:
-                    # Strong's numbers and Morphological tags are all
-                    # uppercase.  This is only required if the Morphological
-                    # Tags were not surrounded by parenthesis.
-                    search_str = search_str.upper().strip()
-            else:
-                search_str = search_terms
+            with timed_stage('search.parse'):
+                # Get a valid set of verse references that conform to the
+                # passed range.
+                range_set = parse_verse_range(range_str)
+
+                if func.__name__ not in ['regex_search',
+                                         'partial_word_search']:
+                    # Try to catch and fix any Strong's Numbers or
+                    # Morphological Tags.
+                    search_terms = self._fix_strongs_morph(search_terms)
+
+                # Regular expression and combined searches get the search
+                # terms as they were passed.
+                if func.__name__ in ['multiword_search', 'anyword_search',
+                                     'phrase_search', 'mixed_phrase_search']:
+                    # Get rid of any non-alphanumeric or '-' characters from
+                    # the search string.
+                    search_str = self._clean_text(search_terms).strip()
+                    if strongs or morph:
+                        # Strong's numbers and Morphological tags are all
+                        # uppercase.  This is only required if the
+                        # Morphological Tags were not surrounded by
+                        # parenthesis.
+                        search_str = search_str.upper().strip()
+                else:
+                    search_str = search_terms
 
             # Get the set of found verses.
             found_set = func(self, search_str, strongs, morph, added,
@@ -1772,8 +1211,9 @@ class Search(object):
 
         # All that needs to be done is find all references with all the
         # searched words in them.
-        found_set = self._index_dict.value_intersect(search_terms.split(),
-                                                     case_sensitive)
+        with timed_stage('search.postings'):
+            found_set = self._index_dict.value_intersect(search_terms.split(),
+                                                         case_sensitive)
 
         return found_set
 
@@ -1798,8 +1238,9 @@ class Search(object):
                    "'%s'..." % ', '.join(search_terms.split()), tag=1)
 
         # Any verse with one and only one of the searched words.
-        found_set = self._index_dict.value_sym_diff(search_terms.split(),
-                                                    case_sensitive)
+        with timed_stage('search.postings'):
+            found_set = self._index_dict.value_sym_diff(search_terms.split(),
+                                                        case_sensitive)
 
         return found_set
 
@@ -1824,8 +1265,9 @@ class Search(object):
                    "'%s'..." % ', '.join(search_terms.split()), tag=1)
 
         # Any verse with one or more of the searched words.
-        found_set = self._index_dict.value_union(search_terms.split(),
-                                                 case_sensitive)
+        with timed_stage('search.postings'):
+            found_set = self._index_dict.value_union(search_terms.split(),
+                                                     case_sensitive)
 
         return found_set
 
@@ -1855,7 +1297,9 @@ class Search(object):
                 #self._words_from_partial(search_terms, case_sensitive),
                 #case_sensitive)
         search_list = search_terms.split()
-        found_set = self._index_dict.from_partial(search_list, case_sensitive)
+        with timed_stage('search.postings'):
+            found_set = self._index_dict.from_partial(search_list,
+                                                      case_sensitive)
 
         return found_set
 
@@ -1864,22 +1308,15 @@ class Search(object):
 
         """
 
-        flags = re.I if not case_sensitive else 0
+        # Compile the regular expressions once instead of once for every
+        # word in the index.
+        regx_list = [partial_word_regex(partial_word, case_sensitive)
+                     for partial_word in partial_word_list.split()]
 
-        # Split the search terms and search through each word key in the index
-        # for any word that contains the partial word.
-        word_list = partial_word_list.split()
+        # Search through each word key in the index for any word that
+        # contains the partial word.
         for word in self._index_dict['_words_']:
-            for partial_word in word_list:
-                # A Regular expression that matches any number of word
-                # characters for every '*' in the term.
-                reg_str = '\\b%s\\b' % partial_word.replace('*', '\w*')
-                try:
-                    word_regx = re.compile(reg_str, flags)
-                except Exception as err:
-                    print('There is a problem with the regular expression '
-                          '%s: %s' % (reg_str, err), file=sys.stderr)
-                    exit()
+            for word_regx in regx_list:
                 if word_regx.match(word):
                     yield word
 
@@ -1904,16 +1341,17 @@ class Search(object):
             # First make sure we are only searching verses that have all the
             # search terms in them.
             search_list = search_terms.split()
-            if '*' in search_terms:
-                ref_set = self._index_dict.from_partial(search_list,
-                                                        case_sensitive,
-                                                        common_limit=5000)
-            else:
-                ref_set = self._index_dict.value_intersect(search_list,
-                                                           case_sensitive)
-            if range_str:
-                # Only search through the supplied range.
-                ref_set.intersection_update(range_str)
+            with timed_stage('search.postings'):
+                if '*' in search_terms:
+                    ref_set = self._index_dict.from_partial(search_list,
+                                                            case_sensitive,
+                                                            common_limit=5000)
+                else:
+                    ref_set = self._index_dict.value_intersect(search_list,
+                                                               case_sensitive)
+                if range_str:
+                    # Only search through the supplied range.
+                    ref_set.intersection_update(range_str)
 
             # No need to search for a single word phrase.
             if len(search_terms.split()) == 1:
@@ -2063,6 +1501,16 @@ class Search(object):
 
         """
 
+        with timed_stage('search.verify'):
+            return self._find_from_regex(ref_iter, search_regex, strongs,
+                                         morph, added, tag, try_clean)
+
+    def _find_from_regex(self, ref_iter, search_regex, strongs, morph, added,
+                         tag, try_clean):
+        """ Do the work of find_from_regex.
+
+        """
+
         # Get an iterator that will return tuples
         # (verse_reference, verse_text).
         verse_iter = IndexedVerseTextIter(ref_iter, strongs=strongs,
@@ -2159,8 +1607,9 @@ class Search(object):
             morph = bool(self._morph_regx.match(term.upper()))
 
             # Search for words or phrases.
-            temp_set = search_func(term, strongs, morph, added, case_sensitive,
-                                   range_str)
+            with timed_stage('search.%s' % search_func.__name__):
+                temp_set = search_func(term, strongs, morph, added,
+                                       case_sensitive, range_str)
 
             # Add the results to the correct set.
             combine_func(temp_set)
@@ -2618,756 +2067,3 @@ class Search(object):
         return set()
 
     concordance_search = test4_search
-
-
-class SearchCmd(Cmd):
-    """ A Command line interface for searching the Bible.
-
-    """
-
-    def __init__(self, module='KJV'):
-        """ Initialize the settings.
-
-        """
-
-        self.prompt = '\001[33m\002search\001[m\002> '
-        self.intro = '''
-    %s  Copyright (C) 2011  Josiah Gordon <josiahg@gmail.com>
-    This program comes with ABSOLUTELY NO WARRANTY; for details type `show w'.
-    This is free software, and you are welcome to redistribute it
-    under certain conditions; type `show c' for details.
-
-        This is a Bible search program that searches the KJV
-        sword module.  If you need help type 'help' to display a list of valid
-        commands.  For help on a specific command type 'help <command>.'
-
-        Examples:
-
-        mixed 'jordan h03383'   (Finds all verses with Strong's number 'H03383'
-                                 translated 'Jordan')
-
-        concordance live        (Lists the references of all the verses with
-                                 the word 'live' in them, the Strong's number
-                                 that was used, and what the phrase is that
-                                 that Strong's number is translated as.)
-
-        concordance h02418      (Lists the references of all the verses with
-                                 the Strong's number 'H02418' and how it was
-                                 translated.  It only occures six times and all
-                                 of them are in Daniel.)
-
-        strongs h02418          (Looks up and gives the definition of the
-                                 Strong's number 'H02418.')
-
-        set range gen-mal       (Sets the range to the Old Testament.)
-
-        Just about everything has tab-completion, so you can hit tab a couple
-        of times to see all the completions to what you are typing.
-
-        If you want to see this intro again type: 'intro'
-
-        To find out more type 'help'
-
-        (example: 'help search' will list the help for the search command.)
-
-        To exit type 'quit' or hit 'CTRL+D'
-
-        ''' % os.path.basename(argv[0])
-        super(SearchCmd, self).__init__()
-        self._quoted_regex = re.compile('''
-                            ((?P<quote>'|")
-                            .*?
-                            (?P=quote)|[^'"]*)
-                            ''', re.X)
-
-        # Perform the specified search.
-        self._search = Search(module=module)
-        self._results = set()
-        self._search_list = []
-        self._highlight_list = []
-        self._words = self._search._index_dict['_words_']
-        self._strongs = self._search._index_dict['_strongs_']
-        self._morph = self._search._index_dict['_morph_']
-        self._book_list = list(book_gen())
-        self._setting_dict = {
-                'search_type': 'mixed',
-                'search_strongs': False,
-                'search_morph': False,
-                'case_sensitive': False,
-                'context': 0,
-                'one_line': False,
-                'show_notes': False,
-                'show_strongs': False,
-                'show_morph': False,
-                'added': True,
-                'range': '',
-                'extras': (),
-                'module': module,
-                }
-        self._search_types = ['mixed', 'mixed_phrase', 'multiword', 'anyword',
-                              'combined', 'partial_word', 'ordered_multiword',
-                              'regex', 'eitheror', 'sword_lucene',
-                              'sword_phrase', 'sword_multiword',
-                              'sword_entryattrib']
-
-    def _complete(self, text, line, begidx, endidx, complete_list):
-        """ Return a list of matching text.
-
-        """
-
-        retlist = [i for i in complete_list if i.startswith(text)]
-        if not retlist:
-            # If nothing was found try words that contain the text.
-            retlist = [i for i in complete_list if text in i]
-        if not retlist:
-            # Finally try matching misspelled words.
-            retlist = get_close_matches(text, complete_list, cutoff=0.7)
-        return retlist
-
-    def _get_list(self, args):
-        """ Split the args into quoted strings and seperate words.
-
-        """
-
-        arg_list = []
-
-        # Split the arg string into quoted phrases and single words.
-        for i, c in self._quoted_regex.findall(args):
-            if c in ['"', "'"]:
-                arg_list.append(i.strip(c))
-            else:
-                arg_list.extend(i.split())
-
-        return arg_list
-
-    def do_test(self, args):
-        """ A Test.
-
-        """
-
-        quoted_regex = re.compile('''((?P<quote>'|").*?(?P=quote)|[^'"]*)''')
-        print(quoted_regex.findall(args))
-        print(self._get_list(args))
-
-    def _print(self, text_iter):
-        """ Print all the text breaking it and screens so the user can read it
-        all.
-
-        """
-
-        count = 0
-        for verse in text_iter:
-            count += len(verse.splitlines()) if '\n' in verse else 1
-            print(verse)
-            if count >= screen_size()[0] - 4:
-                count = 0
-                try:
-                    input('[Press enter to see more, or CTRL+D to end.]')
-                    print('[1A[K', end='')
-                except:
-                    print('[G[K', end='')
-                    break
-
-    def precmd(self, line):
-        """ Set the correct settings before running the line.
-
-        """
-
-        if not line:
-            return line
-
-        cmd = line.split()[0]
-        if cmd in self._search_types:
-            search_type = cmd
-            if search_type.startswith('sword_'):
-                self._setting_dict['extras'] = (search_type[6:],)
-                search_type = search_type[:5]
-            else:
-                self._setting_dict['extras'] = ()
-            self._setting_dict['search_type'] = search_type
-        return line
-
-    def postcmd(self, stop, line):
-        """ If lookup was called then show the results.
-
-        """
-
-        if not line:
-            return stop
-
-        cmd = line.split()[0]
-        if cmd == 'lookup':
-            self.onecmd('show_results')
-        return stop
-
-    def completedefault(self, text, line, begidx, endidx):
-        """ By default complete words in the Bible.
-
-        """
-
-        words_list = self._words
-        return self._complete(text, line, begidx, endidx, words_list)
-
-    def do_shell(self, args):
-        """ Execute shell commands.
-
-        """
-
-        os.system(args)
-
-    def do_concordance(self, args):
-        """ Perform a concordance like search.
-
-        """
-
-        if not args:
-            return
-
-        arg_list = self._get_list(args)
-
-        # Search.
-        strongs_search = self._setting_dict['search_strongs']
-        morph_search = self._setting_dict['search_morph']
-        search_range = self._setting_dict['range']
-        case_sensitive = self._setting_dict['case_sensitive']
-        search_added = self._setting_dict['added']
-        self._search.test4_search(arg_list, strongs_search, morph_search,
-                                  search_added, case_sensitive, search_range)
-
-    def do_show(self, args):
-        """ Show relevent parts of the GPL.
-
-        """
-
-        if args.lower() in ['c', 'copying']:
-            # Show the conditions.
-            print(copying_str)
-        elif args.lower() in ['w', 'warranty']:
-            # Show the warranty.
-            print(warranty_str)
-        else:
-            # Show the entire license.
-            print('%s%s' % (copying_str, warranty_str))
-
-    def do_EOF(self, args):
-        """ Exit when eof is recieved.
-
-        """
-
-        return True
-
-    def do_quit(self, args):
-        """ Exit.
-
-        """
-
-        return True
-
-    def do_help(self, args):
-        """ Print the help.
-
-        """
-
-        if args:
-            try:
-                self._print(getattr(self, 'do_%s' % args).__doc__.splitlines())
-                return
-            except:
-                pass
-        super(SearchCmd, self).do_help(args)
-
-    def do_intro(self, args):
-        """ Re-print the intro screen.
-
-        """
-
-        self._print(self.intro.splitlines())
-
-    def complete_show_results(self, text, line, begidx, endidx):
-        """ Tab completion for the show_results command.
-
-        """
-
-        cmd_list = ['strongs', 'morph', 'notes', 'one_line']
-        return self._complete(text, line, begidx, endidx, cmd_list)
-
-    def do_show_results(self, args):
-        """ Output the results.
-
-        Print out all the verses that were either found by searching or by
-        lookup.
-
-        Extra arguments:
-            +/-strongs      -   Enable/disable strongs in the output.
-            +/-morph        -   Enable/disable morphology in the output
-            +/-notes        -   Enable/disable foot notes in the output.
-            +/-added        -   Enable/disable added text in the output.
-            +/-one_line     -   Enable/disable one line output.
-            anything else   -   If the output is from looking up verses with
-                                the lookup command, then any other words or
-                                quoted phrases given as arguments will be
-                                highlighted in the output.
-
-        """
-
-        search_type = self._setting_dict['search_type']
-        strongs_search = self._setting_dict['search_strongs']
-        morph_search = self._setting_dict['search_morph']
-        search_range = self._setting_dict['range']
-        case_sensitive = self._setting_dict['case_sensitive']
-        search_added = self._setting_dict['added']
-        module_name = self._setting_dict['module']
-        highlight_list = self._highlight_list
-        kwargs = self._setting_dict
-        results = self._results
-
-        # Get the output arguments.
-        show_strongs = self._setting_dict['show_strongs'] or strongs_search
-        show_morph = self._setting_dict['show_morph'] or morph_search
-        show_notes = self._setting_dict['show_notes']
-        one_line = self._setting_dict['one_line']
-
-        arg_list = self._get_list(args)
-
-        if '+strongs' in arg_list:
-            show_strongs = True
-            arg_list.remove('+strongs')
-        if '+morph' in args:
-            show_morph = True
-            arg_list.remove('+morph')
-        if '-strongs' in args:
-            show_strongs = False
-            arg_list.remove('-strongs')
-        if '-morph' in args:
-            show_strongs = False
-            arg_list.remove('-morph')
-        if '+notes' in args:
-            show_notes = True
-            arg_list.remove('+notes')
-        if '-notes' in args:
-            show_notes = False
-            arg_list.remove('-notes')
-        if '+one_line' in args:
-            one_line = True
-            arg_list.remove('+one_line')
-        if '-one_line' in args:
-            one_line = False
-            arg_list.remove('-one_line')
-        if '+added' in args:
-            search_added = True
-            arg_list.remove('+added')
-        if '-added' in args:
-            search_added = False
-            arg_list.remove('-added')
-
-        if search_range:
-            results.intersection_update(parse_verse_range(search_range))
-
-        if not highlight_list:
-            # Highlight anything else the user typed in.
-            highlight_list = arg_list
-
-        # Don't modify regular expression searches.
-        if search_type != 'regex':
-            regx_list = build_highlight_regx(highlight_list, case_sensitive,
-                        (search_type == 'ordered_multiword'))
-            if kwargs['context']:
-                regx_list.extend(build_highlight_regx(results, case_sensitive))
-        else:
-            arg_str = ' '.join(arg_list)
-            regx_list = [re.compile(arg_str, re.I if case_sensitive else 0)]
-
-        # Flags for the highlight string.
-        flags = re.I if not case_sensitive else 0
-        # Add the specified number of verses before and after to provide
-        # context.
-        context_results = sorted(add_context(results, kwargs['context']),
-                                 key=sort_key)
-        # Get a formated verse string generator.
-        verse_gen = render_verses_with_italics(context_results,
-                                               not one_line,
-                                               show_strongs, show_morph,
-                                               search_added,
-                                               show_notes,
-                                               highlight_search_terms,
-                                               module_name, regx_list,
-                                               highlight_text, flags)
-        if one_line:
-            # Print it all on one line.
-            print('  '.join(verse_gen))
-        else:
-            # Print the verses on seperate lines.
-            self._print(verse_gen)
-            #print('\n'.join(verse_gen))
-
-    def complete_lookup(self, text, line, begidx, endidx):
-        """ Try to complete Verse references.
-
-        """
-
-        name_list = self._book_list
-        text = text.capitalize()
-        return self._complete(text, line, begidx, endidx, name_list)
-
-    def do_lookup(self, args):
-        """ Lookup the verses by references.
-
-        Example:    lookup gen1:3-5;mal3    (Look up Genesis chapter 1 verses
-                                            3-5 and Malachi chapter 3.)
-
-        """
-
-        self._results = parse_verse_range(args)
-        self._highlight_list = []
-
-    def complete_strongs(self, text, line, begidx, endidx):
-        """ Tabe complete Strong's numbers.
-
-        """
-        text = text.capitalize()
-        return self._complete(text, line, begidx, endidx, self._strongs)
-
-    def do_strongs(self, numbers):
-        """ Lookup one or more Strong's Numbers.
-
-        strongs number,number,number....
-
-        """
-
-        # Lookup all the Strong's Numbers in the argument list.
-        # Make all the numbers seperated by a comma.
-        strongs_list = ','.join(numbers.upper().split()).split(',')
-        #TODO: Find what Strong's Modules are available and use the best,
-        #      or let the user decide.
-        greek_strongs_lookup = Lookup('StrongsRealGreek')
-        hebrew_strongs_lookup = Lookup('StrongsRealHebrew')
-        for strongs_num in strongs_list:
-            # Greek Strong's Numbers start with a 'G' and Hebrew ones start
-            # with an 'H.'
-            if strongs_num.upper().startswith('G'):
-                mod_name = 'StrongsRealGreek'
-            else:
-                mod_name = 'StrongsRealHebrew'
-            print('%s\n' % mod_lookup(mod_name, strongs_num[1:]))
-
-    def complete_morph(self, text, line, begidx, endidx):
-        """ Tabe complete Morphological Tags.
-
-        """
-        text = text.capitalize()
-        return self._complete(text, line, begidx, endidx, self._morph)
-
-    def do_morph(self, tags):
-        """ Lookup one or more Morphological Tags.
-
-        morph tag,tag,tag....
-
-        """
-
-        # Lookup all the Morphological Tags in the argument list.
-        # I don't know how to lookup Hebrew morphological tags, so I
-        # only lookup Greek ones in 'Robinson.'
-        print('%s\n' % mod_lookup('Robinson', tags.upper()))
-
-    def do_websters(self, words):
-        """ Lookup one or more words in Websters Dictionary.
-
-        websters word,word,word...
-
-        """
-
-        # Lookup words in the dictionary.
-        print('%s\n' % mod_lookup('WebstersDict', words))
-
-    def do_kjvd(self, words):
-        """ Lookup one or more words in the KJV Dictionary.
-
-        kjvd word,word,word...
-
-        """
-
-        # Lookup words in the KJV dictionary.
-        print('%s\n' % mod_lookup('KJVD', words))
-
-    def do_daily(self, daily):
-        """ Display a daily devotional from 'Bagsters Daily light.'
-
-        daily date/today
-
-        Dates are given in the format Month.Day.  The word 'today' is an alias
-        to today's date.  The default is to lookup today's devotional.
-
-        """
-
-        daily = 'today' if not daily else daily
-
-        # Lookup the specified daily devotional.
-        if daily.lower() == 'today':
-            # Today is an alias for today's date.
-            daily = strftime('%m.%d')
-        daily_lookup = Lookup('Daily')
-        # Try to make the output nicer.
-        print(daily_lookup.get_formatted_text(daily))
-
-    def complete_set(self, text, line, begidx, endidx):
-        """ Complete setting options.
-
-        """
-
-        setting_list = self._setting_dict.keys()
-        return self._complete(text, line, begidx, endidx, setting_list)
-
-    def do_set(self, args):
-        """ Set settings.
-
-        Run without arguments to see the current settings.
-
-        set show_strongs = True/False   -   Enable strongs numbers in the
-                                            output.
-        set show_morph = True/False     -   Enable morphology in the output.
-        set context = <number>          -   Show <number> verses of context.
-        set case_sensitive = True/False -   Set the search to case sensitive.
-        set range = <range>             -   Confine search/output to <range>.
-        set one_line = True/False       -   Don't break output at verses.
-        set added = True/False          -   Show/search added text.
-        set show_notes = True/False     -   Show foot-notes in output.
-        set search_type = <type>        -   Use <type> for searching.
-        set search_strongs = True/False -   Search Strong's numbers
-                                            (deprecated).
-        set search_morph = True/False   -   Search Morphological Tags
-                                            (deprecated).
-
-        """
-
-        if not args:
-            print("Current settings:\n")
-            max_len = len(max(self._setting_dict.keys(), key=len))
-            for setting, value in self._setting_dict.items():
-                if setting.lower() == 'range':
-                    if not Sword:
-                        value = VerseRange.parse_range(value)
-                        value = '; '.join(str(i) for i in value)
-                    else:
-                        key = Sword.VerseKey()
-                        range_list = key.parseVerseList(value, 'Genesis 1:1',
-                                                        True, False)
-                        value = range_list.getRangeText()
-                print('{1:{0}} = {2}'.format(max_len, setting, value))
-            print()
-        else:
-            for setting in args.split(';'):
-                if '=' in setting:
-                    k, v = setting.split('=')
-                elif ' ' in setting:
-                    k, v = setting.split()
-                else:
-                    print(self._setting_dict.get(setting, ''))
-                    continue
-                k = k.strip()
-                v = v.strip()
-                if isinstance(v, str):
-                    if v.lower() == 'false':
-                        v = False
-                    elif v.lower() == 'true':
-                        v = True
-                    elif v.isdigit():
-                        v = int(v)
-                self._setting_dict[k] = v
-
-    def complete_search(self, text, line, begidx, endidx):
-        """ Bible word completion to make searching easier.
-
-        """
-
-        words_list = self._words
-        return self._complete(text, line, begidx, endidx, words_list)
-
-    complete_mixed = complete_search
-    complete_mixed_phrase = complete_search
-    complete_multiword = complete_search
-    complete_anyword = complete_search
-    complete_combined = complete_search
-    complete_partial_word = complete_search
-    complete_ordered_multiword = complete_search
-    complete_regex = complete_search
-    complete_eitheror = complete_search
-    complete_sword_lucene = complete_search
-    complete_sword_phrase = complete_search
-    complete_sword_multiword = complete_search
-    complete_sword_entryattrib = complete_search
-
-    def do_search(self, args):
-        """ Search the Bible.
-
-        Search types are:
-
-            mixed               -   A search made up of a mix of most of the
-                                    other search types.  Put an '!' in front of
-                                    words/phrases that you don't want in any of
-                                    the results.
-            mixed_phrase        -   A phrase search that can include words,
-                                    Strong's, and Morphology.  Can be used in
-                                    the mixed search by including words in
-                                    quotes.
-            multiword           -   Search for verses containing each word at
-                                    least once.  Use in the mixed search by
-                                    putting a '+' in front of any word/phrase
-                                    you want to be in all the results.
-            anyword             -   Search for verses containing one or more of
-                                    any of the words.  Use in the mixed search
-                                    by putting a '|' in front of any
-                                    word/phrase you want in any but not
-                                    necessarily all the results.
-            eitheror            -   Search for verses containing one and only
-                                    one of the words.  In the mixed search put
-                                    a '^' in front of two or more words/phrases
-                                    to make the results contain one and only
-                                    one of the marked search terms.
-            combined            -   Search using a phrase like ('in' AND ('the'
-                                    OR 'it')) finding verses that have both
-                                    'in' and 'the' or both 'in' and 'it'.
-                                    To do the same thing with the mixed search
-                                    use a phrase like this:
-                                    (mixed '+in' '^the' '^it').
-            partial_word        -   Search for partial words (e.g. a search for
-                                    'begin*' would find all the words starting
-                                    with 'begin'.)  Use in the mixed search to
-                                    make partial words in a phrase.
-            ordered_multiword   -   Search for words in order, but not
-                                    necessarily in a phrase.  In the mixed
-                                    search put a '~' in front of any quoted
-                                    group of words you want to be in that
-                                    order, but you don't mind if they have
-                                    other words between them.
-            regex               -   A regular expression search (slow).
-
-
-        Examples:
-
-            mixed               -   (mixed '+~in the beg*' '!was') finds any
-                                    verse that has the words 'in', 'the', and
-                                    any word starting with 'beg', in order, but
-                                    not the word 'was.'
-            mixed_phrase        -   (mixed_phrase 'h011121 of gomer') finds any
-                                    verse with that phrase.
-
-            mixed search flags first column prefix (these should come first):
-            ----------------------------------------------------------------
-            ! = not (not in any of the results)
-            + = all (in all the results)
-            | = or  (in at least one result)
-            ^ = exclusive or (only one in any of the results)
-
-            not example: (mixed 'in the beginning' !was) results will have the
-                         phrase 'in the beginning' but will not have the word
-                         'was.'
-            all example: (mixed 'in the beginning' +was) results may have the
-                         phrase 'in the beginning' but all of them will have
-                         the word 'was.' (note. this will find all verses with
-                         the word 'was' in them if you want it to have the
-                         phrase 'in the beginning' also you have to prefix it
-                         with a '+' aswell)
-            or example: (mixed 'in the beginning' |was) results will be all the
-                        verses with the phrase 'in the beginning' and all the
-                        verses with the word 'was.'  This is the default way
-                        the mixed search operates, so the '|' can be excluded
-                        in this case.
-            exclusive or example: (mixed '^in the beginning' '^was') results
-                                  will either have the phrase 'in the
-                                  beginning' or the word 'was', but not both.
-                                  To be effective you must have at least two
-                                  search terms prefixed with '^.'
-
-            mixed search flags second column prefix (these come after the first
-            column flags):
-            -------------------------------------------------------------------
-            ~ = sloppy phrase or ordered multiword
-            & = regular expression search.
-
-            sloppy phrase example: (mixed '~in the beginning') results will
-                                   have all the words 'in', 'the', and
-                                   'beginning,' but they may have other words
-                                   between them.
-            regular expression example:
-            (mixed '&\\b[iI]n\\b\s+\\b[tT[Hh][eE]\\b\s+\\b[bB]eginning\\b')
-            results will be all the verses with the phrase 'in the beginning.'
-
-        """
-
-        if not args:
-            return
-
-        arg_list = self._get_list(args)
-        arg_str = ' '.join(arg_list)
-        self._search_list = arg_list
-
-        extras = self._setting_dict['extras']
-        search_type = self._setting_dict['search_type']
-
-        try:
-            # Get the search function asked for.
-            search_func = getattr(self._search, '%s_search' % search_type)
-        except AttributeError as err:
-            # An invalid search type was specified.
-            print("Invalid search type: %s" % search_type, file=sys.stderr)
-            exit()
-
-        # Search.
-        strongs_search = self._setting_dict['search_strongs']
-        morph_search = self._setting_dict['search_morph']
-        search_range = self._setting_dict['range']
-        case_sensitive = self._setting_dict['case_sensitive']
-        search_added = self._setting_dict['added']
-        self._results = search_func(arg_list, strongs_search, morph_search,
-                                    search_added, case_sensitive, search_range,
-                                    *extras)
-        count = len(self._results)
-        info_print("\nFound %s verse%s.\n" % \
-                   (count, 's' if count != 1 else ''),
-                   tag=-10)
-        print("To view the verses type 'show_results.'")
-
-        if search_type in ['combined', 'combined_phrase']:
-            # Combined searches are complicated.
-            # Parse the search argument and build a highlight string from the
-            # result.
-            arg_parser = CombinedParse(arg_str)
-            parsed_args = arg_parser.word_list
-            not_l = arg_parser.not_list
-            # Remove any stray '+'s.
-            #highlight_str = highlight_str.replace('|+', ' ')
-            if search_type == 'combined_phrase':
-                # A phrase search needs to highlight phrases.
-                highlight_list = parsed_args
-            else:
-                highlight_list = ' '.join(parsed_args).split()
-        # Build the highlight string for the other searches.
-        elif search_type in ['anyword', 'multiword', 'eitheror',
-                             'partial_word']:
-            # Highlight each word separately.
-            highlight_list = arg_str.split()
-        elif search_type == 'mixed':
-            # In mixed search phrases are in quotes so the arg_list should be
-            # what we want, but don't include any !'ed words.
-            highlight_list = [i for i in arg_list if not i.startswith('!')]
-        elif search_type in ['phrase', 'mixed_phrase', 'ordered_multiword']:
-            # Phrases should highlight phrases.
-            highlight_list = [arg_str]
-        elif search_type == 'sword':
-            highlight_list = arg_list
-
-        self._highlight_list = highlight_list
-
-    do_mixed = do_search
-    do_mixed_phrase = do_search
-    do_multiword = do_search
-    do_anyword = do_search
-    do_combined = do_search
-    do_partial_word = do_search
-    do_ordered_multiword = do_search
-    do_regex = do_search
-    do_eitheror = do_search
-    do_sword_lucene = do_search
-    do_sword_phrase = do_search
-    do_sword_multiword = do_search
-    do_sword_entryattrib = do_search
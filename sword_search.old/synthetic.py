@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# A synthetic KJV corpus for building and benchmarking without sword.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A synthetic corpus with the KJV's 31,102 verses, in the raw OSIS the
+sword KJV module has: nearly every word has a Strong's number, the Old
+Testament verbs and every New Testament word have a morphological tag, and
+there are paragraph milestones, study notes, added words, the divine name,
+psalm titles, and the words of Jesus in red.  The words are drawn from a
+Zipf distribution over a fixed vocabulary, so the index has about the
+KJV's shape, and a few real verses are kept as fixtures for tests to check.
+The same seed always gives the same corpus.
+
+Lookup and VerseTextIter are stand-ins for the ones in verses, backed by
+the corpus instead of the dbm files.  Run this to write all the dbm files
+the search engine and the web app need into the index path:
+
+    HOME=/tmp/ci python -m sword_search.synthetic
+
+"""
+
+from datetime import date, timedelta
+from itertools import accumulate
+from functools import lru_cache
+from os.path import join as os_join
+import argparse
+import random
+import os
+
+from .utils import *
+from .verses import Lookup as DbmLookup
+from .verses import VerseTextIter as DbmVerseTextIter
+from .verses import *
+
+
+# Real verses, so tests can check exact text.
+fixture_verses = {
+    'Genesis 1:1': (
+        '<w lemma="strong:H07225">In the beginning</w> '
+        '<w lemma="strong:H0430">God</w> '
+        '<w lemma="strong:H0853 strong:H01254" morph="strongMorph:TH8804">'
+        'created</w> <w lemma="strong:H08064">the heaven</w> '
+        '<w lemma="strong:H0853">and</w> <w lemma="strong:H0776">the earth'
+        '</w>.'),
+    'Genesis 1:3': (
+        '<w lemma="strong:H0559" morph="strongMorph:TH8799">And</w> '
+        '<w lemma="strong:H0430">God</w> said, '
+        '<w lemma="strong:H01961" morph="strongMorph:TH8799">Let there be'
+        '</w> <w lemma="strong:H0216">light</w>: '
+        '<w lemma="strong:H01961" morph="strongMorph:TH8799">and there was'
+        '</w> <w lemma="strong:H0216">light</w>.'),
+    'Psalms 23:1': (
+        '<title canonical="true" type="psalm">A Psalm of '
+        '<w lemma="strong:H01732">David</w>.</title> '
+        '<w lemma="strong:H03068"><divineName>Lord</divineName></w> '
+        '<transChange type="added">is</transChange> my '
+        '<w lemma="strong:H07462" morph="strongMorph:TH8802">shepherd</w>; '
+        'I shall not <w lemma="strong:H02637" morph="strongMorph:TH8799">'
+        'want</w>.'),
+    'John 3:16': (
+        '<q marker="" who="Jesus"><w lemma="strong:G1063" morph="robinson:CONJ">'
+        'For</w> <w lemma="strong:G2316" morph="robinson:N-NSM">God</w> '
+        '<w lemma="strong:G3779" morph="robinson:ADV">so</w> '
+        '<w lemma="strong:G25" morph="robinson:V-AAI-3S">loved</w> '
+        '<w lemma="strong:G2889" morph="robinson:N-ASM">the world</w>, '
+        '<w lemma="strong:G5620" morph="robinson:CONJ">that</w> '
+        '<w lemma="strong:G1325" morph="robinson:V-AAI-3S">he gave</w> '
+        '<w lemma="strong:G846" morph="robinson:P-GSM">his</w> '
+        '<w lemma="strong:G3439" morph="robinson:A-ASM">only begotten</w> '
+        '<w lemma="strong:G5207" morph="robinson:N-ASM">Son</w>, '
+        '<w lemma="strong:G2443" morph="robinson:CONJ">that</w> '
+        '<w lemma="strong:G3956" morph="robinson:A-NSM">whosoever</w> '
+        '<w lemma="strong:G4100" morph="robinson:V-PAP-NSM">believeth</w> '
+        '<w lemma="strong:G1519" morph="robinson:PREP">in</w> '
+        '<w lemma="strong:G846" morph="robinson:P-ASM">him</w> should '
+        '<w lemma="strong:G3361" morph="robinson:PRT-N">not</w> '
+        '<w lemma="strong:G622" morph="robinson:V-2AMS-3S">perish</w>, '
+        '<w lemma="strong:G235" morph="robinson:CONJ">but</w> '
+        '<w lemma="strong:G2192" morph="robinson:V-PAS-3S">have</w> '
+        '<w lemma="strong:G166" morph="robinson:A-ASF">everlasting</w> '
+        '<w lemma="strong:G2222" morph="robinson:N-ASF">life</w>.</q>'),
+    'John 11:35': (
+        '<w lemma="strong:G2424" morph="robinson:N-NSM">Jesus</w> '
+        '<w lemma="strong:G1145" morph="robinson:V-AAI-3S">wept</w>.'),
+}
+
+# The most common words, in about the order of how often the KJV uses them.
+common_words = '''
+the and of to that in he shall unto for I his a lord they be is him not
+them it with all thou thy was God which my me said but ye their have will
+thee from as are when this out were upon man by you Israel king up there
+hath then people came had house into on her before also come one which
+children land day even so let against son shall hand men now saying go
+made went say away may if what because therefore brought over earth
+things neither city did great after every should then these father place
+spake name no word down sons thus behold servant unto many heart days
+among an saith David forth hast Egypt take how our give set Jerusalem
+Judah both upon through given whom an life where priest make again
+Moses said brethren sin wilt art whose blood fear peace mercy grace love
+faith hope charity heaven beginning created light darkness lamb lion
+sabbath passover feast shepherd neighbour loved world sanctified glory
+spirit holy law covenant offering altar tabernacle prophet righteous
+wicked soul truth kingdom gospel disciples Jesus Christ church apostle
+believe believeth saved salvation eternal everlasting angel throne
+'''.split()
+
+# The syllables that the rest of the vocabulary is made of.
+syllables = '''
+ab ad al am an ar ash ath ba be bel ben beth da dan di e el en er eth
+ga gad hab ham har he hi hu i ja je jo ka ke la le li lo ma me mi mo na
+ne ni no o pe ra re ri ro sa se shi so ta te ti to u za ze zi
+'''.split()
+
+# The number of different words, about as many as the KJV has.
+vocabulary_size = 12800
+
+# The mean and spread of the number of words in a verse.
+verse_words = (25, 9)
+
+# How often the different parts of a verse appear.
+paragraph_rate = 0.12
+note_rate = 0.06
+added_rate = 0.08
+divine_rate = 0.04
+quote_rate = 0.25
+phrase_rate = 0.04
+morph_rate = 0.25
+plain_rate = 0.1
+
+# Phrases for the phrase searches to find.
+common_phrases = ['in the beginning', 'son of man', 'the lord is my shepherd',
+                  'grace and peace', 'love thy neighbour', 'the lamb of god']
+
+# The possible tags of each testament.
+hebrew_morph = ['TH8799', 'TH8804', 'TH8802', 'TH8800', 'TH8801', 'TH8685',
+                'TH8686', 'TH8798', 'TH8762', 'TH8735']
+greek_morph = ['N-NSM', 'N-ASF', 'N-GSM', 'V-AAI-3S', 'V-PAI-3S',
+               'V-PAP-NSM', 'T-NSM', 'T-ASF', 'CONJ', 'PREP', 'P-GSM', 'A-NSM',
+               'ADV', 'PRT-N']
+
+# The first book of the New Testament and the gospels.
+new_testament = 'Matthew'
+gospels = ('Matthew', 'Mark', 'Luke', 'John')
+
+# The number of Strong's numbers in each language.
+hebrew_count = 8674
+greek_count = 5624
+
+
+@lru_cache(maxsize=1)
+def vocabulary() -> tuple:
+    """ Return the words and their cumulative Zipf weights.  The common
+    words come first, then the made up ones, a tenth of which are names.
+
+    """
+
+    rng = random.Random(0)
+    word_list = list(dict.fromkeys(common_words))
+    word_set = set(word.lower() for word in word_list)
+    while len(word_list) < vocabulary_size:
+        word = ''.join(rng.choice(syllables)
+                       for _ in range(rng.choice((1, 2, 2, 3, 3, 4))))
+        if rng.random() < 0.1:
+            word = word.capitalize()
+        if word.lower() not in word_set:
+            word_set.add(word.lower())
+            word_list.append(word)
+
+    weights = accumulate(1 / rank for rank in range(1, len(word_list) + 1))
+
+    return tuple(word_list), tuple(weights)
+
+
+def strongs_number(word_index: int, greek: bool) -> str:
+    """ Return the Strong's number of the word, in the KJV's format.
+
+    """
+
+    if greek:
+        return 'G%d' % (1 + word_index * 2654435761 % greek_count)
+    return 'H0%d' % (1 + word_index * 2654435761 % hebrew_count)
+
+
+def _word_group(rng: random.Random, words: list, word_index: int,
+                greek: bool) -> str:
+    """ Return words as a <w> tag with its Strong's number and morphology.
+
+    """
+
+    text = ' '.join(words)
+    if rng.random() < plain_rate:
+        return text
+
+    attr = 'lemma="strong:%s"' % strongs_number(word_index, greek)
+    if greek:
+        attr += ' morph="robinson:%s"' % greek_morph[word_index %
+                                                     len(greek_morph)]
+    elif rng.random() < morph_rate:
+        attr += ' morph="strongMorph:%s"' % hebrew_morph[word_index %
+                                                         len(hebrew_morph)]
+
+    return '<w %s>%s</w>' % (attr, text)
+
+
+def synthetic_verse(verse_ref: str, seed: int=0) -> str:
+    """ Return the raw OSIS text of verse_ref in the corpus made with seed.
+
+    """
+
+    if verse_ref in fixture_verses:
+        return fixture_verses[verse_ref]
+
+    offset = verse_id(verse_ref)
+    book, chapter_verse = verse_ref.rsplit(' ', 1)
+    verse_num = int(chapter_verse.split(':')[1])
+    greek = offset >= verse_id('%s 1:1' % new_testament)
+
+    rng = random.Random(seed * 1000003 + offset)
+    word_list, weights = vocabulary()
+
+    part_list = []
+    if verse_num == 1 and book == 'Psalms':
+        part_list.append('<title canonical="true" type="psalm">A Psalm of '
+                         '<w lemma="strong:H01732">David</w>.</title>')
+    if rng.random() < (0.5 if verse_num == 1 else paragraph_rate):
+        part_list.append('<milestone marker="¶" type="x-p"/>')
+
+    body_list = []
+    count = max(3, int(rng.gauss(*verse_words)))
+    while count > 0:
+        roll = rng.random()
+        if roll < phrase_rate:
+            phrase = rng.choice(common_phrases)
+            kind, words = sum(map(ord, phrase)), phrase.split()
+        elif roll < phrase_rate + added_rate:
+            kind = 'added'
+            words = rng.choices(word_list, cum_weights=weights, k=1)
+        elif roll < phrase_rate + added_rate + divine_rate and not greek:
+            kind, words = 'divine', ['Lord']
+        else:
+            index_list = rng.choices(range(len(word_list)),
+                                     cum_weights=weights,
+                                     k=rng.choice((1, 1, 1, 2, 2, 3)))
+            kind, words = index_list[0], [word_list[i] for i in index_list]
+
+        if not body_list:
+            # The first word of the text is capitalized.
+            words[0] = words[0][0].upper() + words[0][1:]
+
+        if kind == 'added':
+            part = '<transChange type="added">%s</transChange>' % words[0]
+        elif kind == 'divine':
+            part = '<w lemma="strong:H03068"><divineName>Lord</divineName></w>'
+        else:
+            part = _word_group(rng, words, kind, greek)
+
+        if rng.random() < 0.08:
+            part += rng.choice((',', ',', ';', ':'))
+
+        body_list.append(part)
+        count -= len(words)
+
+    if rng.random() < note_rate:
+        note_words = rng.choices(word_list, cum_weights=weights, k=3)
+        body_list.insert(rng.randrange(1, len(body_list) + 1),
+                         '<note type="study">Or, %s</note>' %
+                         ' '.join(note_words))
+
+    part_list.extend(body_list)
+
+    text = ' '.join(part_list) + rng.choice(('.', '.', '.', ':', '?'))
+
+    if book in gospels and rng.random() < quote_rate:
+        text = '<q marker="" who="Jesus">%s</q>' % text
+
+    return text
+
+
+def synthetic_item(module_name: str, key: str, seed: int=0) -> str:
+    """ Return the item key of the synthetic version of module_name.
+
+    """
+
+    if module_name == 'Daily':
+        rng = random.Random(seed * 1000003 + int(key.replace('.', '')))
+        refs = rng.sample(sorted(fixture_verses), 2)
+        return ('<title>%s</title> <p>Morning reading.</p> '
+                '<scripRef passage="%s">%s</scripRef> '
+                '<scripRef passage="%s">%s</scripRef>' %
+                (key, refs[0], refs[0], refs[1], refs[1]))
+    if module_name.startswith('StrongsReal'):
+        prefix = 'H' if module_name.endswith('Hebrew') else 'G'
+        return ('<entryFree n="%s"><title>%s%s</title> Synthetic definition '
+                'of %s%s.</entryFree>' % (key, prefix, key, prefix, key))
+    if module_name == 'Robinson':
+        return '<hi type="italic">%s</hi> Synthetic parsing.' % key
+
+    return synthetic_verse(key, seed)
+
+
+class CorpusDict(dict):
+    """ The items of the synthetic version of a module, made as they are
+    asked for, like the DbmDict the real Lookup uses.
+
+    """
+
+    def __init__(self, module_name: str='KJV', seed: int=0):
+        """ Set the module and seed.
+
+        """
+
+        self._module_name = module_name
+        self._seed = seed
+
+        super(CorpusDict, self).__init__()
+
+    def __missing__(self, key: str) -> str:
+        """ Make the item key.
+
+        """
+
+        value = synthetic_item(self._module_name, key, self._seed)
+        self[key] = value
+        return value
+
+
+class Lookup(DbmLookup):
+    """ A Lookup of the synthetic corpus instead of a dbm.
+
+    """
+
+    def __init__(self, module_name='KJV', markup=0, seed=0):
+        """ Setup the synthetic module.
+
+        """
+
+        super(Lookup, self).__init__(module_name, markup,
+                                     CorpusDict(module_name, seed))
+
+
+class VerseTextIter(DbmVerseTextIter):
+    """ A VerseTextIter of the synthetic corpus.
+
+    """
+
+    _lookup_type = Lookup
+
+
+def write_module(module_name: str, key_iter: iter, path: str,
+                 seed: int=0) -> str:
+    """ Write the items in key_iter of the synthetic module to a dbm in
+    path, and return its filename.
+
+    """
+
+    lookup = Lookup(module_name, seed=seed)
+    dbm_name = os_join(path, '%s.dbm' % module_name)
+
+    with IndexDbm(dbm_name, 'nf') as dbm_file:
+        for key in key_iter:
+            dbm_file[key] = lookup.get_raw_text(key)
+
+    return dbm_name
+
+
+def build_corpus(path: str=INDEX_PATH, seed: int=0,
+                 render_func: object=None) -> list:
+    """ Write the synthetic KJV, its index, the Strong's and Robinson
+    definitions, and the devotionals to dbms in path, and the verse html
+    rendered with render_func if it is given.  Returns the filenames.
+
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    file_list = [write_module('KJV', VerseIter('Genesis 1:1'), path, seed)]
+
+    index = IndexBible('KJV', path, VerseTextIter)
+    index.write_index()
+    file_list.append(os_join(path, 'KJV_index_i.dbm'))
+
+    index_dict = index._module_dict
+    for name, prefix in (('StrongsRealGreek', 'G'),
+                         ('StrongsRealHebrew', 'H')):
+        key_iter = (i[1:] for i in index_dict['_strongs_']
+                    if i.startswith(prefix))
+        file_list.append(write_module(name, key_iter, path, seed))
+
+    robinson_keys = (i for i in index_dict['_morph_']
+                     if not i.startswith('TH'))
+    file_list.append(write_module('Robinson', robinson_keys, path, seed))
+
+    # Use a leap year to get all the days in February.
+    start = date(2012, 1, 1)
+    date_iter = ((start + timedelta(i)).strftime('%m.%d')
+                 for i in range(366))
+    file_list.append(write_module('Daily', date_iter, path, seed))
+
+    if render_func:
+        lookup = Lookup('KJV', seed=seed)
+        filename = os_join(path, 'KJV_html.bin')
+        RefTable.write(filename, (render_func(lookup.get_raw_text(ref))
+                                  for ref in VerseIter('Genesis 1:1')))
+        file_list.append(filename)
+
+    return file_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--path', default=INDEX_PATH,
+                        help='Where to write the dbm files.')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='The seed of the corpus.')
+    args = parser.parse_args()
+
+    for filename in build_corpus(args.path, args.seed):
+        print(filename)
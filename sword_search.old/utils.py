@@ -26,6 +26,9 @@ from xml.dom.minidom import parseString
 from textwrap import fill
 from os.path import dirname as os_dirname
 from os.path import join as os_join
+from time import perf_counter
+from threading import Lock
+from functools import lru_cache
 import dbm
 import locale
 import sys
@@ -43,6 +46,56 @@ if not os.path.isdir(INDEX_PATH):
     INDEX_PATH = os.getcwd()
 
 
+# The function that gets the name and time of each timed stage, if any.
+_stage_hook = None
+
+
+def set_stage_hook(func):
+    """ Set the function that is called with the name and the seconds taken
+    by each timed stage of a search or lookup.  Set it to None to stop
+    timing.
+
+    """
+
+    global _stage_hook
+    _stage_hook = func
+
+
+class timed_stage(object):
+    """ Times the code in a with statement as the stage name, and passes the
+    time to the stage hook.  It does nothing when there is no hook.
+
+    """
+
+    __slots__ = ('_name', '_start')
+
+    def __init__(self, name):
+        """ Set the stage name.
+
+        """
+
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        """ Start the timer.
+
+        """
+
+        if _stage_hook:
+            self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Send the time to the hook.
+
+        """
+
+        if self._start is not None and _stage_hook:
+            _stage_hook(self._name, perf_counter() - self._start)
+        return False
+
+
 def info_print(data, end='\n', tag=0):
     """ Print the data to stderr as info.
 
@@ -96,7 +149,11 @@ class IndexDbm(object):
 
         """
 
-        self._dbm = dbm.open(name, mode)
+        try:
+            self._dbm = dbm.open(name, mode)
+        except ValueError:
+            # Only gdbm has the fast, sync, and unlock flags.
+            self._dbm = dbm.open(name, mode[0])
 
     def __setitem__(self, key, item):
         """ Adds item assignment to this dict
@@ -214,6 +271,23 @@ class IndexDbm(object):
             return False
 
 
+@lru_cache(maxsize=256)
+def partial_word_regex(partial_word, case_sensitive):
+    """ A Regular expression that matches any number of word characters
+    for every '*' in partial_word.  Raises a ValueError if the term doesn't
+    make a valid regular expression.
+
+    """
+
+    flags = re.I if not case_sensitive else 0
+    reg_str = '\\b%s\\b' % partial_word.replace('*', '\\w*')
+    try:
+        return re.compile(reg_str, flags)
+    except re.error as err:
+        raise ValueError('There is a problem with the regular expression '
+                         '%s: %s' % (reg_str, err))
+
+
 class IndexDict(dict):
     """ A Bible index container, that provides on-demand loading of indexed
     items.
@@ -232,16 +306,66 @@ class IndexDict(dict):
         self._name = name
         self._path = path
 
-        dbm_name = '%s/%s_index_i.dbm' % (path, name)
-        self._dbm_dict = IndexDbm(dbm_name, 'r')
-
-        self._lower_case = self.get('lower_case', {})
+        # The database and the lower case map are loaded when they are
+        # first used, so making an IndexDict is cheap.
+        self._dbm = None
+        self._lower_case_map = None
+        self._open_lock = Lock()
 
         super(IndexDict, self).__init__()
 
     # In case we need to access the name externally we don't want it changed.
     name = property(lambda self: self._name)
 
+    @property
+    def _dbm_dict(self):
+        """ The index database, opened the first time it is used.
+
+        """
+
+        if self._dbm is None:
+            self.open()
+        return self._dbm
+
+    @property
+    def _lower_case(self):
+        """ The upper case forms of each lower case word.
+
+        """
+
+        if self._lower_case_map is None:
+            self.open()
+        return self._lower_case_map
+
+    def open(self):
+        """ Open the index database and load the lower case map, if that
+        hasn't been done yet.  The first search does it, or a thread can do
+        it sooner to warm up the index.
+
+        """
+
+        with self._open_lock:
+            if self._dbm is None:
+                dbm_name = '%s/%s_index_i.dbm' % (self._path, self._name)
+                self._dbm = IndexDbm(dbm_name, 'r')
+            if self._lower_case_map is None:
+                self._lower_case_map = self.get('lower_case', {})
+
+        return self
+
+    def reopen(self):
+        """ Open a new handle on the index database.  A dbm handle can't be
+        shared by forked processes, but the items already loaded can, so
+        each process calls this after it is forked.  An index that was
+        never opened is left to open when it is used.
+
+        """
+
+        with self._open_lock:
+            if self._dbm is not None:
+                dbm_name = '%s/%s_index_i.dbm' % (self._path, self._name)
+                self._dbm = IndexDbm(dbm_name, 'r')
+
     def __getitem__(self, key):
         """ If a filename was given then use it to retrieve keys when
         they are needed.
@@ -255,7 +379,8 @@ class IndexDict(dict):
             try:
                 # dbm_name = '%s/%s_index_i.dbm' % (self._path, self._name)
                 # with IndexDbm(dbm_name, 'r') as dbm_dict:
-                self[key] = self._dbm_dict.get(key)
+                with timed_stage('index_io'):
+                    self[key] = self._dbm_dict.get(key)
             except Exception as err:
                 print("The index is either broken or missing.", \
                       file=sys.stderr)
@@ -355,23 +480,17 @@ class IndexDict(dict):
 
         """
 
-        flags = re.I if not case_sensitive else 0
         verse_set = set()
 
+        # Compile the regular expressions once instead of once for every
+        # word in the index.
+        regx_list = [partial_word_regex(partial_word, case_sensitive)
+                     for partial_word in partial_list]
+
         # Search through each word key in the index for any word that contains
         # the partial word.
         for word in self['_words_']:
-            for partial_word in partial_list:
-                # A Regular expression that matches any number of word
-                # characters for every '*' in the term.
-                reg_str = '\\b%s\\b' % partial_word.replace('*', '\w*')
-                try:
-                    word_regx = re.compile(reg_str, flags)
-                except Exception as err:
-                    print('There is a problem with the regular '
-                          'expression %s: %s' % (reg_str, err),
-                          file=sys.stderr)
-                    sys.exit()
+            for word_regx in regx_list:
                 if word_regx.match(word):
                     temp_list = self[word]
                     if len(temp_list) < common_limit:
@@ -397,14 +516,24 @@ class DbmDict(dict):
         self._name = "%s.dbm" % name
         self._path = path
 
-        dbm_name = os_join(path, "%s.dbm" % name)
-        self._dbm_dict = IndexDbm(dbm_name, 'r')
+        # Only opened when an item that isn't loaded is needed.
+        self._dbm = None
 
         super(DbmDict, self).__init__()
 
     # In case we need to access the name externally we don't want it changed.
     name = property(lambda self: self._name)
 
+    @property
+    def _dbm_dict(self):
+        """ The database, opened the first time it is used.
+
+        """
+
+        if self._dbm is None:
+            self._dbm = IndexDbm(os_join(self._path, self._name), 'r')
+        return self._dbm
+
     def __getitem__(self, key):
         """ If a filename was given then use it to retrieve keys when
         they are needed.
@@ -418,7 +547,8 @@ class DbmDict(dict):
             try:
                 # dbm_name = os_join(self._path, self._name)
                 # with IndexDbm(dbm_name, 'r') as dbm_dict:
-                self[key] = self._dbm_dict.get(key)
+                with timed_stage('index_io'):
+                    self[key] = self._dbm_dict.get(key)
             except Exception as err:
                 print("The error was: %s" % err, file=sys.stderr)
 
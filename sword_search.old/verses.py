@@ -24,6 +24,12 @@ from textwrap import fill
 from os.path import dirname as os_dirname
 from os.path import join as os_join
 from difflib import get_close_matches
+from functools import lru_cache
+from bisect import bisect_right
+from threading import Lock
+from array import array
+import struct
+import mmap
 import gzip
 import json
 import re
@@ -34,6 +40,109 @@ from .utils import *
 data_path = os_join(os_dirname(__file__), 'data')
 
 
+class RefTable(object):
+    """ A read-only sequence of verse references stored in a compact binary
+    table.  The table is an array of string offsets followed by one utf-8
+    blob of all the references.  The file is memory mapped, and each
+    reference is only decoded when it is accessed.  It is also used to
+    store the pre-rendered html of each verse.
+
+    """
+
+    _magic = b'BSRT'
+    _header = struct.Struct('<4sI')
+
+    def __init__(self, filename: str):
+        """ Memory map the table in filename.
+
+        """
+
+        with open(filename, 'rb') as table_file:
+            self._mmap = mmap.mmap(table_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+        magic, count = self._header.unpack_from(self._mmap, 0)
+        if magic != self._magic:
+            raise ValueError("%s is not a reference table" % filename)
+
+        # The offsets array has one extra item marking the end of the
+        # last string.
+        offsets_start = self._header.size
+        self._blob_start = offsets_start + (count + 1) * 4
+        self._offsets = array('I')
+        self._offsets.frombytes(self._mmap[offsets_start:self._blob_start])
+        if sys.byteorder != 'little':
+            self._offsets.byteswap()
+
+        self._count = count
+
+    def __len__(self) -> int:
+        """ The number of references in the table.
+
+        """
+
+        return self._count
+
+    def __getitem__(self, key):
+        """ Return the reference at key, or a list of references if key is
+        a slice.
+
+        """
+
+        if type(key) is slice:
+            return [self[i] for i in range(*key.indices(self._count))]
+
+        if key < 0:
+            key += self._count
+        if not 0 <= key < self._count:
+            raise(IndexError("index out of range: %s" % key))
+
+        start = self._blob_start + self._offsets[key]
+        end = self._blob_start + self._offsets[key + 1]
+        return self._mmap[start:end].decode('utf-8')
+
+    def __iter__(self) -> iter:
+        """ An iterator over all the references in the table.
+
+        """
+
+        for i in range(self._count):
+            yield self[i]
+
+    def index(self, item: str) -> int:
+        """ Return the index of item.
+
+        """
+
+        for i, ref in enumerate(self):
+            if ref == item:
+                return i
+        raise(ValueError("%s not in table" % item))
+
+    @classmethod
+    def write(cls, filename: str, ref_iter: iter) -> int:
+        """ Write the references in ref_iter to a table in filename, and
+        return the number of references written.
+
+        """
+
+        offsets = array('I', [0])
+        blob = bytearray()
+        for ref in ref_iter:
+            blob.extend(ref.encode('utf-8'))
+            offsets.append(len(blob))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        count = len(offsets) - 1
+        with open(filename, 'wb') as table_file:
+            table_file.write(cls._header.pack(cls._magic, count))
+            table_file.write(offsets.tobytes())
+            table_file.write(blob)
+
+        return count
+
+
 class Verse(object):
     """ An index object of Bible references that can increment and decrement a
     reference.
@@ -288,9 +397,94 @@ class Verse(object):
             21, 15, 27, 21)
     )
 
+    # Common abbreviations of each book, in the same order as _books_tup.
+    _books_common = (
+        ("Gn", "Ge"),
+        ("Ex", "Exo"),
+        ("Lv", "Le"),
+        ("Nm", "Nu", "Nb"),
+        ("Dt", "De"),
+        ("Jos", "Jsh"),
+        ("Jdg", "Jdgs", "Jg"),
+        ("Rth", "Ru"),
+        ("1Sa", "1Sm"),
+        ("2Sa", "2Sm"),
+        ("1Ki", "1Kg", "1Kin"),
+        ("2Ki", "2Kg", "2Kin"),
+        ("1Ch", "1Chron"),
+        ("2Ch", "2Chron"),
+        ("Ezr",),
+        ("Ne",),
+        ("Est", "Es"),
+        ("Jb",),
+        ("Psa", "Psalm", "Pss", "Psm"),
+        ("Pr", "Prv", "Pro"),
+        ("Ec", "Ecc", "Qoh"),
+        ("So", "SoS", "Song of Songs", "Canticles"),
+        ("Is",),
+        ("Je", "Jr"),
+        ("La",),
+        ("Eze", "Ezk"),
+        ("Da", "Dn"),
+        ("Ho",),
+        ("Jl",),
+        ("Am",),
+        ("Ob",),
+        ("Jnh", "Jon"),
+        ("Mi",),
+        ("Na",),
+        ("Hb",),
+        ("Zep", "Zp"),
+        ("Hg",),
+        ("Zec", "Zc"),
+        ("Ml",),
+        ("Mt",),
+        ("Mk", "Mr", "Mrk"),
+        ("Lk",),
+        ("Jn", "Jhn"),
+        ("Ac",),
+        ("Ro", "Rm"),
+        ("1Co",),
+        ("2Co",),
+        ("Ga",),
+        ("Ephes",),
+        ("Php", "Pp"),
+        ("Co",),
+        ("1Th", "1Thes"),
+        ("2Th", "2Thes"),
+        ("1Ti", "1Tm"),
+        ("2Ti", "2Tm"),
+        ("Tit",),
+        ("Philem", "Phm", "Pm"),
+        ("He",),
+        ("Jm",),
+        ("1Pe", "1Pt"),
+        ("2Pe", "2Pt"),
+        ("1Jn", "1Jhn"),
+        ("2Jn", "2Jhn"),
+        ("3Jn", "3Jhn"),
+        ("Jde",),
+        ("Re", "Rv", "Revelation", "Apocalypse"),
+    )
+
+    # Spoken and arabic forms of the roman numeral book prefixes.
+    _ordinals = {
+        "I": ("1", "1st", "First"),
+        "II": ("2", "2nd", "Second"),
+        "III": ("3", "3rd", "Third"),
+    }
+
     _book_offsets = []
     _chapter_offsets = []
     _ref_list = []
+    _book_index = {}
+    _book_aliases = {}
+    _book_prefixes = {}
+    _book_candidates = {}
+
+    # Held while the tables above are built, so the threads of the server
+    # never see them half built.
+    _tables_lock = Lock()
 
     _ref_regx = re.compile(r'''
         (?P<book>\d*[^\d-]+)
@@ -311,10 +505,6 @@ class Verse(object):
         if not self._book_offsets or not self._chapter_offsets:
             self._build_offsets()
 
-        # Load the reference list if it is empty.
-        if not self._ref_list:
-            self._load_reflist()
-
         # Get the total number of chapters.
         self._chapter_count = len(self._chapter_offsets)
 
@@ -486,6 +676,12 @@ class Verse(object):
 
         """
 
+        # Canonical references don't need any fixing.
+        canonical = self._parse_canonical(reference)
+        if canonical:
+            self._book, self._chapter, self._verse = canonical
+            return self._get_verse_offset(*canonical)
+
         match = self._ref_regx.search(reference)
 
         # Return the default reference if this one doesn't look like
@@ -503,12 +699,6 @@ class Verse(object):
 
         book_index = self._get_book_index(book)
 
-        if reference in self._ref_list:
-            self._book = book_index
-            self._chapter = chapter
-            self._verse = verse
-            return self._ref_list.index(reference)
-
         book_index, chapter, verse = self._abs_verse(book_index, chapter,
                                                      verse)
         self._book = book_index
@@ -526,25 +716,94 @@ class Verse(object):
 
         """
 
-        name_list = []
-        book = book.lower()
-        for index, (name, abv1, abv2, _) in enumerate(self._books_tup):
-            name = name.lower()
-            abv1 = abv1.lower()
-            abv2 = abv2.lower()
-            name_list.extend((name, abv1, abv2))
-            if book in (name, abv1, abv2):
-                return index
-            elif name.startswith(book) or abv1.startswith(book) or abv2.startswith(book):
-                return index
+        if not self._book_aliases:
+            self._build_aliases()
+
+        book = self._normalize_book(book)
+
+        # Try an exact name or abbreviation first, then the start of one.
+        book_index = self._book_aliases.get(book)
+        if book_index is None:
+            book_index = self._book_prefixes.get(book)
+        if book_index is None:
+            book_index = self._fuzzy_book_index(book)
 
-        match_list = get_close_matches(book, name_list, cutoff=0.6)
+        return book_index
+
+    @staticmethod
+    def _normalize_book(book: str) -> str:
+        """ Lowercase book and remove any spaces and periods from it.
+
+        """
+
+        return ''.join(book.lower().split()).replace('.', '')
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _fuzzy_book_index(cls, book: str) -> int:
+        """ Returns the index of the book whose name or abbreviation is the
+        closest match to book.  Only the names starting with the same
+        character are compared.
+
+        """
+
+        candidate_list = cls._book_candidates.get(book[:1], ())
+        match_list = get_close_matches(book, candidate_list, n=1, cutoff=0.6)
         if match_list:
-            return name_list.index(match_list[0]) // 3
+            return cls._book_aliases[match_list[0]]
 
         # Default to Genesis
         return 0
 
+    @classmethod
+    def _build_aliases(cls):
+        """ Build the tables that map every normalized book name, abbreviation,
+        and start of one to the index of the book.  When two books share an
+        alias or prefix the first one in the Bible wins.  The tables are
+        built apart and set when they are done.
+
+        """
+
+        with cls._tables_lock:
+            if cls._book_aliases:
+                # Another thread built them while this one waited.
+                return
+
+            book_aliases = {}
+            book_prefixes = {}
+            book_candidates = {}
+
+            for book_index, book in enumerate(cls._books_tup):
+                name, abv1, abv2, _ = book
+                name_set = {name, abv1, abv2}
+                name_set.update(cls._books_common[book_index])
+
+                for alias in tuple(name_set):
+                    numeral, _, rest = alias.partition(' ')
+                    if numeral in cls._ordinals:
+                        # I Samuel -> 1 Samuel, 1st Samuel, First Samuel
+                        name_set.update('%s %s' % (ordinal, rest)
+                                        for ordinal in cls._ordinals[numeral])
+                for abv in (abv1, abv2):
+                    if abv[0].isdigit():
+                        # 1Sam -> ISam
+                        name_set.add('I' * int(abv[0]) + abv[1:])
+
+                for alias in name_set:
+                    alias = cls._normalize_book(alias)
+                    book_aliases.setdefault(alias, book_index)
+                    for i in range(1, len(alias)):
+                        book_prefixes.setdefault(alias[:i], book_index)
+
+            for alias in book_aliases:
+                book_candidates.setdefault(alias[0], []).append(alias)
+
+            # The aliases are set last, since they are what is checked to
+            # see if the tables are built.
+            cls._book_prefixes = book_prefixes
+            cls._book_candidates = book_candidates
+            cls._book_aliases = book_aliases
+
     def _abs_chapter(self, book_index: int, chapter: int) -> tuple:
         """ Returns the absolute location in the Bible of the chapter, based on
         the book_index.
@@ -648,6 +907,31 @@ class Verse(object):
 
         return verse_offset
 
+    @classmethod
+    def _parse_canonical(cls, reference: str) -> tuple:
+        """ Return a tuple of the book index, chapter, and verse of reference
+        if it is a valid canonical reference (e.g. 'I John 3:16'), otherwise
+        return None.
+
+        """
+
+        book, _, chapter_verse = reference.rpartition(' ')
+        chapter, _, verse = chapter_verse.partition(':')
+
+        book_index = cls._book_index.get(book)
+        if book_index is None or not chapter.isdigit() or not verse.isdigit():
+            return None
+
+        chapter = int(chapter)
+        verse = int(verse)
+        chapter_list = cls._verse_count[book_index]
+        if not 0 < chapter <= len(chapter_list):
+            return None
+        if not 0 < verse <= chapter_list[chapter - 1]:
+            return None
+
+        return book_index, chapter, verse
+
     @classmethod
     def _build_offsets(cls):
         """ Build the book and chapter offsets lists.  The book offsets are the
@@ -656,25 +940,40 @@ class Verse(object):
 
         """
 
-        # Modify the class variables, so this is only run once and they
-        # will be used by all instances of this class.
-        cls._book_offsets.append(0)
-        cls._chapter_offsets.append(0)
+        # Set the class variables, so this is only run once and they will
+        # be used by all instances of this class.
+        with cls._tables_lock:
+            if cls._book_offsets and cls._chapter_offsets:
+                # Another thread built them while this one waited.
+                return
+
+            book_offsets = [0]
+            chapter_offsets = [0]
+
+            for book in cls._verse_count:
+                book_offsets.append(book_offsets[-1] + len(book))
+                for chapter in book:
+                    chapter_offsets.append(chapter_offsets[-1] + chapter)
 
-        for book in cls._verse_count:
-            cls._book_offsets.append(cls._book_offsets[-1] + len(book))
-            for chapter in book:
-                cls._chapter_offsets.append(cls._chapter_offsets[-1] + chapter)
+            cls._book_index = {book[0]: index
+                               for index, book in enumerate(cls._books_tup)}
+            cls._book_offsets = book_offsets
+            cls._chapter_offsets = chapter_offsets
 
     @classmethod
     def _load_reflist(cls):
-        """ Load the reference list.
+        """ Load the reference list.  Use the binary reference table if it
+        is there, because it only has to be mapped into memory.
 
         """
 
-        filename = os_join(data_path, 'ref_list.json.gz')
-        with gzip.open(filename, 'rb') as reflist:
-            cls._ref_list = json.loads(reflist.read().decode())
+        try:
+            cls._ref_list = RefTable(os_join(data_path, 'ref_list.bin'))
+        except (OSError, ValueError) as err:
+            info_print("Error loading reference table: %s" % err, tag=1)
+            filename = os_join(data_path, 'ref_list.json.gz')
+            with gzip.open(filename, 'rb') as reflist:
+                cls._ref_list = json.loads(reflist.read().decode())
 
     def copy(self):
         """ Return a unique copy of self.
@@ -688,27 +987,21 @@ class Verse(object):
 
         """
 
-        return self._ref_list[self._verse_offset]
+        return verse_ref(self._verse_offset)
 
     def get_max_verse(self) -> object:
         """ Return a Verse object of the last verse in the chapter.
 
         """
 
-        max_verse = self._verse_count[self._book][self._chapter - 1]
-        book_name = self._books_tup[self._book][0]
-        reference = "%s %s:%s" % (book_name, self._chapter, max_verse)
-        return Verse(reference)
+        return Verse(chapter_span(self._verse_offset)[1])
 
     def get_max_chapter(self) -> object:
         """ Return a Verse object of the last chapter of the book.
 
         """
 
-        max_chapter = self._books_tup[self._book][-1]
-        book_name = self._books_tup[self._book][0]
-        reference = "%s %s:1" % (book_name, max_chapter)
-        return Verse(reference)
+        return Verse(chapter_span(book_span(self._verse_offset)[1])[0])
 
 
 class VerseRange(object):
@@ -763,8 +1056,10 @@ class VerseRange(object):
 
         """
 
+        # Count the verses, because adding to the last verse in the Bible
+        # leaves it there.
         temp = self._lower.copy()
-        while temp <= self._upper:
+        for _ in range(len(self)):
             yield temp
             temp += 1
 
@@ -832,7 +1127,7 @@ class VerseRange(object):
         start_book = ''
         for book, chapters, verses in ref_list:
             if start_book:
-                end_book = Verse('%s 1:1' % book).get_max_chapter().get_max_verse()
+                end_book = Verse(book_span(int(Verse('%s 1:1' % book)))[1])
                 ref_set.add(VerseRange(start_book, end_book))
                 start_book = ''
                 continue
@@ -870,9 +1165,8 @@ class VerseRange(object):
                         ref_set.add(Verse(ref))
             for chapter in chapters:
                 ref = '%s %s:1' % (book, chapter)
-                start = Verse(ref)
-                end = start.get_max_verse()
-                ref_set.add(VerseRange(start, end))
+                start, end = chapter_span(int(Verse(ref)))
+                ref_set.add(VerseRange(Verse(start), Verse(end)))
         return ref_set
 
     def get_refs_list(self):
@@ -880,7 +1174,7 @@ class VerseRange(object):
 
         """
 
-        return Verse._ref_list[int(self._lower):int(self._upper)+1]
+        return span_refs((int(self._lower), int(self._upper)))
 
     # args: verse_list, default_key, expand_range, chapter_as_verse?
     def parse_verse_list(self, verse_list, default_key, expand_range,
@@ -950,10 +1244,9 @@ class ChapterIter(VerseIter):
 
         """
 
-        start = Verse('%s %s:1' % (book, chapter))
-        end = start.get_max_verse()
+        start, end = chapter_span(int(Verse('%s %s:1' % (book, chapter))))
 
-        super(ChapterIter, self).__init__(start.get_text(), end.get_text())
+        super(ChapterIter, self).__init__(verse_ref(start), verse_ref(end))
 
 
 class BookIter(VerseIter):
@@ -966,10 +1259,9 @@ class BookIter(VerseIter):
 
         """
 
-        start = Verse('%s 1:1' % book)
-        end = start.get_max_chapter().get_max_verse()
+        start, end = book_span(int(Verse('%s 1:1' % book)))
 
-        super(BookIter, self).__init__(start.get_text(), end.get_text())
+        super(BookIter, self).__init__(verse_ref(start), verse_ref(end))
 
 
 class Lookup(object):
@@ -977,12 +1269,15 @@ class Lookup(object):
 
     """
 
-    def __init__(self, module_name='KJV', markup=0):
-        """ Setup the module to look up information in.
+    def __init__(self, module_name='KJV', markup=0, dbm_dict=None):
+        """ Setup the module to look up information in.  The text comes from
+        dbm_dict if it is given, instead of the module's dbm.
 
         """
 
-        self._dbm_dict = DbmDict(module_name, INDEX_PATH)
+        if dbm_dict is None:
+            dbm_dict = DbmDict(module_name, INDEX_PATH)
+        self._dbm_dict = dbm_dict
 
         self._bold_regx = re.compile(r'<b>(\w+)</b>', re.I)
         self._italic_regx = re.compile(r'''
@@ -1045,13 +1340,16 @@ class VerseTextIter(object):
 
     """
 
+    # The class used to look up the verse text.
+    _lookup_type = Lookup
+
     def __init__(self, reference_iter, strongs=False, morph=False,
                  module='KJV', markup=0, render=''):
         """ Initialize.
 
         """
 
-        self._module = Lookup(module)
+        self._module = self._lookup_type(module)
 
         if render.lower() == 'raw':
             self._render_func = self._module.get_raw_text
@@ -1385,6 +1683,177 @@ class RawDict(object):
                               '_words': [defaultdict(list)]}
 
 
+class IndexBible(object):
+    """ Index the bible by Strong's Numbers, Morphological Tags, and words,
+    reading the verses with text_iter, so no sword library is needed.
+
+    """
+
+    def __init__(self, module='KJV', path='', text_iter=VerseTextIter,
+                 book_iter=BookIter):
+        """ Initialize the index dicts.  text_iter and book_iter are the
+        types used to read the verses of each book.
+
+        """
+
+        self._module_name = module
+        self._path = path if path else INDEX_PATH
+        self._text_iter = text_iter
+        self._book_iter = book_iter
+
+        # Remove morphological and strongs information.
+        self._cleanup_regx = re.compile(r'\s*(<([GH]\d*)>|\{([A-Z\d-]*)\})')
+        # Note removal regular expression.
+        self._remove_notes_regex = re.compile(r'\s?<n>\s?(.*?)\s?</n>', re.S)
+        self._remove_tags_regex = re.compile(r'<[/]?[pin]>')
+
+        self._non_alnum_regx = re.compile(r'\W')
+        self._fix_regx = re.compile(r'\s+')
+        self._strongs_regx = re.compile(r'\s<([GH]\d+)>', re.I)
+        self._morph_regx = re.compile(r'\s\{([\w-]+)\}', re.I)
+
+        self._module_dict = defaultdict(list)
+        # lower_case is used to store lower_case words case sensitive
+        # counterpart.  _Words_ is for easy key lookup for partial words.
+        self._words_set = set()
+        self._strongs_set = set()
+        self._morph_set = set()
+        self._module_dict.update({'lower_case': defaultdict(list)})
+
+        self._index_dict = {
+                '%s_index_i' % self._module_name: self._module_dict
+                }
+
+        self._index_built = False
+
+    def _book_gen(self):
+        """ A Generator function that yields book names in order.
+
+        """
+
+        return book_gen()
+
+    def _index_strongs(self, verse_ref, verse_text):
+        """ Update the modules strongs dictionary from the verse text.
+
+        """
+
+        strongs_list = set(self._strongs_regx.findall(verse_text))
+        for strongs_num in strongs_list:
+            self._strongs_set.add(strongs_num)
+            self._module_dict[strongs_num].append(verse_ref)
+
+    def _index_morph(self, verse_ref, verse_text):
+        """ Update the modules mophological dictionary from the verse text.
+
+        """
+
+        morph_list = set(self._morph_regx.findall(verse_text))
+        for morph_num in morph_list:
+            self._morph_set.add(morph_num)
+            self._module_dict[morph_num].append(verse_ref)
+
+    def _index_words(self, verse_ref, verse_text):
+        """ Update the modules word dictionary from the verse text.
+
+        """
+
+        # Remove all the morphological and strongs stuff.
+        clean_text = self._cleanup_regx.sub('', verse_text)
+        # Remove any non-alpha-numeric stuff.
+        clean_text = self._non_alnum_regx.sub(' ', clean_text)
+        # Replace runs of one or more spaces with just a single space.
+        clean_text = self._fix_regx.sub(' ', clean_text).strip()
+
+        # Remove the strongs and morphological stuff in such a way that
+        # split words are still split (i.e. where in, instead of wherein).
+        # So there are split versions and non-split versions just to be sure
+        # that the correct one is in there.
+        verse_text = self._strongs_regx.sub('', verse_text)
+        verse_text = self._morph_regx.sub('', verse_text)
+
+        # Strip out all unicode so we can search correctly.
+        verse_text = verse_text.encode('ascii', 'ignore')
+        verse_text = verse_text.decode('ascii', 'ignore')
+        verse_text = self._non_alnum_regx.sub(' ', verse_text)
+        verse_text = self._fix_regx.sub(' ', verse_text).strip()
+
+        # Include the capitalized words for case sensitive search.
+        word_set = set(verse_text.split())
+        word_set.update(set(clean_text.split()))
+
+        for word in word_set:
+            if word:
+                self._words_set.add(word)
+                self._module_dict[word].append(verse_ref)
+                l_word = word.lower()
+                if l_word != word:
+                    # Map the lowercase word to the regular word for case
+                    # insensitive searches.
+                    if word not in self._module_dict['lower_case'][l_word]:
+                        self._module_dict['lower_case'][l_word].append(word)
+
+    def _index_book(self, book_name="Genesis"):
+        """ Creates indexes for strongs, morphology and words.
+
+        """
+
+        book_iter = self._book_iter(book_name)
+        verse_iter = self._text_iter(book_iter, True, True, self._module_name,
+                                     render='render_raw')
+
+        for verse_ref, verse_text in verse_iter:
+            info_print('\033[%dD\033[KIndexing...%s' % \
+                       (len(verse_ref) + 20, verse_ref), end='')
+
+            # Put the entire Bible in the index, so we can pull it out
+            # faster.
+            self._module_dict[verse_ref] = verse_text
+            # Remove the notes so we don't search them.
+            verse_text = self._remove_notes_regex.sub('', verse_text)
+            # Remove tags so they don't mess anything up.
+            verse_text = self._remove_tags_regex.sub('', verse_text)
+
+            # Index everything else.
+            self._index_strongs(verse_ref, verse_text)
+            self._index_morph(verse_ref, verse_text)
+            self._index_words(verse_ref, verse_text)
+
+    def build_index(self):
+        """ Create index files of the bible for strongs numbers,
+        morphological tags, and case (in)sensitive words.
+
+        """
+
+        info_print("Indexing %s could take a while..." % self._module_name)
+        for book in self._book_gen():
+            self._index_book(book)
+        self._module_dict['_words_'].extend(self._words_set)
+        self._module_dict['_strongs_'].extend(self._strongs_set)
+        self._module_dict['_morph_'].extend(self._morph_set)
+
+        info_print('\nDone.')
+
+        self._index_built = True
+
+    def write_index(self):
+        """ Write all the index dictionaries to their respective dbm files,
+        building the index first if it hasn't been.  The keys are the
+        indexed items and the values are the verse references that contain
+        the key.
+
+        """
+
+        if not self._index_built:
+            self.build_index()
+
+        for name, dic in self._index_dict.items():
+            info_print("Writing %s.dbm..." % name)
+            dbm_name = '%s/%s.dbm' % (self._path, name)
+            with IndexDbm(dbm_name, 'nf') as index_file:
+                index_file.update(dic)
+
+
 def parse_verse_range(verse_list: str) -> set:
     """ Return a set of all the verses in the ranges represented by verse_list.
 
@@ -1408,26 +1877,136 @@ def parse_verse_range(verse_list: str) -> set:
     return verse_set
 
 
-def add_context(ref_set: set, count: int=0) -> set:
+def add_context(ref_set: set, count: int=0, chapter: bool=False) -> set:
     """ Add count number of verses before and after reference and return a set
-    of those references.
+    of those references.  If chapter is True the whole chapter of each
+    reference is added instead.
 
     """
 
-    if count == 0:
+    if count == 0 and not chapter:
         return ref_set
 
-    # Make the argument a parseable string.
-    if not isinstance(ref_set, str):
-        reference = ','.join(ref_set)
+    # Make the argument an iterable of references.
+    if isinstance(ref_set, str):
+        ref_set = parse_verse_range(ref_set)
+
+    _load_tables()
+    last_id = Verse._chapter_offsets[-1] - 1
+    if not Verse._ref_list:
+        Verse._load_reflist()
 
-    verse_set = VerseRange.parse_range(reference)
     return_set = set()
-    for i in verse_set:
-        return_set.update(str(j) for j in VerseRange(i - count, i + count))
+    for ref in ref_set:
+        ref_id = verse_id(ref)
+        if chapter:
+            start, end = chapter_span(ref_id)
+        else:
+            start = max(0, ref_id - count)
+            end = min(last_id, ref_id + count)
+        return_set.update(Verse._ref_list[start:end + 1])
     return return_set
 
 
+def _load_tables():
+    """ Make sure the offset tables are built.
+
+    """
+
+    if not Verse._book_offsets or not Verse._chapter_offsets:
+        Verse._build_offsets()
+
+
+def _chapter_index(verse_offset: int) -> int:
+    """ Return the absolute chapter index of the verse at verse_offset.
+
+    """
+
+    _load_tables()
+    chapter_offsets = Verse._chapter_offsets
+
+    # Clamp the offset to the Bible.
+    verse_offset = min(max(verse_offset, 0), chapter_offsets[-1] - 1)
+
+    return bisect_right(chapter_offsets, verse_offset) - 1
+
+
+def verse_id(reference: str) -> int:
+    """ Return the verse offset (id) of reference.
+
+    """
+
+    _load_tables()
+    canonical = Verse._parse_canonical(reference)
+    if not canonical:
+        # Not a canonical reference so let Verse figure it out.
+        return int(Verse(reference))
+    book_index, chapter, verse = canonical
+    return Verse._chapter_offsets[Verse._book_offsets[book_index] +
+                                  chapter - 1] + verse - 1
+
+
+def verse_ref(verse_offset: int) -> str:
+    """ Return the reference string of the verse id verse_offset.
+
+    """
+
+    if not Verse._ref_list:
+        Verse._load_reflist()
+    return Verse._ref_list[verse_offset]
+
+
+def span_refs(span: tuple) -> list:
+    """ Return a list of the references from the first to the last verse id
+    in span.
+
+    """
+
+    if not Verse._ref_list:
+        Verse._load_reflist()
+    start, end = span
+    return Verse._ref_list[start:end + 1]
+
+
+def chapter_span(verse_offset: int) -> tuple:
+    """ Return a tuple of the first and last verse ids of the chapter
+    containing verse_offset.
+
+    """
+
+    chapter_index = _chapter_index(verse_offset)
+    chapter_offsets = Verse._chapter_offsets
+    return (chapter_offsets[chapter_index],
+            chapter_offsets[chapter_index + 1] - 1)
+
+
+def book_span(verse_offset: int) -> tuple:
+    """ Return a tuple of the first and last verse ids of the book containing
+    verse_offset.
+
+    """
+
+    chapter_index = _chapter_index(verse_offset)
+    book_offsets = Verse._book_offsets
+    chapter_offsets = Verse._chapter_offsets
+    book_index = bisect_right(book_offsets, chapter_index) - 1
+    return (chapter_offsets[book_offsets[book_index]],
+            chapter_offsets[book_offsets[book_index + 1]] - 1)
+
+
+def next_chapter(verse_offset: int) -> int:
+    """ Return the verse id of the first verse of the chapter after the one
+    containing verse_offset, or None if it is in the last chapter.
+
+    """
+
+    chapter_index = _chapter_index(verse_offset)
+    chapter_offsets = Verse._chapter_offsets
+    if chapter_index + 2 >= len(chapter_offsets):
+        return None
+    return chapter_offsets[chapter_index + 1]
+
+
 def book_gen():
     """ A Generator function that yields book names in order.
 
@@ -1435,7 +2014,67 @@ def book_gen():
 
     for book in Verse._books_tup:
         yield book[0]
-book_list = list(book_gen())
+
+
+def __getattr__(name):
+    """ Build the list of book names the first time it is used.
+
+    """
+
+    if name == 'book_list':
+        global book_list
+        book_list = list(book_gen())
+        return book_list
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def make_ref_table(filename: str='') -> str:
+    """ Write the binary reference table from ref_list.json.gz and return its
+    filename.
+
+    """
+
+    filename = filename if filename else os_join(data_path, 'ref_list.bin')
+
+    with gzip.open(os_join(data_path, 'ref_list.json.gz'), 'rb') as reflist:
+        RefTable.write(filename, json.loads(reflist.read().decode()))
+
+    return filename
+
+
+def make_html_table(render_func: object, module: str='KJV',
+                    path: str=INDEX_PATH, kind: str='html') -> str:
+    """ Render the raw text of every verse in module with render_func and
+    write the html to a table in path indexed by verse id.  kind names the
+    table, so other things made from the raw text, like the plain text that
+    is highlighted, can be stored the same way.  Returns the filename of
+    the table.
+
+    """
+
+    lookup = Lookup(module)
+    filename = os_join(path, '%s_%s.bin' % (module, kind))
+
+    html_iter = (render_func(lookup.get_raw_text(ref))
+                 for ref in VerseIter('Genesis 1:1'))
+    RefTable.write(filename, html_iter)
+
+    return filename
+
+
+def open_html_table(module: str='KJV', path: str=INDEX_PATH,
+                    kind: str='html') -> object:
+    """ Return the table of pre-rendered verse html (or the kind of table
+    make_html_table wrote) for module, or None if it has not been built.
+
+    """
+
+    try:
+        return RefTable(os_join(path, '%s_%s.bin' % (module, kind)))
+    except (OSError, ValueError) as err:
+        info_print("Error loading %s table: %s" % (kind, err), tag=1)
+        return None
 
 
 # Key function used to sort a list of verse references.
@@ -1447,7 +2086,8 @@ def sort_key(ref):
     try:
         book, chap_verse = ref.rsplit(' ', 1)
         chap, verse = chap_verse.split(':')
-        val = '%02d%03d%03d' % (int(book_list.index(book)), int(chap),
+        _load_tables()
+        val = '%02d%03d%03d' % (Verse._book_index[book], int(chap),
                                 int(verse))
         return val
     except Exception as err:
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Jinja2 template setup and pre-rendered page parts.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The jinja2 templates are compiled once into a bytecode cache and are not
+checked for changes on every render.  The search page shell is rendered
+once with placeholders, and the dropdowns are cached by their values.
+
+"""
+
+from os.path import join, dirname
+from functools import partial, lru_cache
+from jinja2 import FileSystemBytecodeCache
+import bottle
+import re
+
+from static import asset
+
+
+# Store the compiled templates in the cache directory, so they don't have
+# to be compiled again when the server restarts.
+template_settings = {
+    'bytecode_cache': FileSystemBytecodeCache(join(dirname(__file__),
+                                                   'cache')),
+    'auto_reload': False,
+    # Link to the assets by their hashed names.
+    'globals': {'asset': asset},
+}
+
+template = partial(bottle.jinja2_template, template_settings=template_settings)
+
+# Marks where a value goes in a pre-rendered page.
+field_mark = '\0%s\0'
+field_regx = re.compile('\0([^\0]+)\0')
+
+
+def dropdown_html(name: str, **kwargs) -> str:
+    """ Render the named dropdown template.  Only one value differs between
+    renders, so the html is cached by all the values.
+
+    """
+
+    try:
+        return _cached_dropdown(name, **kwargs)
+    except TypeError:
+        # The values came from a cookie and can't be hashed.
+        return template(name, name=name, **kwargs)
+
+
+@lru_cache(maxsize=512)
+def _cached_dropdown(name: str, **kwargs) -> str:
+    """ Render and cache the named dropdown template.
+
+    """
+
+    return template(name, name=name, **kwargs)
+
+
+class PageShell(object):
+    """ A template rendered once with placeholders for its fields.  Rendering
+    it only joins the static parts of the page with the field values.
+
+    """
+
+    def __init__(self, name: str, field_list: list):
+        """ Render the template name with a placeholder for each field in
+        field_list.
+
+        """
+
+        self._name = name
+        self._field_list = field_list
+        self._part_list = []
+
+    def _prepare(self):
+        """ Render the template with the placeholders and split it into the
+        static parts and the field names.
+
+        """
+
+        html = template(self._name, **{field: field_mark % field
+                                       for field in self._field_list})
+        self._part_list = field_regx.split(html)
+
+    def render(self, **kwargs) -> str:
+        """ Return the page with the fields filled in from kwargs.
+
+        """
+
+        # Templates are reloaded in debug mode, so the shell is too.
+        if not self._part_list or bottle.DEBUG:
+            self._prepare()
+
+        part_list = self._part_list[:]
+        part_list[1::2] = [str(kwargs.get(field, ''))
+                           for field in part_list[1::2]]
+        return ''.join(part_list)
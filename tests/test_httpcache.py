@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the conditional requests with compressed responses.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Check that Conditional and Compress keep the json and ndjson
+representations of a route apart, keep the cookies a route sets, and send
+the cached compressed body of the routes that allow it.
+
+"""
+
+from wsgiref.util import setup_testing_defaults
+import json
+import gzip
+
+import pytest
+
+import bottle
+from bottle import request, response
+
+from httpcache import Conditional
+from compress import Compress
+from render import FragmentCache
+from stream import wants_ndjson
+
+# Enough references that the responses get compressed.
+ref_list = ['John 3:%s' % i for i in range(1, 200)]
+
+
+@pytest.fixture
+def app(tmp_path):
+    """ A compressed app with a route like lookup, that picks json or
+    ndjson from the Accept header and sets a cookie, and a route like the
+    static json ones.  app.calls counts the calls to each route, and
+    app.cache is the cache of compressed bodies.
+
+    """
+
+    (tmp_path / 'content.txt').write_text('In the beginning')
+    conditional = Conditional(str(tmp_path))
+    bottle_app = bottle.Bottle()
+    calls = {'lookup': 0, 'refs': 0}
+
+    @bottle_app.route('/lookup<ext>')
+    @conditional('private, no-cache', cookie_list=('search_terms',),
+                 accept_func=wants_ndjson, send_cached=False)
+    def lookup(ext=''):
+        calls['lookup'] += 1
+        response.set_cookie('search_terms', 'god')
+        if wants_ndjson(request):
+            response.content_type = 'application/x-ndjson'
+            return ''.join(json.dumps(i) + '\n' for i in ref_list)
+        response.content_type = 'application/json'
+        return json.dumps({'references': ref_list})
+
+    @bottle_app.route('/refs<ext>')
+    @conditional()
+    def refs(ext=''):
+        calls['refs'] += 1
+        response.content_type = 'application/json'
+        return json.dumps({'references': ref_list})
+
+    compressed_app = Compress(bottle_app, cache=FragmentCache())
+    compressed_app.calls = calls
+    compressed_app.cache = compressed_app._cache
+    return compressed_app
+
+
+def get(app: object, path: str, query: str='', **headers) -> tuple:
+    """ Request path from app, and return the status, a dictionary of the
+    lowercase headers, and the uncompressed body.
+
+    """
+
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+    for name, value in headers.items():
+        environ['HTTP_%s' % name.upper()] = value
+    setup_testing_defaults(environ)
+
+    response_list = []
+
+    def start_response(status, header_list, exc_info=None):
+        response_list[:] = [status, header_list]
+
+    body = b''.join(app(environ, start_response))
+    status, header_list = response_list
+    header_dict = {}
+    for name, value in header_list:
+        name = name.lower()
+        if name in header_dict:
+            value = '%s, %s' % (header_dict[name], value)
+        header_dict[name] = value
+    if header_dict.get('content-encoding') == 'gzip':
+        body = gzip.decompress(body)
+
+    return status, header_dict, body
+
+
+def test_representation_etags(app):
+    """ The json and ndjson responses have different ETags and vary on
+    Accept.
+
+    """
+
+    _, json_headers, json_body = get(app, '/lookup.json')
+    _, ndjson_headers, ndjson_body = get(app, '/lookup.json',
+                                         accept='application/x-ndjson')
+
+    assert json_headers['content-type'].startswith('application/json')
+    assert ndjson_headers['content-type'].startswith('application/x-ndjson')
+    assert json.loads(json_body) == {'references': ref_list}
+    assert ndjson_body.decode().splitlines()[0] == json.dumps(ref_list[0])
+    assert json_headers['etag'] != ndjson_headers['etag']
+    assert 'Accept' in json_headers['vary']
+    assert 'Cookie' in json_headers['vary']
+
+
+def test_not_modified_per_representation(app):
+    """ The ETag of one representation doesn't get a 304 for the other,
+    compressed or not.
+
+    """
+
+    for encoding in ('identity', 'gzip'):
+        _, headers, _ = get(app, '/lookup.json', accept_encoding=encoding)
+        etag = headers['etag']
+
+        status, _, _ = get(app, '/lookup.json', if_none_match=etag,
+                           accept_encoding=encoding)
+        assert status.startswith('304')
+
+        status, headers, _ = get(app, '/lookup.json', if_none_match=etag,
+                                 accept_encoding=encoding,
+                                 accept='application/x-ndjson')
+        assert status.startswith('200')
+        assert headers['content-type'].startswith('application/x-ndjson')
+
+        status, _, _ = get(app, '/lookup.json', query='format=ndjson',
+                           if_none_match=etag, accept_encoding=encoding)
+        assert status.startswith('200')
+
+
+def test_compressed_lookup_keeps_cookie(app):
+    """ Every compressed lookup calls the route, so the cookie it sets is
+    sent, and the ndjson body is never sent to a json client.
+
+    """
+
+    for accept in ('application/x-ndjson', '', 'application/x-ndjson', ''):
+        status, headers, body = get(app, '/lookup.json', accept=accept,
+                                    accept_encoding='gzip')
+        assert status.startswith('200')
+        assert headers['content-encoding'] == 'gzip'
+        assert 'search_terms=god' in headers['set-cookie']
+        assert 'Accept-Encoding' in headers['vary']
+        if accept:
+            assert headers['content-type'].startswith('application/x-ndjson')
+        else:
+            assert json.loads(body) == {'references': ref_list}
+
+    assert app.calls['lookup'] == 4
+
+
+def test_uncached_lookup_body(app):
+    """ The compressed bodies of routes that never send them from the cache
+    aren't cached.
+
+    """
+
+    for encoding in ('gzip', 'deflate'):
+        for accept in ('application/x-ndjson', ''):
+            get(app, '/lookup.json', accept=accept, accept_encoding=encoding)
+
+    assert app.calls['lookup'] == 4
+    assert len(app.cache) == 0
+
+
+def test_cached_compressed_body(app):
+    """ The routes without cookies send the cached compressed body without
+    being called again.
+
+    """
+
+    responses = [get(app, '/refs.json', accept_encoding='gzip')
+                 for _ in range(3)]
+
+    assert app.calls['refs'] == 1
+    assert len(app.cache) == 1
+    for status, headers, body in responses:
+        assert status.startswith('200')
+        assert headers['content-encoding'] == 'gzip'
+        assert headers['content-type'].startswith('application/json')
+        assert headers['etag'].startswith('W/')
+        assert json.loads(body) == {'references': ref_list}
+
+    # A client without gzip gets the plain body.
+    _, headers, body = get(app, '/refs.json')
+    assert 'content-encoding' not in headers
+    assert json.loads(body) == {'references': ref_list}
+
+
+def test_if_modified_since(app):
+    """ Routes that vary on cookies or Accept have no Last-Modified, so
+    If-Modified-Since alone never gets them a 304.  The other routes still
+    get one.
+
+    """
+
+    _, headers, _ = get(app, '/lookup.json')
+    assert 'last-modified' not in headers
+
+    status, _, _ = get(app, '/lookup.json',
+                       if_modified_since='Fri, 01 Jan 2100 00:00:00 GMT',
+                       cookie='search_terms=love',
+                       accept='application/x-ndjson')
+    assert status.startswith('200')
+
+    _, headers, _ = get(app, '/refs.json')
+    status, _, _ = get(app, '/refs.json',
+                       if_modified_since=headers['last-modified'])
+    assert status.startswith('304')
+
+
+@pytest.mark.parametrize('path', ['/lookup.json', '/refs.json'])
+def test_not_modified_etag(app, path):
+    """ The 304 sends the same ETag the 200 did, weak if it was
+    compressed.
+
+    """
+
+    for encoding in ('gzip', 'identity'):
+        _, headers, _ = get(app, path, accept_encoding=encoding)
+        etag = headers['etag']
+        assert etag.startswith('W/') == (encoding == 'gzip')
+
+        status, not_modified_headers, _ = get(app, path, if_none_match=etag,
+                                              accept_encoding=encoding)
+        assert status.startswith('304')
+        assert not_modified_headers['etag'] == etag
+        if encoding == 'gzip':
+            assert 'Accept-Encoding' in not_modified_headers['vary']
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the partial word search of the index.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of IndexDict.from_partial, on an index filled in without a dbm.
+
+"""
+
+import pytest
+
+sword_search = pytest.importorskip('sword_search')
+
+from sword_search import regex_cache_info
+from sword_search.utils import IndexDict, partial_word_regex
+
+
+@pytest.fixture
+def index_dict():
+    """ A small index of a few words.
+
+    """
+
+    index_dict = IndexDict()
+    index_dict.update({
+        '_words_': ['love', 'loved', 'Lovely', 'beloved', 'glove', 'God'],
+        'love': ['John 3:16', '1 John 4:8'],
+        'loved': ['John 3:16', 'John 11:5'],
+        'Lovely': ['Philippians 4:8'],
+        'beloved': ['Matthew 3:17'],
+        'glove': ['Genesis 1:1'],
+        'God': ['Genesis 1:1'],
+    })
+    return index_dict
+
+
+def test_from_partial(index_dict):
+    """ The verses of every word the partial words match.
+
+    """
+
+    assert index_dict.from_partial(['lov*']) == {
+        'John 3:16', '1 John 4:8', 'John 11:5', 'Philippians 4:8'}
+    assert index_dict.from_partial(['lov*'], case_sensitive=True) == {
+        'John 3:16', '1 John 4:8', 'John 11:5'}
+    assert index_dict.from_partial(['*loved', 'god']) == {
+        'John 3:16', 'John 11:5', 'Matthew 3:17', 'Genesis 1:1'}
+    assert index_dict.from_partial(['lov*'], common_limit=2) == {
+        'Philippians 4:8'}
+
+
+def test_from_partial_compiles_once(index_dict):
+    """ Each term is compiled once, not once for every word in the index.
+
+    """
+
+    partial_word_regex.cache_clear()
+    index_dict.from_partial(['lov*', 'g*'])
+    index_dict.from_partial(['lov*'])
+
+    info = regex_cache_info()['partial_word_regex']
+    assert info['misses'] == 2
+    assert info['hits'] == 1
+
+
+def test_from_partial_bad_pattern(index_dict):
+    """ A term that isn't a valid regular expression raises a ValueError
+    instead of exiting.
+
+    """
+
+    with pytest.raises(ValueError):
+        index_dict.from_partial(['lov(*'])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the OSIS renderer and search term highlighter.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Check render_osis and highlight_osis against the regular expression
+renderer and highlighter the app used before them, over the fixture verses
+and a sample of the synthetic corpus.
+
+"""
+
+import re
+
+import pytest
+
+sword_search = pytest.importorskip('sword_search')
+
+from sword_search import synthetic, VerseIter
+from sword_search import build_highlight_regx, highlight_search_terms
+from osis_regex import tag_regx, tag_func
+from render import render_osis, build_highlight, highlight_osis, osis_tokens
+import render
+
+# Every 97th verse of the synthetic KJV, and the fixture verses.
+sample_refs = [str(i) for i in VerseIter('Genesis 1:1')][::97]
+sample_refs.extend(synthetic.fixture_verses)
+
+terms_lists = [
+    ['god'],
+    ['lov*', 'the lord'],
+    ['in the beginning', 'light'],
+    ['H0430'],
+    ['strong'],
+]
+
+# Finds the text of each highlighted word.
+highlighted_regx = re.compile(r'<span class="query-highlight">([^<]*)</span>')
+
+
+@pytest.fixture(scope='module')
+def text_list():
+    """ The raw text of the sample verses.
+
+    """
+
+    text_iter = synthetic.VerseTextIter(iter(sample_refs), strongs=True,
+                                        morph=True, render='raw')
+    return [text for _, text in text_iter]
+
+
+def old_highlight(text: str, terms_list: list) -> str:
+    """ Highlight the terms in text the way lookup_verses used to.
+
+    """
+
+    highlight_text = '<span class="query-highlight">\\1</span>'
+    reel = build_highlight_regx(terms_list, False,
+                                color_tag='</?span[^>]*>',
+                                extra_tag='</span>')
+    text = re.sub(r'(stron)g(:|Morph:|sMarkup)', '\\1k\\2', text,
+                  flags=re.IGNORECASE)
+    text = highlight_search_terms(text, reel, highlight_text,
+                                  color_tag='</?span[^>]*>')
+    return re.sub(r'(stron)k(:|Morph:|sMarkup)', '\\1g\\2', text,
+                  flags=re.IGNORECASE)
+
+
+def test_render_fixture():
+    """ The html of Genesis 1:1.
+
+    """
+
+    html = render_osis(synthetic.fixture_verses['Genesis 1:1'])
+    assert html == (
+        '<span class="word" data-lemma="strong:H07225" >In the beginning'
+        '</span> <span class="word" data-lemma="strong:H0430" >God</span> '
+        '<span class="word" data-lemma="strong:H0853 strong:H01254" '
+        'data-morph="strongMorph:TH8804">created</span> '
+        '<span class="word" data-lemma="strong:H08064" >the heaven</span> '
+        '<span class="word" data-lemma="strong:H0853" >and</span> '
+        '<span class="word" data-lemma="strong:H0776" >the earth</span>.')
+
+
+def test_render_matches_regex(text_list):
+    """ render_osis makes the same html as the regular expression renderer.
+
+    """
+
+    for ref, text in zip(sample_refs, text_list):
+        assert render_osis(text) == tag_regx.sub(tag_func, text), ref
+
+
+def test_highlight_fixture():
+    """ Only the word God is highlighted in Genesis 1:1.
+
+    """
+
+    text = synthetic.fixture_verses['Genesis 1:1']
+    highlighted = highlight_osis(text, build_highlight(['god']))
+    assert highlighted == text.replace(
+        '>God<', '><span class="query-highlight">God</span><')
+
+
+@pytest.mark.parametrize('terms_list', terms_lists)
+def test_highlight_matches_regex(text_list, terms_list):
+    """ highlight_osis makes the same text as the regex highlighter, with
+    and without the text without tags cached.
+
+    """
+
+    highlight_regx = build_highlight(terms_list)
+    render._plain_text.cache_clear()
+    for _ in range(2):
+        for ref, text in zip(sample_refs, text_list):
+            assert highlight_osis(text, highlight_regx) == \
+                old_highlight(text, terms_list), ref
+
+
+@pytest.mark.parametrize('terms_list', terms_lists)
+def test_highlight_plain_entry(text_list, tmp_path, terms_list):
+    """ highlight_osis makes the same text with the plain entries read from
+    a table as without them.
+
+    """
+
+    filename = str(tmp_path / 'plain.bin')
+    sword_search.RefTable.write(filename, map(render.plain_entry, text_list))
+    entry_table = sword_search.RefTable(filename)
+
+    highlight_regx = build_highlight(terms_list)
+    for i, (ref, text) in enumerate(zip(sample_refs, text_list)):
+        assert highlight_osis(text, highlight_regx, entry_table[i]) == \
+            highlight_osis(text, highlight_regx), ref
+
+
+@pytest.mark.parametrize('terms_list', terms_lists)
+def test_token_marks(text_list, terms_list):
+    """ The words in the token ranges osis_tokens marks are the words
+    highlight_osis highlights.  The ranges of phrases also hold the
+    punctuation between their words.
+
+    """
+
+    highlight_regx = build_highlight(terms_list)
+    for ref, text in zip(sample_refs, text_list):
+        token_list, marks = osis_tokens(text, highlight_regx)
+        marked = [token_list[i][0] for start, end in marks
+                  for i in range(start, end)
+                  if render.word_regx.match(token_list[i][0])]
+        highlighted_text = highlight_osis(text, highlight_regx)
+        highlighted = highlighted_regx.findall(highlighted_text)
+        assert marked == highlighted, ref
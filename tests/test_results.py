@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the search result cache.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the bounds of ResultCache.
+
+"""
+
+from results import ResultCache, result_id
+
+
+def refs(count: int) -> list:
+    """ A list of count references.
+
+    """
+
+    return ['Genesis 1:%s' % i for i in range(1, count + 1)]
+
+
+def test_get():
+    """ A result is found by its id with its query normalized.
+
+    """
+
+    cache = ResultCache()
+    rid = cache.add(' god  love', 'Genesis', 'Revelation', refs(3))
+    assert rid == result_id('god love', 'Genesis', 'Revelation')
+    assert cache.get(rid) == {
+        'rid': rid,
+        'search_terms': 'god love',
+        'min_range': 'Genesis',
+        'max_range': 'Revelation',
+        'references': refs(3),
+    }
+    assert cache.get('missing', {}) == {}
+
+
+def test_max_results():
+    """ The least recently used results are dropped past max_results.
+
+    """
+
+    cache = ResultCache(max_results=2)
+    first = cache.add('a', 'Genesis', 'Revelation', refs(1))
+    second = cache.add('b', 'Genesis', 'Revelation', refs(1))
+    cache.get(first)
+    cache.add('c', 'Genesis', 'Revelation', refs(1))
+    assert cache.get(first)
+    assert cache.get(second) is None
+    assert len(cache) == 2
+
+
+def test_max_references():
+    """ The least recently used results are dropped until the references
+    fit, and results too big for the cache aren't kept.
+
+    """
+
+    cache = ResultCache(max_references=100)
+    first = cache.add('a', 'Genesis', 'Revelation', refs(40))
+    second = cache.add('b', 'Genesis', 'Revelation', refs(40))
+    third = cache.add('c', 'Genesis', 'Revelation', refs(40))
+    assert cache.get(first) is None
+    assert cache.get(second) and cache.get(third)
+    assert cache.stats()['references'] == 80
+
+    # Adding the same search again doesn't count its references twice.
+    cache.add('c', 'Genesis', 'Revelation', refs(50))
+    assert cache.stats()['references'] == 90
+
+    huge = cache.add('d', 'Genesis', 'Revelation', refs(101))
+    assert cache.get(huge) is None
+    assert cache.get(second) and cache.get(third)
+    assert cache.stats()['references'] == 90
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the async tornado server adapter.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the thread pool paths of the async server: each streamed body
+is made on one thread, requests that time out get a 504 and aren't run
+later, and requests past the backlog get a 503.
+
+"""
+
+from threading import Event, Thread, get_ident
+from http.client import HTTPConnection
+import asyncio
+import time
+
+import pytest
+
+from server import drain_wsgi, Worker, WSGIHandler
+
+
+def test_drain_wsgi():
+    """ The status, headers, and each chunk are put in order, and the body
+    is closed.
+
+    """
+
+    closed = []
+
+    class Body(list):
+        def close(self):
+            closed.append(True)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return Body([b'a', b'', b'b'])
+
+    item_list = []
+    drain_wsgi(app, {}, item_list.append, Event())
+    assert item_list == [('200 OK', [('Content-Type', 'text/plain')]),
+                         b'a', b'b']
+    assert closed == [True]
+
+
+def test_drain_wsgi_stopped():
+    """ The app isn't called once the request is stopped.
+
+    """
+
+    called = []
+
+    def app(environ, start_response):
+        called.append(True)
+        start_response('200 OK', [])
+        return [b'a']
+
+    stop = Event()
+    stop.set()
+    item_list = []
+    drain_wsgi(app, {}, item_list.append, stop)
+    assert called == []
+    assert item_list == []
+
+
+def test_worker_backlog():
+    """ Only backlog calls wait for a thread, the rest are refused.
+
+    """
+
+    worker = Worker(1, 0, 1, backlog=2)
+    release = Event()
+    ran = []
+
+    def block():
+        release.wait(5)
+        ran.append(get_ident())
+
+    try:
+        assert worker.submit(block)
+        # Wait until the first call has the thread.
+        for _ in range(100):
+            if not worker._waiting:
+                break
+            time.sleep(0.01)
+        assert worker.submit(block)
+        assert worker.submit(block)
+        assert not worker.submit(block)
+        release.set()
+    finally:
+        release.set()
+        worker.executor.shutdown(wait=True)
+
+    assert len(ran) == 3
+
+
+@pytest.fixture
+def serve():
+    """ Return a function that serves a wsgi app with WSGIHandler on a
+    thread, and returns the port it is on.
+
+    """
+
+    pytest.importorskip('tornado')
+    from tornado.web import Application
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.netutil import bind_sockets
+    import re
+
+    loop_list = []
+
+    def start(wsgi_app, workers=2, timeout=5.0, backlog=0):
+        sockets = bind_sockets(0, address='127.0.0.1')
+        started = Event()
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            loop = IOLoop.current()
+            worker = Worker(workers, 0, timeout, backlog)
+            handler_args = {
+                'wsgi_app': wsgi_app,
+                'worker': worker,
+                'timeout': timeout,
+                'inline_regx': re.compile(r'^/inline'),
+            }
+            application = Application([(r'.*', WSGIHandler, handler_args)])
+            worker.server = HTTPServer(application)
+            worker.server.add_sockets(sockets)
+            loop_list.append((loop, worker))
+            loop.add_callback(started.set)
+            loop.start()
+            worker.executor.shutdown(wait=False)
+
+        Thread(target=run, daemon=True).start()
+        started.wait(5)
+        return sockets[0].getsockname()[1]
+
+    yield start
+
+    for loop, worker in loop_list:
+        loop.add_callback(loop.stop)
+
+
+def get(port: int, path: str) -> tuple:
+    """ Return the status, headers, and body of path.
+
+    """
+
+    connection = HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    result = (response.status, dict(response.getheaders()), response.read())
+    connection.close()
+    return result
+
+
+def test_streamed_body_one_thread(serve):
+    """ Every chunk of a streamed body is made on the same thread, which
+    isn't the IO loop's, while other requests run at the same time.
+
+    """
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+
+        def body():
+            for _ in range(5):
+                time.sleep(0.002)
+                yield b'%d\n' % get_ident()
+
+        return body()
+
+    port = serve(app, workers=4)
+    result_list = [None] * 16
+
+    def fetch(i):
+        result_list[i] = get(port, '/stream')
+
+    thread_list = [Thread(target=fetch, args=(i,)) for i in range(16)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+
+    for status, _, body in result_list:
+        assert status == 200
+        ident_list = body.split()
+        assert len(ident_list) == 5
+        assert len(set(ident_list)) == 1
+
+
+def test_timeout_and_stop(serve):
+    """ A request that times out gets a 504, and one that times out while
+    it waits for a thread is never run.
+
+    """
+
+    release = Event()
+    path_list = []
+
+    def app(environ, start_response):
+        path_list.append(environ['PATH_INFO'])
+        if environ['PATH_INFO'] == '/slow':
+            release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    port = serve(app, workers=1, timeout=0.3)
+    try:
+        slow = Thread(target=get, args=(port, '/slow'))
+        slow.start()
+        time.sleep(0.1)
+        status, _, _ = get(port, '/queued')
+        assert status == 504
+    finally:
+        release.set()
+    slow.join()
+
+    # Give the pool thread time to reach the queued request.
+    time.sleep(0.2)
+    assert path_list == ['/slow']
+
+    status, _, body = get(port, '/fast')
+    assert (status, body) == (200, b'done')
+
+
+def test_backlog_shed(serve):
+    """ Requests past the backlog get a 503 without waiting, and inline
+    routes still run on the loop.
+
+    """
+
+    release = Event()
+
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    port = serve(app, workers=1, backlog=1)
+    try:
+        thread_list = [Thread(target=get, args=(port, '/slow'))
+                       for _ in range(2)]
+        for thread in thread_list:
+            thread.start()
+            time.sleep(0.1)
+
+        status, headers, _ = get(port, '/other')
+        assert status == 503
+        assert headers['Retry-After'] == '1'
+
+        status, _, body = get(port, '/inline')
+        assert (status, body) == (200, b'done')
+    finally:
+        release.set()
+
+    for thread in thread_list:
+        thread.join()
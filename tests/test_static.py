@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the in memory assets.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the ETags and conditional requests of AssetStore.
+
+"""
+
+from bottle import BaseRequest
+import pytest
+
+from static import AssetStore, etag_matches
+
+
+@pytest.fixture
+def store(tmp_path) -> AssetStore:
+    """ An AssetStore with one compressible asset and no built assets.
+
+    """
+
+    asset_dir = tmp_path / 'assets'
+    asset_dir.mkdir()
+    (asset_dir / 'app.js').write_text('var x = 1;\n' * 100)
+
+    return AssetStore(str(asset_dir), str(tmp_path / 'build'))
+
+
+def get(store: AssetStore, **headers) -> object:
+    """ Request app.js from store with headers.
+
+    """
+
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/app.js'}
+    for key, value in headers.items():
+        environ['HTTP_%s' % key.upper()] = value
+
+    return store.response('app.js', BaseRequest(environ))
+
+
+def test_variant_etags(store):
+    """ Each encoding of an asset has its own ETag.
+
+    """
+
+    plain = get(store)
+    gzipped = get(store, accept_encoding='gzip')
+
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert plain.headers['ETag'] != gzipped.headers['ETag']
+    assert plain.headers['Vary'] == gzipped.headers['Vary']
+
+
+@pytest.mark.parametrize('encoding', ['', 'gzip'])
+def test_not_modified(store, encoding):
+    """ A 304 is sent for the variant the client has, with its ETag.
+
+    """
+
+    etag = get(store, accept_encoding=encoding).headers['ETag']
+    if_none_match_list = [etag, 'W/%s' % etag, '"other", %s' % etag, '*']
+
+    for if_none_match in if_none_match_list:
+        response = get(store, accept_encoding=encoding,
+                       if_none_match=if_none_match)
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+
+def test_other_variant_modified(store):
+    """ The tag of one encoding does not validate another.
+
+    """
+
+    etag = get(store).headers['ETag']
+    response = get(store, accept_encoding='gzip', if_none_match=etag)
+
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_etag_matches():
+    """ Tags are compared weakly across a list.
+
+    """
+
+    assert etag_matches('W/"a", "b"', '"a"')
+    assert etag_matches('"a"', 'W/"a"')
+    assert not etag_matches('"ab"', '"a"')
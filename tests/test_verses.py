@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# vim: sw=4:ts=4:sts=4:fdm=indent:fdl=0:
+# -*- coding: UTF8 -*-
+#
+# Tests of the verse id helpers and the reference table.
+# Copyright (C) 2013 Josiah Gordon <josiahg@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the verse id (offset) helpers and RefTable.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+import sys
+
+import pytest
+
+sword_search = pytest.importorskip('sword_search')
+
+from sword_search import parse_verse_range, sort_key
+from sword_search.verses import RefTable, Verse, VerseRange
+from sword_search.verses import verse_id, verse_ref, span_refs
+from sword_search.verses import chapter_span, book_span, next_chapter
+
+
+def test_verse_id_ends():
+    """ The first and last verses of the Bible.
+
+    """
+
+    assert verse_id('Genesis 1:1') == 0
+    assert verse_id('Revelation 22:21') == 31101
+    assert verse_ref(31101) == 'Revelation of John 22:21'
+
+
+@pytest.mark.parametrize('reference', [
+    'Genesis 1:1', 'Malachi 4:6', 'Matthew 1:1', 'John 3:16', 'Jude 1:25',
+    'Revelation 22:21', 'Jn 3:16', '1 Cor 13:4', 'Psalms 119:176',
+])
+def test_verse_id_matches_verse(reference):
+    """ verse_id gives the same id as Verse, and verse_ref gives back the
+    reference Verse would.
+
+    """
+
+    verse = Verse(reference)
+    assert verse_id(reference) == int(verse)
+    assert verse_ref(verse_id(reference)) == str(verse)
+    assert verse_id(verse_ref(verse_id(reference))) == verse_id(reference)
+
+
+@pytest.mark.parametrize('round_number', range(10))
+def test_tables_built_once_across_threads(monkeypatch, round_number):
+    """ Threads that all parse references before the tables are built get
+    the right books, and the tables are built once.
+
+    """
+
+    for name in ('_book_aliases', '_book_prefixes', '_book_candidates',
+                 '_book_index'):
+        monkeypatch.setattr(Verse, name, {})
+    for name in ('_book_offsets', '_chapter_offsets'):
+        monkeypatch.setattr(Verse, name, [])
+    Verse._fuzzy_book_index.cache_clear()
+
+    reference_list = ['Rev 22:21', 'Jude 1:3', 'Jn 3:16', '1 Cor 13:4',
+                      'Revelatoin 1:1', 'Judges 1:1'] * 8
+    barrier = Barrier(len(reference_list))
+
+    def parse(reference):
+        barrier.wait()
+        return str(Verse(reference))
+
+    # Switch threads often, so they run while the tables are being built.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(len(reference_list)) as executor:
+            result_list = list(executor.map(parse, reference_list))
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    Verse._fuzzy_book_index.cache_clear()
+    assert result_list == [
+        'Revelation of John 22:21', 'Jude 1:3', 'John 3:16',
+        'I Corinthians 13:4', 'Revelation of John 1:1', 'Judges 1:1'] * 8
+    for candidate_list in Verse._book_candidates.values():
+        assert len(candidate_list) == len(set(candidate_list))
+
+
+def test_chapter_span():
+    """ The span of the chapter with the verse in it.
+
+    """
+
+    assert chapter_span(verse_id('John 3:16')) == (verse_id('John 3:1'),
+                                                   verse_id('John 3:36'))
+    assert chapter_span(0) == (0, verse_id('Genesis 1:31'))
+    assert chapter_span(31101) == (verse_id('Revelation 22:1'), 31101)
+
+
+def test_book_span():
+    """ The span of the book with the verse in it.
+
+    """
+
+    assert book_span(verse_id('Jude 1:3')) == (verse_id('Jude 1:1'),
+                                               verse_id('Jude 1:25'))
+    assert book_span(verse_id('Genesis 50:26')) == \
+        (0, verse_id('Genesis 50:26'))
+    assert book_span(31101) == (verse_id('Revelation 1:1'), 31101)
+
+
+def test_next_chapter():
+    """ The next chapter crosses books, and there isn't one after the last
+    chapter.
+
+    """
+
+    assert next_chapter(verse_id('John 3:16')) == verse_id('John 4:1')
+    assert next_chapter(verse_id('Malachi 4:6')) == verse_id('Matthew 1:1')
+    assert next_chapter(verse_id('Revelation 21:27')) == \
+        verse_id('Revelation 22:1')
+    assert next_chapter(verse_id('Revelation 22:3')) is None
+
+
+def test_span_refs():
+    """ span_refs gives the same references, in the same order, as parsing
+    the range.
+
+    """
+
+    span = (verse_id('Jude 1:24'), verse_id('Revelation 1:2'))
+    assert span_refs(span) == sorted(parse_verse_range('Jude 1:24-Rev 1:2'),
+                                     key=sort_key)
+    start, end = chapter_span(verse_id('Psalms 23:1'))
+    assert span_refs((start, end)) == ['Psalms 23:%s' % i
+                                       for i in range(1, 7)]
+
+
+def test_verse_range_last_verse():
+    """ A range that ends at the last verse stops there.
+
+    """
+
+    verse_range = VerseRange('Revelation 22:20', 'Revelation 22:21')
+    assert [str(i) for i in verse_range] == ['Revelation of John 22:20',
+                                             'Revelation of John 22:21']
+
+
+def test_ref_table(tmp_path):
+    """ Write a table and read it back.
+
+    """
+
+    filename = str(tmp_path / 'refs.bin')
+    ref_list = ['Genesis 1:1', '', 'Revelation of John 22:21', 'Ἰησοῦς']
+    assert RefTable.write(filename, iter(ref_list)) == len(ref_list)
+
+    table = RefTable(filename)
+    assert len(table) == len(ref_list)
+    assert list(table) == ref_list
+    assert table[-1] == ref_list[-1]
+    assert table[1:3] == ref_list[1:3]
+    assert table.index('Revelation of John 22:21') == 2
+    with pytest.raises(IndexError):
+        table[len(ref_list)]
+    with pytest.raises(ValueError):
+        table.index('John 3:16')
+
+
+def test_ref_table_bad_file(tmp_path):
+    """ A file that isn't a reference table.
+
+    """
+
+    filename = tmp_path / 'refs.bin'
+    filename.write_bytes(b'\0' * 16)
+    with pytest.raises(ValueError):
+        RefTable(str(filename))
+
+
+def test_book_list():
+    """ The list of book names is built when it is first used.
+
+    """
+
+    from sword_search import verses
+
+    assert sword_search.book_list == list(verses.book_gen())
+    assert sword_search.book_list[0] == 'Genesis'
+    assert len(sword_search.book_list) == 66